@@ -0,0 +1,121 @@
+# coding=utf-8
+"""
+
+Rotation augmentation applied while streaming the training batches.
+For every angle the bilinear resampling of skimage.transform.rotate (resize=False, constant zero border)
+is precomputed once as a map of source pixels and weights, then applied to a whole batch
+with one vectorized gather, so rotated patches are never stored.
+
+"""
+
+from __future__ import print_function
+import numpy as np
+
+__author__ = "Cesare Catavitello"
+
+__license__ = "MIT"
+__version__ = "1.0.1"
+__maintainer__ = "Cesare Catavitello"
+__email__ = "cesarec88@gmail.com"
+__status__ = "Production"
+
+
+class RotationMap(object):
+    """
+    bilinear resampling map rotating (h, w) images of angle degrees around their center
+    """
+
+    def __init__(self, shape, angle):
+        """
+
+        :param shape: (h, w) of the images to rotate
+        :param angle: rotation in degrees, counter-clockwise as in skimage.transform.rotate
+        """
+        self.shape = tuple(shape)
+        self.angle = angle
+        rows, cols = self.shape
+        # output pixel -> source coordinates, same center convention of skimage.transform.rotate
+        center_col, center_row = cols / 2. - 0.5, rows / 2. - 0.5
+        theta = np.deg2rad(angle)
+        out_row, out_col = np.mgrid[:rows, :cols].reshape(2, -1).astype(float)
+        src_col = np.cos(theta) * (out_col - center_col) - np.sin(theta) * (out_row - center_row) + center_col
+        src_row = np.sin(theta) * (out_col - center_col) + np.cos(theta) * (out_row - center_row) + center_row
+        row0, col0 = np.floor(src_row), np.floor(src_col)
+        d_row, d_col = src_row - row0, src_col - col0
+        # images are padded by one zero pixel per side, neighbours outside the image read the zero border
+        padded_rows, padded_cols = rows + 2, cols + 2
+        indices, weights = [], []
+        for dr, dc, weight in ((0, 0, (1 - d_row) * (1 - d_col)), (0, 1, (1 - d_row) * d_col),
+                               (1, 0, d_row * (1 - d_col)), (1, 1, d_row * d_col)):
+            r = np.clip(row0 + dr + 1, 0, padded_rows - 1).astype(np.intp)
+            c = np.clip(col0 + dc + 1, 0, padded_cols - 1).astype(np.intp)
+            indices.append(r * padded_cols + c)
+            weights.append(weight)
+        self.indices = np.array(indices)
+        self.weights = np.array(weights, dtype=np.float32)
+
+    def apply(self, batch):
+        """
+        rotates every image of the batch
+        :param batch: array (..., h, w)
+        :return: float32 array of the same shape with the rotated images
+        """
+        batch = np.asarray(batch, dtype=np.float32)
+        lead = batch.shape[:-2]
+        padded = np.zeros(lead + (self.shape[0] + 2, self.shape[1] + 2), dtype=np.float32)
+        padded[..., 1:-1, 1:-1] = batch
+        padded = padded.reshape(lead + (-1,))
+        rotated = padded[..., self.indices[0]] * self.weights[0]
+        for k in xrange(1, 4):
+            rotated += padded[..., self.indices[k]] * self.weights[k]
+        return rotated.reshape(batch.shape)
+
+
+def rotation_maps(shape, augmentation_angle):
+    """
+    maps of all the rotations multiple of augmentation_angle, the first one is the identity
+    :param shape: (h, w) of the patches
+    :param augmentation_angle: angle in degrees between two rotations
+    :return: list of RotationMap, None in place of the identity
+    """
+    if augmentation_angle % 360 == 0:
+        return [None]
+    multiplier = int(360. / augmentation_angle)
+    return [None] + [RotationMap(shape, augmentation_angle * j) for j in xrange(1, multiplier)]
+
+
+def rotate_batch(batch, rotation_ix, maps):
+    """
+    rotates each patch of a batch with its own map, every map is applied to all its patches at once
+    :param batch: patches (n, n_channel, h, w)
+    :param rotation_ix: index in maps of the rotation of each patch
+    :param maps: rotations as given by rotation_maps
+    :return: float32 array (n, n_channel, h, w)
+    """
+    rotated = np.array(batch, dtype=np.float32)
+    for rotation, rotation_map in enumerate(maps):
+        selected = np.flatnonzero(rotation_ix == rotation)
+        if rotation_map is not None and len(selected) > 0:
+            rotated[selected] = rotation_map.apply(rotated[selected])
+    return rotated
+
+
+def augmented_batches(X, Y, maps, batch_size=128):
+    """
+    endless stream of shuffled training batches over all the (patch, rotation) couples,
+    each epoch covers len(X) * len(maps) samples and every rotation is applied to its whole share of a batch at once
+    :param X: patches (n_sample, n_channel, h, w), also memory mapped
+    :param Y: categorical labels (n_sample, n_classes)
+    :param maps: rotations as given by rotation_maps
+    :param batch_size: samples per batch
+    :return: generator of (batch of patches, batch of labels)
+    """
+    n_samples = len(X)
+    while True:
+        order = np.random.permutation(n_samples * len(maps))
+        for start in xrange(0, len(order), batch_size):
+            chosen = order[start:start + batch_size]
+            # sorted reads are cheaper on memory mapped patches
+            chosen = chosen[np.argsort(chosen % n_samples, kind='mergesort')]
+            patch_ix, rotation_ix = chosen % n_samples, chosen // n_samples
+            yield rotate_batch(X[patch_ix], rotation_ix, maps), Y[patch_ix]
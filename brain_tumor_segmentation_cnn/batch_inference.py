@@ -0,0 +1,127 @@
+# coding=utf-8
+"""
+
+Inference over a whole test set, with the patches of several slices packed in the same batches.
+The slices are decoded ahead by a pool of reader threads, their patches fill predict batches of a
+fixed size whatever slice they come from, and each slice is handed back as soon as all its patches
+are classified, so that its result is written while the model keeps running on the next ones.
+
+"""
+
+from __future__ import print_function
+from multiprocessing.pool import ThreadPool
+from numpy.lib.stride_tricks import as_strided
+from collections import deque
+import numpy as np
+
+__author__ = "Cesare Catavitello"
+
+__license__ = "MIT"
+__version__ = "1.0.1"
+__maintainer__ = "Cesare Catavitello"
+__email__ = "cesarec88@gmail.com"
+__status__ = "Production"
+
+
+def read_ahead(load, keys, workers=4, ahead=16):
+    """
+    loads the slices on a pool of threads, at most ahead slices are loaded and not yet consumed
+    :param load: function key -> loaded slice
+    :param keys: keys of the slices
+    :param workers: number of reader threads
+    :param ahead: number of slices loaded in advance
+    :return: generator of (key, loaded slice), in the order of keys
+    """
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for key in keys:
+            pending.append((key, pool.apply_async(load, (key,))))
+            if len(pending) >= ahead:
+                key, loaded = pending.popleft()
+                yield key, loaded.get()
+        while pending:
+            key, loaded = pending.popleft()
+            yield key, loaded.get()
+    finally:
+        pool.terminate()
+
+
+class _Slice(object):
+    """
+    patches of a slice waiting to be classified
+    """
+
+    def __init__(self, key, features, inside, patch_size):
+        h, w = patch_size
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        channels, rows, cols = features.shape
+        self.key = key
+        self.windows = as_strided(features, shape=(rows - h + 1, cols - w + 1, channels, h, w),
+                                  strides=features.strides[1:] + features.strides)
+        if inside is None:
+            inside = np.ones(self.windows.shape[:2], dtype=bool)
+        self.positions = np.argwhere(inside)
+        self.classes = np.zeros(self.windows.shape[:2], dtype=int)
+        # patches copied in a batch and patches classified so far
+        self.queued = 0
+        self.classified = 0
+
+    def finished(self):
+        return self.classified == len(self.positions)
+
+
+def _classify(model, patches, segments):
+    """
+    classifies a batch and gives its classes back to the slices of its patches
+    :param model: patch classifier
+    :param patches: array (n, channels, h, w) of the batch
+    :param segments: list of (slice, first position, number of positions) of the patches of the batch, in order
+    """
+    classes = model.predict_classes(patches)
+    offset = 0
+    for patch_slice, start, count in segments:
+        selected = patch_slice.positions[start:start + count]
+        patch_slice.classes[selected[:, 0], selected[:, 1]] = classes[offset:offset + count]
+        patch_slice.classified += count
+        offset += count
+
+
+def classify_slices(model, slices, batch_size=4096):
+    """
+    classifies the patches of a stream of slices, in batches holding the patches of consecutive slices
+    :param model: patch classifier with input (n, channels, h, w), keras or numpy_runtime
+    :param slices: iterable of (key, features, inside): features (channels, rows, cols) the patches are cut from,
+     inside boolean (rows - h + 1, cols - w + 1) of the patches to classify, None for all of them
+    :param batch_size: number of patches of each predict batch, copied always in the same float32 buffer
+    :return: generator of (key, classes) in the order of slices, classes (rows - h + 1, cols - w + 1)
+     where element (i, j) is the class of the patch with top-left corner (i, j), 0 if not classified
+    """
+    patch_size = tuple(model.input_shape[2:])
+    buffer = None
+    pending = deque()
+    segments = []
+    filled = 0
+    for key, features, inside in slices:
+        patch_slice = _Slice(key, features, inside, patch_size)
+        if buffer is None:
+            buffer = np.empty((batch_size,) + patch_slice.windows.shape[2:], dtype=np.float32)
+        pending.append(patch_slice)
+        while patch_slice.queued < len(patch_slice.positions):
+            count = min(batch_size - filled, len(patch_slice.positions) - patch_slice.queued)
+            selected = patch_slice.positions[patch_slice.queued:patch_slice.queued + count]
+            buffer[filled:filled + count] = patch_slice.windows[selected[:, 0], selected[:, 1]]
+            segments.append((patch_slice, patch_slice.queued, count))
+            patch_slice.queued += count
+            filled += count
+            if filled == batch_size:
+                _classify(model, buffer, segments)
+                segments, filled = [], 0
+        while pending and pending[0].finished():
+            done = pending.popleft()
+            yield done.key, done.classes
+    if filled:
+        _classify(model, buffer[:filled], segments)
+    while pending:
+        done = pending.popleft()
+        yield done.key, done.classes
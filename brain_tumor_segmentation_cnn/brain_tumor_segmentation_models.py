@@ -10,27 +10,29 @@ The segmentation is described in accordance to the rules of the Brats Contest.
 
 from __future__ import print_function
 from skimage.color import rgb2gray
-from glob import glob
-from skimage import io, color, img_as_float
-from skimage.exposure import adjust_gamma
-from sklearn.feature_extraction.image import extract_patches_2d
+from skimage import io, img_as_float
+from skimage.morphology import binary_dilation, square
 from sklearn.metrics import classification_report
-from keras.utils import np_utils
-from keras.models import Sequential
-from keras.layers import Dense, Conv2D, MaxPool2D, Dropout, Activation, Flatten
-from keras.optimizers import SGD
-from keras.layers.advanced_activations import LeakyReLU
-from keras.callbacks import EarlyStopping
-from keras.initializers import glorot_normal
-from keras.models import model_from_json
 from os.path import isdir
 from os import makedirs
 from errno import EEXIST
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import json
+import time
 import argparse
 import matplotlib.image as mpimg
 from patch_library import PatchLibrary
+from augmentation import rotation_maps, augmented_batches
+from patch_stream import StoreSampler, IndexSampler, balanced_batches, prefetch
+from volume_store import get_slice_loader, PngStripLoader, brain_mask
+from overlay import render_overlay, OverlayWriter, TUMOR_COLORS
+from batch_inference import read_ahead, classify_slices
+from hard_examples import mine_hard_examples
+import numpy_runtime
+
+# keras is imported only by the methods building, training or loading a keras model,
+# a model loaded with the numpy runtime predicts without importing it
 
 __author__ = "Cesare Catavitello"
 
@@ -62,18 +64,26 @@ class Brain_tumor_segmentation_model(object):
      viewing segmented images and analyzing results
     """
 
-    def __init__(self, is_hgg=None, n_chan=4, loaded_model=False, model_name=None):
+    def __init__(self, is_hgg=None, n_chan=4, loaded_model=False, model_name=None, runtime='keras'):
         """
 
         :param model_name: if loaded_model is True load the model name specified
         :param is_hgg: if True compile model for HGG if False for LGG
         :param n_chan:number of channels being assessed. defaults to 4
         :param loaded_model: True if loading a pre-existing model. defaults to False
+        :param runtime: 'keras' or 'numpy', runtime of the loaded model, with numpy it can only predict
         """
         self.n_chan = n_chan
         self.loaded_model = loaded_model
         self.is_hgg = is_hgg
         self.model = None
+        self.dense_model = None
+        # pixels evaluated and skipped by the last roi prediction
+        self.roi_counts = None
+        # grid points evaluated and found in the tumor by the last coarse pass
+        self.coarse_counts = None
+        # slice loader of volume_store for the test data, None reads the test PNGs directly
+        self.loader = None
 
         if not self.loaded_model:
             if self.is_hgg is None:
@@ -91,9 +101,13 @@ class Brain_tumor_segmentation_model(object):
                 model_to_load = str(raw_input('Which model should I load? '))
             else:
                 model_to_load = model_name
-            self.model = self.load_model_weights(model_to_load)
+            self.model = self.load_model_weights(model_to_load, runtime)
 
     def _make_model(self):
+        from keras.models import Sequential
+        from keras.layers import Dense, Conv2D, MaxPool2D, Dropout, Activation, Flatten
+        from keras.layers.advanced_activations import LeakyReLU
+        from keras.initializers import glorot_normal
         if self.is_hgg:
             dropout_rate = 0.1
         else:
@@ -234,6 +248,7 @@ class Brain_tumor_segmentation_model(object):
         self.model = model_to_make
 
     def _compile_model(self):
+        from keras.optimizers import SGD
         # default decay = 1e-6, lr = 0.01 maybe 1e-2 for linear decay?
         sgd = SGD(lr=3e-3,
                   decay=0,
@@ -245,13 +260,22 @@ class Brain_tumor_segmentation_model(object):
                            metrics=['accuracy'])
 
     @staticmethod
-    def load_model_weights(model_name):
+    def load_model_weights(model_name, runtime='keras'):
         """
 
         :param model_name: filepath to model and weights, not including extension
-        :return: Model with loaded weights. can fit on model using loaded_model=True in fit_model method
+        :param runtime: 'keras', or 'numpy' to run the model with numpy_runtime, keras is then never imported
+        :return: Model with loaded weights. can fit on model using loaded_model=True in fit_model method,
+         with the numpy runtime a numpy_runtime model that can only predict
         """
         print('Loading model {}'.format(model_name))
+        if runtime == 'numpy':
+            model_comp = numpy_runtime.load_model(model_name)
+            print('Done.')
+            return model_comp
+        if runtime != 'keras':
+            raise ValueError('unknown runtime {}'.format(runtime))
+        from keras.models import model_from_json
         model_to_load = '{}.json'.format(model_name)
         weights = '{}.hdf5'.format(model_name)
         with open(model_to_load) as f:
@@ -261,13 +285,18 @@ class Brain_tumor_segmentation_model(object):
         print('Done.')
         return model_comp
 
-    def fit_model(self, X_train, y_train):
+    def fit_model(self, X_train, y_train, augmentation_angle=0, n_epochs=None):
         """
 
         :param X_train: list of patches to train on in form (n_sample, n_channel, h, w)
         :param y_train: list of labels corresponding to X_train patches in form (n_sample,)
+        :param augmentation_angle: if not 0 every epoch also shows each patch rotated of all the multiples
+         of this angle, rotations are computed batch by batch
+        :param n_epochs: number of epochs, by default 20 for HGG and 25 for LGG
         :return: Fits specified model
         """
+        from keras.utils import np_utils
+        from keras.callbacks import EarlyStopping
 
         print(X_train.shape)
         print('*' * 100)
@@ -275,19 +304,83 @@ class Brain_tumor_segmentation_model(object):
         print('*' * 100)
         Y_train = np_utils.to_categorical(y_train, 5)
 
-        shuffle = zip(X_train, Y_train)
-        np.random.shuffle(shuffle)
+        if n_epochs is None:
+            n_epochs = 20 if self.is_hgg else 25
+
+        if augmentation_angle % 360 != 0:
+            maps = rotation_maps(X_train.shape[2:], augmentation_angle)
+            steps = (len(X_train) * len(maps) + 127) // 128
+            print('training on {} patches x {} rotations'.format(len(X_train), len(maps)))
+            self.model.fit_generator(augmented_batches(X_train, Y_train, maps, batch_size=128),
+                                     steps_per_epoch=steps, epochs=n_epochs, verbose=1)
+            self.dense_model = None
+            return
 
-        X_train = np.array([shuffle[i][0] for i in xrange(len(shuffle))])
-        Y_train = np.array([shuffle[i][1] for i in xrange(len(shuffle))])
         EarlyStopping(monitor='val_loss', patience=2, mode='auto')
 
-        if self.is_hgg:
-            n_epochs = 20
+        # keras shuffles a permutation of the indices at every epoch, the patches are not copied
+        self.model.fit(X_train, Y_train, epochs=n_epochs, batch_size=128, shuffle=True, verbose=1)
+        self.dense_model = None
+
+    def fit_stream(self, library, num_samples, source='store', augmentation_angle=0, batch_size=128, n_epochs=None,
+                   store_chunk=10000):
+        """
+        fits the model on class balanced batches streamed from disk, the patches are never all in memory
+        :param library: PatchLibrary of the training data
+        :param num_samples: number of patches per epoch, before augmentation
+        :param source: 'store' to draw from the patch stores (topped up to num_samples / 5 patches per class),
+         'index' to cut new patches around the centers of the coordinate index at every batch
+        :param augmentation_angle: if not 0 each patch is rotated of a random multiple of this angle
+        :param batch_size: patches per batch
+        :param n_epochs: number of epochs, by default 20 for HGG and 25 for LGG
+        :param store_chunk: patches cut and appended at a time while a store is topped up
+        :return: Fits specified model
+        """
+        classes = [0, 1, 2, 3, 4]
+        if source == 'store':
+            stores = dict((class_num, library.patch_store(class_num, num_samples // len(classes), store_chunk))
+                          for class_num in classes)
+            sampler = StoreSampler(stores, num_samples // len(classes))
+        elif source == 'index':
+            sampler = IndexSampler(library)
         else:
-            n_epochs = 25
+            raise ValueError('unknown stream source {}'.format(source))
+        maps = rotation_maps(library.patch_size, augmentation_angle)
+        steps = (num_samples * len(maps) + batch_size - 1) // batch_size
+
+        if n_epochs is None:
+            n_epochs = 20 if self.is_hgg else 25
 
-        self.model.fit(X_train, Y_train, epochs=n_epochs, batch_size=128, verbose=1)
+        print('streaming {} batches of {} patches per epoch from the {}'.format(steps, batch_size, source))
+        self.model.fit_generator(prefetch(balanced_batches(sampler, classes, batch_size, maps)),
+                                 steps_per_epoch=steps, epochs=n_epochs, verbose=1)
+        self.dense_model = None
+
+    def fit_hard_examples(self, library, num_samples, rounds=1, stride=4, fraction=0.5, n_epochs=5, source=None,
+                          augmentation_angle=0):
+        """
+        rounds of hard example mining: the current model classifies the training slices on a grid, the centers it
+        gets wrong or with a low confidence become a weighted pool mixed in the sampling of the library,
+        then the model is fit again for a few epochs
+        :param library: PatchLibrary of the training data
+        :param num_samples: number of patches per epoch when streaming
+        :param rounds: number of mining and training rounds
+        :param stride: distance in pixels between the grid points of the mining, 1 to classify every pixel
+        :param fraction: fraction of the patches of each class drawn from the hard examples
+        :param n_epochs: number of epochs of each round
+        :param source: 'index' to stream the patches as fit_stream, None to fit on patches in memory
+        :param augmentation_angle: angle of the rotations of the patches, as in fit_model and fit_stream
+        :return: Fits specified model
+        """
+        for round_num in xrange(rounds):
+            print('hard example mining, round {} of {}'.format(round_num + 1, rounds))
+            library.use_hard_examples(mine_hard_examples(self.model, library, stride=stride), fraction)
+            if source == 'index':
+                self.fit_stream(library, num_samples, source='index', augmentation_angle=augmentation_angle,
+                                n_epochs=n_epochs)
+            else:
+                X, y = library.make_training_patches()
+                self.fit_model(X, y, augmentation_angle=augmentation_angle, n_epochs=n_epochs)
 
     def save_model(self, model_name):
         """
@@ -317,83 +410,325 @@ class Brain_tumor_segmentation_model(object):
         y_pred = self.model.predict_class(X_test)
         print(classification_report(y_pred, y_test))
 
-    def predict_image(self, test_img):
+    def _load_strip(self, test_img):
         """
-        predicts classes of input image
-        :param test_img: filepath to image to predict on
-        :return: segmented result
+        loads the five images of a test slice, through self.loader if set
+        :param test_img: filepath (or loader key) of the image to predict on
+        :return: array (5, 216, 160) with values in [0, 1]
         """
+        if self.loader is not None:
+            return self.loader.load_slice(test_img) / 255.
         # imgs = io.imread(test_img).astype('float').reshape(5, 216, 160)
         imgs = mpimg.imread(test_img).astype('float')
-        imgs = rgb2gray(imgs).reshape(5, 216, 160)
+        return rgb2gray(imgs).reshape(5, 216, 160)
 
-        plist = []
+    def load_test_slice(self, test_img):
+        """
+        loads a test strip and normalizes each modality in [0, 1] as the training patches
+        :param test_img: filepath (or loader key) of the image to predict on
+        :return: array (4, 216, 160) with the four modalities of the slice
+        """
+        return self.normalize_modalities(self._load_strip(test_img)[:-1])
 
-        # create patches_to_predict from an entire slice
-        for img in imgs[:-1]:
+    @staticmethod
+    def normalize_modalities(imgs):
+        """
+        divides in place each modality by its maximum
+        :param imgs: array (4, rows, cols)
+        :return: imgs
+        """
+        for img in imgs:
             if np.max(img) != 0:
                 img /= np.max(img)
-            p = extract_patches_2d(img, (33, 33))
-            plist.append(p)
-        patches_to_predict = np.array(
-            zip(np.array(plist[0]), np.array(plist[1]), np.array(plist[2]), np.array(plist[3])))
+        return imgs
+
+    def roi_mask(self, test_img, imgs, mask=None):
+        """
+        gives the brain mask of a test slice: the given one, the one saved with the slice by the
+        pre processing, or the pixels where any modality is not zero
+        :param test_img: filepath (or loader key) of the slice
+        :param imgs: array (4, rows, cols) of the slice
+        :param mask: optional boolean mask (rows, cols)
+        :return: boolean mask (rows, cols)
+        """
+        if mask is None and self.loader is not None:
+            mask = self.loader.load_mask(test_img)
+        if mask is None:
+            mask = brain_mask(imgs)
+        return np.asarray(mask, dtype=bool)
+
+    def _predict_positions(self, imgs, positions, chunk=4096):
+        """
+        classifies only the patches at the given positions, cut in chunks from a strided view of the slice
+        :param imgs: array (4, rows, cols) of the normalized slice
+        :param positions: array (n, 2) of top-left corners of the patches to classify
+        :param chunk: number of patches copied and classified at once
+        :return: array (n,) of predicted classes
+        """
+        h, w = self.model.input_shape[2:]
+        channels, rows, cols = imgs.shape
+        windows = as_strided(imgs, shape=(rows - h + 1, cols - w + 1, channels, h, w),
+                             strides=imgs.strides[1:] + imgs.strides)
+        classes = np.zeros(len(positions), dtype=int)
+        for start in xrange(0, len(positions), chunk):
+            selected = positions[start:start + chunk]
+            classes[start:start + chunk] = self.model.predict_classes(windows[selected[:, 0], selected[:, 1]])
+        return classes
+
+    def predict_patches(self, imgs, chunk=4096):
+        """
+        classifies every patch of the slice, the patches are copied from a strided view of the slice
+        in chunks of whole rows, always in the same float32 buffer: the memory used is set by chunk,
+        not by the size of the slice
+        :param imgs: array (4, rows, cols) of the normalized slice
+        :param chunk: number of patches classified at once, rounded down to whole rows of patches
+        :return: array (rows - 32, cols - 32) of predicted classes
+        """
+        h, w = self.model.input_shape[2:]
+        channels, rows, cols = imgs.shape
+        windows = as_strided(imgs, shape=(rows - h + 1, cols - w + 1, channels, h, w),
+                             strides=imgs.strides[1:] + imgs.strides)
+        block = min(len(windows), max(1, chunk // windows.shape[1]))
+        buffer = np.empty((block * windows.shape[1], channels, h, w), dtype=np.float32)
+        classes = np.zeros(windows.shape[:2], dtype=int)
+        for start in xrange(0, len(windows), block):
+            n_rows = len(windows[start:start + block])
+            patches = buffer[:n_rows * windows.shape[1]]
+            patches.reshape((n_rows,) + windows.shape[1:])[...] = windows[start:start + block]
+            classes[start:start + block] = self.model.predict_classes(patches).reshape(n_rows, -1)
+        return classes
+
+    def predict_image(self, test_img, dense=False, roi=False, mask=None, coarse=0, margin=8, chunk=4096):
+        """
+        predicts classes of input image
+        :param test_img: filepath to image to predict on
+        :param dense: if True segments the whole slice in one pass of the fully convolutional model
+        :param roi: if True only the pixels inside the brain mask are classified, the background is class 0
+        :param mask: brain mask (216, 160) to use with roi, by default the one saved by the pre processing
+         or the pixels where any modality is not zero
+        :param coarse: if not 0, stride of the grid of the coarse pass finding the tumor,
+         only the pixels near the tumor found are then classified (see predict_coarse_to_fine)
+        :param margin: pixels added around the tumor found by the coarse pass
+        :param chunk: number of patches classified at once by the patch based prediction
+        :return: segmented result
+        """
+        imgs = self.load_test_slice(test_img)
+        if coarse:
+            return self.predict_coarse_to_fine(imgs, self.roi_mask(test_img, imgs, mask), coarse, margin, dense=dense)
+        if roi:
+            return self.predict_roi(imgs, self.roi_mask(test_img, imgs, mask), dense=dense)
+        if dense:
+            return self.predict_dense(imgs[np.newaxis])[0]
 
         # predict classes of each pixel based on model
-        full_pred = self.model.predict_classes(patches_to_predict)
-        fp1 = full_pred.reshape(184, 128)
-        return fp1
+        return self.predict_patches(imgs, chunk)
+
+    def predict_roi(self, imgs, mask, dense=False):
+        """
+        classifies only the patches centered inside the mask, the others are set to class 0.
+        The result is the one of the full run inside the mask
+        :param imgs: array (4, rows, cols) of the normalized slice
+        :param mask: boolean mask (rows, cols)
+        :param dense: if True the fully convolutional model is run on the bounding box of the mask,
+         when its results are the ones of the patch based prediction (see dense_exact)
+        :return: array (rows - 32, cols - 32) of predicted classes
+        """
+        h, w = self.model.input_shape[2:]
+        rows, cols = imgs.shape[1] - h + 1, imgs.shape[2] - w + 1
+        # the patch with top-left corner (i, j) is centered in (i + h // 2, j + w // 2)
+        inside = mask[h // 2:h // 2 + rows, w // 2:w // 2 + cols]
+        segmentation = np.zeros((rows, cols), dtype=int)
+        positions = np.argwhere(inside)
+        print('ROI: {} pixels evaluated, {} background pixels skipped'.format(len(positions),
+                                                                           rows * cols - len(positions)))
+        self.roi_counts = (len(positions), rows * cols - len(positions))
+        if len(positions) == 0:
+            return segmentation
+        if dense and self.dense_exact():
+            # the crop holds the whole patch of every position of the bounding box
+            (r0, c0), (r1, c1) = positions.min(axis=0), positions.max(axis=0) + 1
+            crop = imgs[np.newaxis, :, r0:r1 + h - 1, c0:c1 + w - 1]
+            segmentation[r0:r1, c0:c1] = self.predict_dense(crop)[0]
+            segmentation[~inside] = 0
+        else:
+            segmentation[inside] = self._predict_positions(imgs, positions)
+        return segmentation
+
+    def predict_coarse_to_fine(self, imgs, mask, stride=4, margin=8, dense=False):
+        """
+        two stage segmentation: a coarse pass classifies the pixels of the brain on a grid of the given stride,
+        then the full model runs only around the grid points found in the tumor, dilated by stride - 1 + margin
+        pixels. Slices where the coarse pass finds no tumor are returned as class 0 without any other pass,
+        tumors smaller than the stride can be missed
+        :param imgs: array (4, rows, cols) of the normalized slice
+        :param mask: brain mask (rows, cols), the grid points outside are skipped
+        :param stride: distance in pixels between the points of the coarse grid
+        :param margin: pixels added around the tumor found by the coarse pass
+        :param dense: if True the fine pass uses the fully convolutional model, when exact (see predict_roi)
+        :return: array (rows - 32, cols - 32) of predicted classes
+        """
+        h, w = self.model.input_shape[2:]
+        rows, cols = imgs.shape[1] - h + 1, imgs.shape[2] - w + 1
+        grid = np.zeros((rows, cols), dtype=bool)
+        grid[::stride, ::stride] = True
+        grid &= mask[h // 2:h // 2 + rows, w // 2:w // 2 + cols]
+        positions = np.argwhere(grid)
+        tumor = positions[self._predict_positions(imgs, positions) != 0] if len(positions) > 0 else positions
+        self.coarse_counts = (len(positions), len(tumor))
+        print('coarse pass: {} grid points evaluated, {} in the tumor'.format(*self.coarse_counts))
+        if len(tumor) == 0:
+            self.roi_counts = (0, rows * cols)
+            return np.zeros((rows, cols), dtype=int)
+        candidates = np.zeros(mask.shape, dtype=bool)
+        candidates[tumor[:, 0] + h // 2, tumor[:, 1] + w // 2] = True
+        candidates = binary_dilation(candidates, square(2 * (stride - 1 + margin) + 1))
+        return self.predict_roi(imgs, candidates & mask, dense=dense)
+
+    def validate_coarse_to_fine(self, tests, stride=4, margin=8, dense=False):
+        """
+        compares the coarse to fine segmentation with the full one on validation slices. The reference is the
+        segmentation of every pixel of the slice, brain mask included, so that the tumor pixels missed
+        because they fall outside the mask count against the recall too
+        :param tests: filepaths (or loader keys) of the validation slices
+        :param stride: distance in pixels between the points of the coarse grid
+        :param margin: pixels added around the tumor found by the coarse pass
+        :param dense: if True both segmentations use the fully convolutional model
+        :return: dict with the speed-up, the recall of the tumor pixels of the full segmentation,
+         the agreement on the class of the tumor pixels and the number of slices skipped by the coarse pass
+        """
+        full_time, coarse_time = 0., 0.
+        tumor, found, agreed, skipped = 0, 0, 0, 0
+        for test_img in tests:
+            imgs = self.load_test_slice(test_img)
+            mask = self.roi_mask(test_img, imgs)
+            start = time.time()
+            full = self.predict_dense(imgs[np.newaxis])[0] if dense else self.predict_patches(imgs)
+            full_time += time.time() - start
+            start = time.time()
+            fine = self.predict_coarse_to_fine(imgs, mask, stride, margin, dense=dense)
+            coarse_time += time.time() - start
+            skipped += self.coarse_counts[1] == 0
+            tumor += np.count_nonzero(full)
+            found += np.count_nonzero((full != 0) & (fine != 0))
+            agreed += np.count_nonzero((full != 0) & (fine == full))
+        report = {'speed_up': full_time / max(coarse_time, 1e-12),
+                  'recall': found / float(tumor) if tumor else 1.,
+                  'agreement': agreed / float(tumor) if tumor else 1.,
+                  'skipped_slices': skipped,
+                  'slices': len(tests)}
+        print('coarse to fine (stride {}, margin {}): speed-up {speed_up:.2f}x, tumor recall {recall:.4f}, '
+              'class agreement {agreement:.4f}, {skipped_slices}/{slices} slices skipped'.format(stride, margin,
+                                                                                                 **report))
+        return report
+
+    def dense_exact(self):
+        """
+        builds, if needed, the fully convolutional version of the model
+        :return: True if its results are the ones of the patch based prediction, False if the model
+         uses same padding: the zero padding of every feature map is then applied at the border of each patch,
+         not at the border of the slice, and the fully convolutional pass is not used
+        """
+        if self.dense_model is None:
+            if isinstance(self.model, numpy_runtime.NumpyModel):
+                raise ValueError('the fully convolutional model is built with keras, '
+                                 'load the model with the keras runtime')
+            from fully_convolutional import FullyConvolutionalModel
+            self.dense_model = FullyConvolutionalModel(self.model)
+            if not self.dense_model.exact:
+                print('the model uses same padding: the fully convolutional pass would not give the results '
+                      'of the patch based one, the patches are classified one by one')
+        return self.dense_model.exact
+
+    def predict_dense(self, slices):
+        """
+        segments whole slices with the fully convolutional version of the model,
+        instead of extracting and classifying every 33x33 patch.
+        Models with same padding fall back to the patch based prediction (see dense_exact)
+        :param slices: array (n, 4, rows, cols) of normalized slices
+        :return: array (n, rows - 32, cols - 32) of predicted classes
+        """
+        if not self.dense_exact():
+            return np.array([self.predict_patches(np.asarray(imgs, dtype=np.float32)) for imgs in slices])
+        return self.dense_model.predict_classes(slices)
 
-    def save_segmented_image(self, index, test_img, save=False):
+    def save_segmented_image(self, index, test_img, save=False, dense=False, roi=False, coarse=0, margin=8,
+                             writer=None):
         """
         Creates an image of original brain with segmentation overlay
         :param index: index of image to save
         :param test_img: filepath to test image for segmentation, including file extension
         :param save: If true, shows output image. (defaults to False)
+        :param dense: if True uses the fully convolutional inference
+        :param roi: if True classifies only the pixels inside the brain mask
+        :param coarse: if not 0, stride of the coarse pass of the coarse to fine segmentation
+        :param margin: pixels added around the tumor found by the coarse pass
+        :param writer: overlay.OverlayWriter saving the image in background, if None it is saved at once
         :return: if show is True, shows image of segmentation results
                  if show is false, returns segmented image.
         """
 
-        segmentation = self.predict_image(test_img)
+        segmentation = self.predict_image(test_img, dense=dense, roi=roi, coarse=coarse, margin=margin)
 
-        img_mask = np.pad(segmentation, (16, 16), mode='edge')
-        ones = np.argwhere(img_mask == 1)
-        twos = np.argwhere(img_mask == 2)
-        threes = np.argwhere(img_mask == 3)
-        fours = np.argwhere(img_mask == 4)
-
-        test_im = mpimg.imread(test_img).astype('float')
-        test_back = rgb2gray(test_im).reshape(5, 216, 160)[-2]
-        # overlay = mark_boundaries(test_back, img_mask)
-        gray_img = img_as_float(test_back)
-
-        # adjust gamma of image
-        image = adjust_gamma(color.gray2rgb(gray_img), 0.65)
-        sliced_image = image.copy()
-        red_multiplier = [1, 0.2, 0.2]
-        yellow_multiplier = [1, 1, 0.25]
-        green_multiplier = [0.35, 0.75, 0.25]
-        blue_multiplier = [0, 0.25, 0.9]
-
-        # change colors of segmented classes
-        for i in xrange(len(ones)):
-            sliced_image[ones[i][0]][ones[i][1]] = red_multiplier
-        for i in xrange(len(twos)):
-            sliced_image[twos[i][0]][twos[i][1]] = green_multiplier
-        for i in xrange(len(threes)):
-            sliced_image[threes[i][0]][threes[i][1]] = blue_multiplier
-        for i in xrange(len(fours)):
-            sliced_image[fours[i][0]][fours[i][1]] = yellow_multiplier
+        test_back = self._load_strip(test_img)[-2]
+        sliced_image = self.render_segmentation(segmentation, test_back)
 
         if save:
-
-            try:
+            path = './results/result_{}.png'.format(index)
+            if writer is not None:
+                writer.save(path, sliced_image)
+            else:
                 mkdir_p('./results/')
-                io.imsave('./results/result' + '_' + str(index) + '.png', sliced_image)
-            except:
-                io.imsave('./results/result' + '_' + str(index) + '.png', sliced_image)
+                io.imsave(path, sliced_image)
         else:
             return sliced_image
 
+    @staticmethod
+    def render_segmentation(segmentation, test_back):
+        """
+        :param segmentation: array (rows - 32, cols - 32) of predicted classes
+        :param test_back: t2 image (rows, cols) of the slice
+        :return: rgb image of the segmentation over the slice
+        """
+        img_mask = np.pad(segmentation, (16, 16), mode='edge')
+        return render_overlay(img_as_float(test_back), img_mask, TUMOR_COLORS, gamma=0.65)
+
+    def segment_directory(self, tests, roi=False, batch_size=4096, workers=4, writer=None):
+        """
+        segments the test slices classifying the patches of consecutive slices in the same batches,
+        the next slices are decoded by reader threads while the model runs
+        :param tests: filepaths (or loader keys) of the test slices
+        :param roi: if True classifies only the pixels inside the brain mask
+        :param batch_size: number of patches classified together
+        :param workers: number of threads decoding the slices
+        :param writer: overlay.OverlayWriter saving the overlays as save_segmented_image, None to not save them
+        :return: number of slices segmented per second
+        """
+        h, w = self.model.input_shape[2:]
+
+        def load(test_img):
+            strip = self._load_strip(test_img)
+            test_back = strip[-2].copy()
+            imgs = self.normalize_modalities(strip[:-1])
+            inside = None
+            if roi:
+                # the patch with top-left corner (i, j) is centered in (i + h // 2, j + w // 2)
+                mask = self.roi_mask(test_img, imgs)
+                inside = mask[h // 2:h // 2 + mask.shape[0] - h + 1, w // 2:w // 2 + mask.shape[1] - w + 1]
+            return test_back, imgs, inside
+
+        # the index and the background of each slice travel as its key
+        slices = (((index, test_back), imgs, inside)
+                  for index, (_, (test_back, imgs, inside)) in enumerate(read_ahead(load, tests, workers)))
+        start = time.time()
+        count = 0
+        for (index, test_back), segmentation in classify_slices(self.model, slices, batch_size):
+            if writer is not None:
+                writer.save('./results/result_{}.png'.format(index), self.render_segmentation(segmentation, test_back))
+            count += 1
+        elapsed = max(time.time() - start, 1e-12)
+        print('{} slices segmented in {:.1f}s, {:.2f} slices/s'.format(count, elapsed, count / elapsed))
+        return count / elapsed
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Commands to istanciate or load the convolutional neural network')
@@ -441,18 +776,135 @@ if __name__ == '__main__':
                         dest='test',
                         default=False,
                         help='execute test')
+    parser.add_argument('-dense',
+                        action='store_true',
+                        dest='dense',
+                        default=False,
+                        help='segment test images with the fully convolutional model\n'
+                             'instead of classifying each patch (models with same padding\n'
+                             'fall back to the patches)')
+    parser.add_argument('-data',
+                        action='store',
+                        dest='data',
+                        default='Training_PNG',
+                        type=str,
+                        help='folder of the training data, PNG strips or h5 patient volumes,\n'
+                             'default=Training_PNG')
+    parser.add_argument('-test_data',
+                        action='store',
+                        dest='test_data',
+                        default='test_data',
+                        type=str,
+                        help='folder of the test data, PNG strips or h5 patient volumes,\n'
+                             'default=test_data')
+    parser.add_argument('-roi',
+                        action='store_true',
+                        dest='roi',
+                        default=False,
+                        help='classify only the pixels inside the brain mask of each test slice,\n'
+                             'the background is set to class 0')
+    parser.add_argument('-coarse',
+                        action='store',
+                        dest='coarse',
+                        default=0,
+                        type=int,
+                        help='segment test images coarse to fine: a pass on a grid of the given stride finds the tumor,\n'
+                             'the full model runs only around it, default=0 (full segmentation)')
+    parser.add_argument('-margin',
+                        action='store',
+                        dest='margin',
+                        default=8,
+                        type=int,
+                        help='pixels added around the tumor found by the coarse pass, default=8')
+    parser.add_argument('-validate_coarse',
+                        action='store_true',
+                        dest='validate_coarse',
+                        default=False,
+                        help='report speed-up and recall of the coarse to fine segmentation\n'
+                             'against the one of the whole slices on the test data')
+    parser.add_argument('-stream',
+                        action='store',
+                        dest='stream',
+                        default=None,
+                        choices=['store', 'index'],
+                        help='train on class balanced batches streamed from disk instead of loading all patches,\n'
+                             'store: from the patch stores, index: cutting new patches at every batch')
+    parser.add_argument('-runtime',
+                        action='store',
+                        dest='runtime',
+                        default='keras',
+                        choices=['keras', 'numpy'],
+                        help='runtime of the loaded model, numpy predicts without importing keras\n'
+                             '(no training, no -dense), default=keras')
+    parser.add_argument('-batch',
+                        action='store',
+                        dest='batch',
+                        default=0,
+                        type=int,
+                        help='segment the test slices classifying this many patches together, packed from\n'
+                             'consecutive slices decoded by reader threads, default=0 (one slice at a time)')
+    parser.add_argument('-readers',
+                        action='store',
+                        dest='readers',
+                        default=4,
+                        type=int,
+                        help='number of threads decoding the test slices with -batch, default=4')
+    parser.add_argument('-mine',
+                        action='store',
+                        dest='mine',
+                        default=0,
+                        type=int,
+                        help='rounds of hard example mining after the training (or on the loaded model): the model\n'
+                             'classifies the training slices on a grid and the next round samples a fraction of the\n'
+                             'patches among the centers it gets wrong, default=0 (no mining)')
+    parser.add_argument('-mine_stride',
+                        action='store',
+                        dest='mine_stride',
+                        default=4,
+                        type=int,
+                        help='distance in pixels between the grid points of the mining, 1 for every pixel, default=4')
+    parser.add_argument('-hard_fraction',
+                        action='store',
+                        dest='hard_fraction',
+                        default=0.5,
+                        type=float,
+                        help='fraction of the patches of each class drawn from the hard examples, default=0.5')
+    parser.add_argument('-mine_epochs',
+                        action='store',
+                        dest='mine_epochs',
+                        default=5,
+                        type=int,
+                        help='epochs of each mining round, default=5')
     result = parser.parse_args()
+    if result.mine and (result.stream == 'store' or result.runtime != 'keras'):
+        parser.error('-mine trains with the keras runtime, on patches in memory or streamed with -stream index')
+    if result.batch and (result.dense or result.coarse):
+        parser.error('-batch classifies the patches, it can not be used with -dense or -coarse')
 
-    train_data = glob('Training_PNG/**')
+    train_loader = get_slice_loader(result.data)
+    train_data = train_loader.keys()
     print(str(len(train_data)) + ' images loaded')
 
     if type(result.model_to_load) is int:
-        patches = PatchLibrary((33, 33), train_data, result.training_datas, result.angle)
-        X, y = patches.make_training_patches()
+        patches = PatchLibrary((33, 33), train_data, result.training_datas, result.angle, loader=train_loader)
         model = Brain_tumor_segmentation_model(is_hgg=result.hgg)
-        model.fit_model(X, y)
+        if result.stream is not None:
+            model.fit_stream(patches, result.training_datas, source=result.stream, augmentation_angle=result.angle)
+        else:
+            X, y = patches.make_training_patches()
+            model.fit_model(X, y, augmentation_angle=result.angle)
     else:
-        model = Brain_tumor_segmentation_model(loaded_model=True, model_name='./models/' + result.model_to_load)
+        model = Brain_tumor_segmentation_model(loaded_model=True, model_name='./models/' + result.model_to_load,
+                                               runtime=result.runtime)
+
+    if result.mine:
+        if type(result.model_to_load) is not int:
+            patches = PatchLibrary((33, 33), train_data, result.training_datas, result.angle, loader=train_loader)
+        model.fit_hard_examples(patches, result.training_datas, rounds=result.mine, stride=result.mine_stride,
+                                fraction=result.hard_fraction, n_epochs=result.mine_epochs, source=result.stream,
+                                augmentation_angle=result.angle)
+    # the training slices are not read anymore
+    train_loader.close()
 
     if result.save:
         if result.angle is not 0:
@@ -466,7 +918,20 @@ if __name__ == '__main__':
         model.save_model('models/' + name + '_' + str(result.training_datas) + angle + 'result_cnn')
 
     if result.test:
-        tests = glob('test_data/**')
-        segmented_images = []
-        for index, slice_img in enumerate(tests):
-            segmented_images.append(model.save_segmented_image(index, test_img=slice_img, save=True))
+        test_loader = get_slice_loader(result.test_data)
+        if not isinstance(test_loader, PngStripLoader):
+            model.loader = test_loader
+        tests = test_loader.keys()
+        if result.validate_coarse:
+            model.validate_coarse_to_fine(tests, stride=result.coarse or 4, margin=result.margin, dense=result.dense)
+        # overlays are written in background while the next slice is segmented
+        writer = OverlayWriter()
+        if result.batch:
+            model.segment_directory(tests, roi=result.roi, batch_size=result.batch, workers=result.readers,
+                                    writer=writer)
+        else:
+            for index, slice_img in enumerate(tests):
+                model.save_segmented_image(index, test_img=slice_img, save=True, dense=result.dense, roi=result.roi,
+                                           coarse=result.coarse, margin=result.margin, writer=writer)
+        writer.close()
+        test_loader.close()
@@ -0,0 +1,181 @@
+# coding=utf-8
+"""
+
+Conversion of a patch classifier (a Sequential stack of Conv2D, MaxPool2D, Flatten and Dense layers)
+into a fully convolutional network segmenting a whole slice in one forward pass.
+Dense layers become convolutions, while every strided layer is run with stride 1 and
+the following layers are applied to each of its sub-sampled grids (shift-and-stitch),
+so that every patch position of the slice is classified.
+
+"""
+
+from __future__ import print_function
+from keras.models import Model
+from keras.layers import Input, Conv2D, MaxPool2D, Dense, Flatten, Dropout, Activation
+import numpy as np
+
+__author__ = "Cesare Catavitello"
+
+__license__ = "MIT"
+__version__ = "1.0.1"
+__maintainer__ = "Cesare Catavitello"
+__email__ = "cesarec88@gmail.com"
+__status__ = "Production"
+
+
+def _clone(layer, **changes):
+    """
+    creates a new layer of the same kind of layer, applying the given changes to its configuration
+    :param layer: keras layer to copy
+    :param changes: configuration entries to override
+    :return: new layer, not yet built
+    """
+    config = layer.get_config()
+    for key in ('name', 'batch_input_shape', 'input_shape', 'input_dim'):
+        config.pop(key, None)
+    config.update(changes)
+    return layer.__class__.from_config(config)
+
+
+class FullyConvolutionalModel(object):
+    """
+    fully convolutional version of a trained patch classifier, sharing its weights
+    """
+
+    def __init__(self, model):
+        """
+
+        :param model: trained keras Sequential model, with channels_first layers and input (n_chan, h, w)
+        """
+        self.patch_size = tuple(model.input_shape[2:])
+        self.exact = True
+        # each stage is (keras model, stride of the sub-sampling closing it, or None for the last stage)
+        self.stages = []
+        self.receptive_field = 1
+        self._jump = 1
+
+        layers = [layer for layer in model.layers if layer.__class__.__name__ != 'InputLayer']
+        channels = stage_channels = model.input_shape[1]
+        spatial = None
+        channels_last_order = False
+        segment = []
+        for position, layer in enumerate(layers):
+            config = layer.get_config()
+            if isinstance(layer, (Conv2D, MaxPool2D)) and config.get('data_format', 'channels_first') != 'channels_first':
+                raise ValueError('only channels_first models can be converted')
+            if isinstance(layer, Conv2D):
+                strides = tuple(config['strides'])
+                if config['padding'] == 'same':
+                    # zero padding is applied at the border of each patch, not at the border of the slice:
+                    # every feature map touching the border of a patch differs from the one of the slice
+                    self.exact = False
+                    if strides != (1, 1):
+                        raise ValueError('strided convolutions with same padding cannot be converted')
+                segment.append((_clone(layer, strides=(1, 1)), layer.get_weights()))
+                channels = config['filters']
+                self._grow(config['kernel_size'])
+                if strides != (1, 1):
+                    self._close_segment(segment, stage_channels, strides)
+                    stage_channels, segment = channels, []
+            elif isinstance(layer, MaxPool2D):
+                if config['padding'] != 'valid':
+                    raise ValueError('only valid max pooling can be converted')
+                strides = tuple(config['strides'])
+                segment.append((_clone(layer, strides=(1, 1)), []))
+                self._grow(config['pool_size'])
+                if strides != (1, 1):
+                    self._close_segment(segment, stage_channels, strides)
+                    stage_channels, segment = channels, []
+            elif isinstance(layer, Flatten):
+                spatial = tuple(layer.input_shape[2:])
+                channels = layer.input_shape[1]
+                # a channels_first Flatten moves the channels last before flattening, otherwise
+                # (channels_last, or older keras without data_format) the input is flattened as it is
+                channels_last_order = config.get('data_format') == 'channels_first'
+            elif isinstance(layer, Dense):
+                kernel, bias = layer.get_weights()
+                if spatial is not None:
+                    # the flattened input becomes an h x w valid convolution, of kernel (h, w, channels, units)
+                    if channels_last_order:
+                        kernel = kernel.reshape(spatial + (channels, config['units']))
+                    else:
+                        kernel = kernel.reshape((channels,) + spatial + (config['units'],)).transpose(1, 2, 0, 3)
+                    self._grow(spatial)
+                else:
+                    kernel = kernel.reshape(1, 1, -1, config['units'])
+                conv = Conv2D(filters=config['units'],
+                              kernel_size=kernel.shape[:2],
+                              padding='valid',
+                              activation=config['activation'],
+                              data_format='channels_first')
+                segment.append((conv, [kernel, bias]))
+                channels = config['units']
+                spatial = None
+            elif isinstance(layer, Dropout):
+                continue
+            elif isinstance(layer, Activation) and position == len(layers) - 1:
+                # the final softmax does not change the predicted class
+                continue
+            else:
+                segment.append((_clone(layer), layer.get_weights()))
+        self._close_segment(segment, stage_channels, None)
+
+    def _grow(self, kernel_size):
+        self.receptive_field += (max(kernel_size) - 1) * self._jump
+
+    def _close_segment(self, segment, in_channels, stride):
+        """
+        builds the keras model of a stage from the layers collected so far
+        :param segment: list of (layer, weights)
+        :param in_channels: number of channels in input to the stage
+        :param stride: sub-sampling applied after the stage, None for the last one
+        """
+        stage_input = Input(shape=(in_channels, None, None))
+        tensor = stage_input
+        for layer, _ in segment:
+            tensor = layer(tensor)
+        for layer, weights in segment:
+            if weights:
+                layer.set_weights(weights)
+        self.stages.append((Model(inputs=stage_input, outputs=tensor), stride))
+        if stride is not None:
+            self._jump *= max(stride)
+
+    def _run(self, stage_index, features, batch_size):
+        """
+        applies the stage and, recursively, the following ones on each sub-sampled grid of its output
+        :param stage_index: index of the stage to apply
+        :param features: input of the stage (n, channels, rows, cols)
+        :return: predicted classes (n, rows', cols') for every patch position of the input grid
+        """
+        model, stride = self.stages[stage_index]
+        output = model.predict(features, batch_size=batch_size)
+        if stride is None:
+            return output.argmax(axis=1)
+        sy, sx = stride
+        stitched = None
+        for oy in xrange(sy):
+            for ox in xrange(sx):
+                grid = output[:, :, oy::sy, ox::sx]
+                if grid.shape[2] == 0 or grid.shape[3] == 0:
+                    continue
+                classes = self._run(stage_index + 1, np.ascontiguousarray(grid), batch_size)
+                if stitched is None:
+                    # the first grid is the largest one
+                    stitched = np.zeros((classes.shape[0], classes.shape[1] * sy, classes.shape[2] * sx),
+                                        dtype=classes.dtype)
+                stitched[:, oy::sy, ox::sx][:, :classes.shape[1], :classes.shape[2]] = classes
+        return stitched
+
+    def predict_classes(self, slices, batch_size=8):
+        """
+        classifies every patch position of the given slices
+        :param slices: array (n, n_chan, rows, cols) normalized as the training patches
+        :param batch_size: number of slices per forward pass
+        :return: array (n, rows - h + 1, cols - w + 1) of classes, where element (i, j)
+                 is the class of the patch whose top-left corner is (i, j)
+        """
+        rows = slices.shape[2] - self.patch_size[0] + 1
+        cols = slices.shape[3] - self.patch_size[1] + 1
+        classes = self._run(0, np.asarray(slices, dtype='float32'), batch_size)
+        return classes[:, :rows, :cols]
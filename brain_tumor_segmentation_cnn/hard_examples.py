@@ -0,0 +1,121 @@
+# coding=utf-8
+"""
+
+Hard example mining for the patch based models.
+The current model classifies the training slices on a grid of patch centers (every pixel with stride 1),
+the centers it misclassifies or classifies with a low confidence are collected per true class, each one
+weighted by how far the model is from the right answer. The pool of these centers is then mixed into the
+class balanced sampling of PatchLibrary, so that the next training round spends its patches on the
+pixels the model still gets wrong instead of on easy background and healthy tissue.
+
+"""
+
+from __future__ import print_function
+from patch_index import COORDINATE_DTYPE, not_empty_patches
+import numpy as np
+
+__author__ = "Cesare Catavitello"
+
+__license__ = "MIT"
+__version__ = "1.0.1"
+__maintainer__ = "Cesare Catavitello"
+__email__ = "cesarec88@gmail.com"
+__status__ = "Production"
+
+
+def grid_centers(img, patch_size, stride):
+    """
+    centers of the patches fitting in the slice on a grid of the given stride
+    :param img: slice (4, rows, cols)
+    :param patch_size: (h, w) of the patches
+    :param stride: distance in pixels between the grid points
+    :return: array (n, 2) of row and col of the centers and boolean array (n,), False for the patches discarded
+     by the resample rule of the coordinate index for the classes other than 0 (see patch_index.not_empty_patches)
+    """
+    h, w = patch_size
+    # the patch centered in (r, c) has top-left corner (r - h // 2, c - w // 2)
+    not_empty = not_empty_patches(img, h, w)[::stride, ::stride]
+    corners = np.indices(not_empty.shape).reshape(2, -1).T
+    return corners * stride + (h // 2, w // 2), not_empty.ravel()
+
+
+class HardExamplePool(object):
+    """
+    patch centers of each class found hard for the model, sampled with probability proportional to their weight
+    """
+
+    def __init__(self, classes=(0, 1, 2, 3, 4)):
+        self.classes = list(classes)
+        self.coordinates = dict((class_num, np.empty(0, dtype=COORDINATE_DTYPE)) for class_num in self.classes)
+        self.weights = dict((class_num, np.empty(0)) for class_num in self.classes)
+
+    def add(self, class_num, entries, weights):
+        """
+        :param class_num: true class of the centers
+        :param entries: array of COORDINATE_DTYPE, slice ids of the coordinate index of the library
+        :param weights: array of positive weights of the entries
+        """
+        self.coordinates[class_num] = np.concatenate([self.coordinates[class_num], entries])
+        self.weights[class_num] = np.concatenate([self.weights[class_num], weights])
+
+    def count(self, class_num):
+        return len(self.coordinates.get(class_num, ()))
+
+    def sample(self, class_num, num_patches):
+        """
+        draws, with replacement, num_patches centers of class class_num with probability proportional to their weight
+        :param class_num: class to sample from
+        :param num_patches: number of centers to draw
+        :return: array of COORDINATE_DTYPE sorted by slice, so that each slice is decoded once
+        """
+        if self.count(class_num) == 0:
+            raise ValueError('no hard example of class {}'.format(class_num))
+        weights = self.weights[class_num]
+        chosen = np.random.choice(len(weights), num_patches, p=weights / weights.sum())
+        return np.sort(self.coordinates[class_num][chosen], order='slice')
+
+
+def mine_hard_examples(model, library, stride=4, confidence=0.6, batch_size=128):
+    """
+    classifies the slices of the coordinate index of the library on a grid of patch centers and collects
+    the misclassified centers and the ones whose true class has a probability lower than confidence
+    :param model: patch classifier, keras or numpy_runtime, giving the probabilities of the classes
+    :param library: PatchLibrary of the training data, its patches are cut and normalized as for training
+    :param stride: distance in pixels between the grid points, 1 to classify every pixel
+    :param confidence: minimum probability of the true class of a center not to be hard
+    :param batch_size: patches per forward pass
+    :return: HardExamplePool, weights 1 - probability of the true class
+    """
+    pool = HardExamplePool(library.index.classes)
+    visited = dict((class_num, 0) for class_num in pool.classes)
+    wrong = dict((class_num, 0) for class_num in pool.classes)
+    print('mining hard examples on {} slices, grid stride {}'.format(len(library.index.slices), stride))
+    for slice_id, key in enumerate(library.index.slices):
+        label = library.loader.load_label(key)
+        centers, not_empty = grid_centers(library.loader.load_slice(key)[:-1], library.patch_size, stride)
+        truth = label[centers[:, 0], centers[:, 1]].astype(int)
+        # the centers the coordinate index can give: nearly empty patches only for class 0
+        known = np.isin(truth, pool.classes) & (not_empty | (truth == 0))
+        centers, truth = centers[known], truth[known]
+        if len(centers) == 0:
+            continue
+        entries = np.empty(len(centers), dtype=COORDINATE_DTYPE)
+        entries['slice'] = slice_id
+        entries['row'] = centers[:, 0]
+        entries['col'] = centers[:, 1]
+        probabilities = model.predict(library.crop_patches(entries), batch_size=batch_size)
+        true_probability = probabilities[np.arange(len(truth)), truth]
+        misclassified = probabilities.argmax(axis=1) != truth
+        hard = misclassified | (true_probability < confidence)
+        for class_num in pool.classes:
+            of_class = truth == class_num
+            visited[class_num] += np.count_nonzero(of_class)
+            wrong[class_num] += np.count_nonzero(of_class & misclassified)
+            selected = of_class & hard
+            if selected.any():
+                pool.add(class_num, entries[selected], 1. - true_probability[selected])
+    for class_num in pool.classes:
+        print('class {}: {} grid centers, {:.2%} misclassified, {} hard examples'.format(
+            class_num, visited[class_num], wrong[class_num] / float(max(visited[class_num], 1)),
+            pool.count(class_num)))
+    return pool
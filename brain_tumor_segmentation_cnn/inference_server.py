@@ -0,0 +1,443 @@
+# coding=utf-8
+"""
+
+Long-lived local HTTP service keeping named segmentation models loaded.
+Every model is served by its own thread, which groups the slices of concurrent requests
+in micro-batches (up to max_batch slices, waiting at most the latency budget for a batch to fill).
+Requests and responses are .npy payloads:
+POST /segment/model_name   a slice or a volume, labels of the same size are returned
+GET /stats                 latency and throughput counters of each model, as json
+GET /models                names and kinds of the models served
+Can be run from the command line:
+python inference_server.py -model hgg=./models/model_name -edge_model edge=../edge_detector_cnn/models/model_name
+
+"""
+
+from __future__ import print_function
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from httplib import HTTPConnection
+from threading import Thread, Event, Lock
+from Queue import Queue, Empty
+from os.path import abspath, dirname, join
+from io import BytesIO
+import numpy as np
+import argparse
+import json
+import time
+import sys
+
+# the edge detector is a sibling folder, not a package
+sys.path.append(join(dirname(abspath(__file__)), '..', 'edge_detector_cnn'))
+from brain_tumor_segmentation_models import Brain_tumor_segmentation_model
+from edge_detector_cnn import Edge_detector_cnn
+from volume_inference import scale_modalities, classify_positions, segment_volume
+from volume_store import brain_mask
+
+__author__ = "Cesare Catavitello"
+
+__license__ = "MIT"
+__version__ = "1.0.1"
+__maintainer__ = "Cesare Catavitello"
+__email__ = "cesarec88@gmail.com"
+__status__ = "Production"
+
+
+def tumor_segmenter(dense=False, roi=False):
+    """
+    :param dense: if True uses the fully convolutional model
+    :param roi: if True only the pixels inside the brain mask are classified
+    :return: function segmenting slices (n, 4, rows, cols) of raw modalities with a
+     Brain_tumor_segmentation_model, labels (n, rows, cols)
+    """
+
+    def segment(model, slices, batch_size):
+        masks = brain_mask(np.asarray(slices).transpose(1, 0, 2, 3))
+        return segment_volume(model, scale_modalities(slices), masks, batch_size, dense=dense, roi=roi)
+
+    return segment
+
+
+def edge_segmenter(roi=False, dense=False):
+    """
+    :param roi: if True only the pixels where the image is not zero are classified
+    :param dense: if True uses the fully convolutional model
+    :return: function finding the edges of images (n, rows, cols) in the 0-255 range with an
+     Edge_detector_cnn, labels (n, rows, cols)
+    """
+
+    def segment(model, images, batch_size):
+        images = np.asarray(images, dtype=float) / 256
+        h, w = model.model.input_shape[2:]
+        n_images, rows, cols = images.shape
+        labels = np.zeros(images.shape, dtype=np.uint8)
+        for start in xrange(0, n_images, batch_size):
+            batch = images[start:start + batch_size]
+            features = np.array([model.edge_features(img) for img in batch])
+            # the patch with top-left corner (i, j) is centered in (i + h // 2, j + w // 2)
+            inside = (batch != 0)[:, h // 2:h // 2 + rows - h + 1, w // 2:w // 2 + cols - w + 1]
+            if dense:
+                predicted = model.predict_dense(features)
+                if roi:
+                    predicted[~inside] = 0
+            else:
+                if not roi:
+                    inside = np.ones(inside.shape, dtype=bool)
+                predicted = np.zeros(inside.shape, dtype=int)
+                predicted[inside] = classify_positions(model.model, features, np.argwhere(inside))
+            labels[start:start + batch_size, h // 2:h // 2 + rows - h + 1, w // 2:w // 2 + cols - w + 1] = predicted
+        return labels
+
+    return segment
+
+
+def load_tumor_model(model_name, runtime='keras'):
+    return Brain_tumor_segmentation_model(loaded_model=True, model_name=model_name, runtime=runtime)
+
+
+def load_edge_model(model_name, runtime='keras'):
+    return Edge_detector_cnn(loaded_model=True, model_name=model_name, runtime=runtime)
+
+
+class MicroBatcher(object):
+    """
+    serves one model from a dedicated thread, the slices of the requests waiting together
+    are segmented in one batch
+    """
+
+    def __init__(self, name, kind, load, segment, slice_ndim, max_batch=32, latency=0.02):
+        """
+
+        :param name: name of the model in the requests
+        :param kind: 'tumor' or 'edge'
+        :param load: function without arguments returning the model, it is called in the thread of the batcher
+        :param segment: function (model, slices, batch_size) -> labels (n, rows, cols)
+        :param slice_ndim: number of dimensions of one slice, a request holds a slice or a stack of slices
+        :param max_batch: maximum number of slices grouped in a batch, a bigger request is segmented alone
+        :param latency: seconds the first request of a batch waits for others to join
+        """
+        self.name = name
+        self.kind = kind
+        self.slice_ndim = slice_ndim
+        self.max_batch = max_batch
+        self.latency = latency
+        self._load = load
+        self._segment = segment
+        self._queue = Queue()
+        self._ready = Event()
+        self._load_error = None
+        self._lock = Lock()
+        self._started = time.time()
+        self._counters = {'requests': 0, 'slices': 0, 'batches': 0, 'errors': 0,
+                          'busy_seconds': 0., 'total_latency': 0., 'max_latency': 0.}
+        worker = Thread(target=self._serve, name='batcher-' + name)
+        worker.daemon = True
+        worker.start()
+
+    def wait_ready(self):
+        """
+        waits for the model to be loaded, raising the error of the loading if any
+        :return:
+        """
+        self._ready.wait()
+        if self._load_error is not None:
+            raise self._load_error
+
+    def submit(self, slices):
+        """
+        segments a stack of slices, blocking until its batch has been processed
+        :param slices: array (n, ...) of slices
+        :return: array (n, rows, cols) of labels
+        """
+        job = {'slices': slices, 'arrived': time.time(), 'done': Event(), 'labels': None, 'error': None}
+        self._queue.put(job)
+        job['done'].wait()
+        if job['error'] is not None:
+            raise job['error']
+        return job['labels']
+
+    def _serve(self):
+        # the model is loaded and run in this thread only, the backend is never shared between threads
+        try:
+            model = self._load()
+        except Exception as error:
+            self._load_error = error
+            model = None
+        self._ready.set()
+        while True:
+            jobs = [self._queue.get()]
+            size = len(jobs[0]['slices'])
+            deadline = jobs[0]['arrived'] + self.latency
+            while size < self.max_batch:
+                try:
+                    job = self._queue.get(timeout=max(deadline - time.time(), 0))
+                except Empty:
+                    break
+                jobs.append(job)
+                size += len(job['slices'])
+            self._process(model, jobs)
+
+    def _process(self, model, jobs):
+        start = time.time()
+        # slices of different size can not be stacked, each size is segmented in its own batch
+        groups = {}
+        for job in jobs:
+            groups.setdefault(job['slices'].shape[1:], []).append(job)
+        for group in groups.values():
+            try:
+                if model is None:
+                    raise RuntimeError('model {} could not be loaded: {}'.format(self.name, self._load_error))
+                labels = self._segment(model, np.concatenate([job['slices'] for job in group]), self.max_batch)
+                offset = 0
+                for job in group:
+                    job['labels'] = labels[offset:offset + len(job['slices'])]
+                    offset += len(job['slices'])
+            except Exception as error:
+                for job in group:
+                    job['error'] = error
+        done = time.time()
+        with self._lock:
+            counters = self._counters
+            counters['requests'] += len(jobs)
+            counters['slices'] += sum(len(job['slices']) for job in jobs)
+            # each group of slices of the same size is a batch of its own
+            counters['batches'] += len(groups)
+            counters['errors'] += sum(job['error'] is not None for job in jobs)
+            counters['busy_seconds'] += done - start
+            for job in jobs:
+                counters['total_latency'] += done - job['arrived']
+                counters['max_latency'] = max(counters['max_latency'], done - job['arrived'])
+        for job in jobs:
+            job['done'].set()
+
+    def stats(self):
+        """
+        :return: dict of the counters of the batcher, latencies are in milliseconds. slices_per_second is the
+         throughput over the uptime, slices_per_busy_second the speed of the model while it is segmenting
+        """
+        with self._lock:
+            counters = dict(self._counters)
+        uptime = time.time() - self._started
+        return {'kind': self.kind,
+                'requests': counters['requests'],
+                'slices': counters['slices'],
+                'batches': counters['batches'],
+                'errors': counters['errors'],
+                'queued': self._queue.qsize(),
+                'mean_batch_slices': counters['slices'] / float(max(counters['batches'], 1)),
+                'mean_latency_ms': 1000 * counters['total_latency'] / max(counters['requests'], 1),
+                'max_latency_ms': 1000 * counters['max_latency'],
+                'slices_per_second': counters['slices'] / max(uptime, 1e-12),
+                'slices_per_busy_second': counters['slices'] / max(counters['busy_seconds'], 1e-12),
+                'busy_fraction': counters['busy_seconds'] / max(uptime, 1e-12),
+                'uptime_seconds': uptime}
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    """
+    handles the requests of the InferenceServer
+    """
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            stats = dict((name, batcher.stats()) for name, batcher in self.server.batchers.items())
+            self._send(json.dumps(stats), 'application/json')
+        elif self.path == '/models':
+            models = dict((name, batcher.kind) for name, batcher in self.server.batchers.items())
+            self._send(json.dumps(models), 'application/json')
+        else:
+            self.send_error(404, 'unknown path {}'.format(self.path))
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'segment' or parts[1] not in self.server.batchers:
+            self.send_error(404, 'unknown model or path {}'.format(self.path))
+            return
+        batcher = self.server.batchers[parts[1]]
+        try:
+            slices = np.load(BytesIO(self.rfile.read(int(self.headers['Content-Length']))), allow_pickle=False)
+        except (ValueError, IOError, TypeError) as error:
+            self.send_error(400, 'expected a .npy payload: {}'.format(error))
+            return
+        single = slices.ndim == batcher.slice_ndim
+        if single:
+            slices = slices[np.newaxis]
+        if slices.ndim != batcher.slice_ndim + 1:
+            self.send_error(400, '{} expects slices of {} dimensions, got an array of shape {}'.format(
+                batcher.name, batcher.slice_ndim, slices.shape))
+            return
+        try:
+            labels = batcher.submit(slices)
+        except Exception as error:
+            self.send_error(500, str(error))
+            return
+        body = BytesIO()
+        np.save(body, labels[0] if single else labels)
+        self._send(body.getvalue(), 'application/octet-stream')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class InferenceServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server handling each request in its own thread, the requests meet in the batchers of the models
+    """
+    daemon_threads = True
+
+    def __init__(self, address, batchers, verbose=False):
+        """
+
+        :param address: (host, port) to listen on
+        :param batchers: dict name -> MicroBatcher
+        :param verbose: if True every request is logged
+        """
+        HTTPServer.__init__(self, address, InferenceHandler)
+        self.batchers = batchers
+        self.verbose = verbose
+
+
+class InferenceClient(object):
+    """
+    plain client of the InferenceServer
+    """
+
+    def __init__(self, host='localhost', port=8765, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def _request(self, method, path, body=None):
+        connection = HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            connection.request(method, path, body)
+            response = connection.getresponse()
+            data = response.read()
+            if response.status != 200:
+                raise IOError('{} {} failed with {} {}'.format(method, path, response.status, response.reason))
+            return data
+        finally:
+            connection.close()
+
+    def segment(self, model_name, slices):
+        """
+        :param model_name: name of the model on the server
+        :param slices: a slice or a stack of slices, (4, rows, cols) for the tumor models
+         and (rows, cols) in the 0-255 range for the edge models
+        :return: labels (rows, cols), or (n, rows, cols) for a stack
+        """
+        body = BytesIO()
+        np.save(body, np.asarray(slices))
+        return np.load(BytesIO(self._request('POST', '/segment/' + model_name, body.getvalue())))
+
+    def stats(self):
+        return json.loads(self._request('GET', '/stats'))
+
+    def models(self):
+        return json.loads(self._request('GET', '/models'))
+
+
+def named_paths(values):
+    """
+    :param values: strings name=path
+    :return: list of (name, path)
+    """
+    pairs = []
+    for value in values or []:
+        name, sep, path = value.partition('=')
+        if not sep or not name or not path:
+            raise argparse.ArgumentTypeError('expected name=path, got {}'.format(value))
+        pairs.append((name, path))
+    return pairs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local inference server keeping the segmentation models loaded')
+    parser.add_argument('-model',
+                        action='append',
+                        dest='models',
+                        default=[],
+                        type=str,
+                        help='tumor segmentation model to serve, as name=path_to_model_name (repeatable)')
+    parser.add_argument('-edge_model',
+                        action='append',
+                        dest='edge_models',
+                        default=[],
+                        type=str,
+                        help='edge detection model to serve, as name=path_to_model_name (repeatable)')
+    parser.add_argument('-host',
+                        action='store',
+                        dest='host',
+                        default='localhost',
+                        type=str,
+                        help='address to listen on, default=localhost')
+    parser.add_argument('-port',
+                        action='store',
+                        dest='port',
+                        default=8765,
+                        type=int,
+                        help='port to listen on, default=8765')
+    parser.add_argument('-max_batch',
+                        action='store',
+                        dest='max_batch',
+                        default=32,
+                        type=int,
+                        help='maximum number of slices segmented in one batch, default=32')
+    parser.add_argument('-latency',
+                        action='store',
+                        dest='latency',
+                        default=20,
+                        type=float,
+                        help='milliseconds a request waits for others to fill its batch, default=20')
+    parser.add_argument('-dense',
+                        action='store_true',
+                        dest='dense',
+                        default=False,
+                        help='segment with the fully convolutional version of the models')
+    parser.add_argument('-roi',
+                        action='store_true',
+                        dest='roi',
+                        default=False,
+                        help='classify only the pixels inside the brain mask')
+    parser.add_argument('-runtime',
+                        action='store',
+                        dest='runtime',
+                        default='keras',
+                        choices=['keras', 'numpy'],
+                        help='runtime of the models, numpy predicts without importing keras, default=keras')
+    parser.add_argument('-verbose',
+                        action='store_true',
+                        dest='verbose',
+                        default=False,
+                        help='log every request')
+    result = parser.parse_args()
+
+    batchers = {}
+    for name, path in named_paths(result.models):
+        batchers[name] = MicroBatcher(name, 'tumor', lambda path=path: load_tumor_model(path, result.runtime),
+                                      tumor_segmenter(dense=result.dense, roi=result.roi), 3,
+                                      max_batch=result.max_batch, latency=result.latency / 1000.)
+    for name, path in named_paths(result.edge_models):
+        batchers[name] = MicroBatcher(name, 'edge', lambda path=path: load_edge_model(path, result.runtime),
+                                      edge_segmenter(roi=result.roi, dense=result.dense), 2,
+                                      max_batch=result.max_batch, latency=result.latency / 1000.)
+    if not batchers:
+        parser.error('no model to serve, use -model or -edge_model')
+    for batcher in batchers.values():
+        batcher.wait_ready()
+        print('model {} ({}) ready'.format(batcher.name, batcher.kind))
+
+    server = InferenceServer((result.host, result.port), batchers, verbose=result.verbose)
+    print('serving {} on http://{}:{}'.format(', '.join(sorted(batchers)), result.host, result.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
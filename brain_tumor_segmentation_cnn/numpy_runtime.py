@@ -0,0 +1,362 @@
+# coding=utf-8
+"""
+
+Runtime for the trained models written with NumPy only: keras and its backend are never imported.
+The architecture is read from the {name}.json written by save_model and the weights from {name}.hdf5,
+then the layers are run following the keras graph. Convolutions are im2col products computed by BLAS,
+in chunks of images bounding the memory of the unrolled windows.
+Supported layers: InputLayer, Conv2D, MaxPooling2D, Dense, Flatten, Reshape, Concatenate, Activation,
+LeakyReLU, Dropout (identity at prediction time) and models nested in other models.
+The loaded model can only predict, with the predict and predict_classes methods of the keras models.
+
+"""
+
+from __future__ import print_function
+from numpy.lib.stride_tricks import as_strided
+import numpy as np
+import h5py
+import json
+
+__author__ = "Cesare Catavitello"
+
+__license__ = "MIT"
+__version__ = "1.0.1"
+__maintainer__ = "Cesare Catavitello"
+__email__ = "cesarec88@gmail.com"
+__status__ = "Production"
+
+# elements of the unrolled windows of a convolution held in memory at once
+IM2COL_ELEMENTS = 2 ** 24
+
+
+def _as_str(value):
+    return value.decode('utf8') if isinstance(value, bytes) else value
+
+
+def softmax(x):
+    # as keras, the softmax is taken over the last axis, also for the outputs of the convolutions
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {'linear': lambda x: x,
+               'relu': lambda x: np.maximum(x, 0),
+               'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+               'tanh': np.tanh,
+               'softmax': softmax}
+
+
+def activation(name):
+    if name not in ACTIVATIONS:
+        raise ValueError('unsupported activation {}'.format(name))
+    return ACTIVATIONS[name]
+
+
+def _padding(size, kernel, stride, padding):
+    """
+    :return: output size and zeros added before and after the input, as the padding of tensorflow
+    """
+    if padding == 'valid':
+        return (size - kernel) // stride + 1, 0, 0
+    if padding == 'same':
+        output = (size + stride - 1) // stride
+        total = max((output - 1) * stride + kernel - size, 0)
+        return output, total // 2, total - total // 2
+    raise ValueError('unsupported padding {}'.format(padding))
+
+
+def windows(x, kernel_size, strides, padding, fill=0.):
+    """
+    gives the windows of a batch of images, without copying them
+    :param x: array (n, rows, cols, channels)
+    :param kernel_size: (height, width) of the windows
+    :param strides: (vertical, horizontal) step between the windows
+    :param padding: 'valid' or 'same'
+    :param fill: value of the padding
+    :return: view (n, out_rows, out_cols, height, width, channels)
+    """
+    (kh, kw), (sh, sw) = kernel_size, strides
+    rows, top, bottom = _padding(x.shape[1], kh, sh, padding)
+    cols, left, right = _padding(x.shape[2], kw, sw, padding)
+    if top or bottom or left or right:
+        x = np.pad(x, ((0, 0), (top, bottom), (left, right), (0, 0)), mode='constant', constant_values=fill)
+    x = np.ascontiguousarray(x)
+    s = x.strides
+    return as_strided(x, shape=(x.shape[0], rows, cols, kh, kw, x.shape[3]),
+                      strides=(s[0], s[1] * sh, s[2] * sw, s[1], s[2], s[3]))
+
+
+class Layer(object):
+    """
+    layer of the graph, called on the list of its input arrays
+    """
+
+    def __init__(self, config, weights):
+        """
+
+        :param config: configuration of the layer in the json of the model
+        :param weights: list of the weights of the layer, in the order of keras
+        """
+        self.config = config
+        self.weights = weights
+
+    def channels_last(self, x):
+        return x.transpose(0, 2, 3, 1) if self.config.get('data_format') == 'channels_first' else x
+
+    def restore_format(self, x):
+        return x.transpose(0, 3, 1, 2) if self.config.get('data_format') == 'channels_first' else x
+
+
+class Conv2D(Layer):
+    def __init__(self, config, weights):
+        super(Conv2D, self).__init__(config, weights)
+        if tuple(config.get('dilation_rate', (1, 1))) != (1, 1):
+            raise ValueError('dilated convolutions are not supported')
+        self.kernel = weights[0]
+        self.bias = weights[1] if config.get('use_bias', True) else None
+        self.activation = activation(config.get('activation', 'linear'))
+
+    def __call__(self, inputs):
+        kh, kw, channels, filters = self.kernel.shape
+        unrolled = windows(self.channels_last(inputs[0]), (kh, kw), self.config['strides'], self.config['padding'])
+        n, rows, cols = unrolled.shape[:3]
+        kernel = self.kernel.reshape(kh * kw * channels, filters)
+        output = np.empty((n, rows, cols, filters), dtype=np.float32)
+        chunk = max(1, IM2COL_ELEMENTS // max(1, rows * cols * kh * kw * channels))
+        for start in xrange(0, n, chunk):
+            # the reshape of the strided view copies the windows in the im2col matrix
+            columns = unrolled[start:start + chunk].reshape(-1, kh * kw * channels)
+            output[start:start + chunk] = np.dot(columns, kernel).reshape(-1, rows, cols, filters)
+        if self.bias is not None:
+            output += self.bias
+        return self.activation(self.restore_format(output))
+
+
+class MaxPooling2D(Layer):
+    def __call__(self, inputs):
+        pool_size = self.config['pool_size']
+        strides = self.config.get('strides') or pool_size
+        pooled = windows(self.channels_last(inputs[0]), pool_size, strides, self.config['padding'], fill=-np.inf)
+        return self.restore_format(pooled.max(axis=(3, 4)))
+
+
+class Dense(Layer):
+    def __init__(self, config, weights):
+        super(Dense, self).__init__(config, weights)
+        self.kernel = weights[0]
+        self.bias = weights[1] if config.get('use_bias', True) else None
+        self.activation = activation(config.get('activation', 'linear'))
+
+    def __call__(self, inputs):
+        output = np.dot(inputs[0], self.kernel)
+        if self.bias is not None:
+            output += self.bias
+        return self.activation(output)
+
+
+class Flatten(Layer):
+    def __call__(self, inputs):
+        x = inputs[0]
+        if self.config.get('data_format') == 'channels_first' and x.ndim > 2:
+            # keras moves the channels last before flattening
+            x = np.moveaxis(x, 1, -1)
+        return x.reshape(len(x), -1)
+
+
+class Reshape(Layer):
+    def __call__(self, inputs):
+        return inputs[0].reshape((len(inputs[0]),) + tuple(self.config['target_shape']))
+
+
+class Concatenate(Layer):
+    def __call__(self, inputs):
+        return np.concatenate(inputs, axis=self.config.get('axis', -1))
+
+
+class Activation(Layer):
+    def __call__(self, inputs):
+        return activation(self.config['activation'])(inputs[0])
+
+
+class LeakyReLU(Layer):
+    def __call__(self, inputs):
+        alpha = self.config.get('alpha', 0.3)
+        return np.maximum(inputs[0], 0) + alpha * np.minimum(inputs[0], 0)
+
+
+class Dropout(Layer):
+    def __call__(self, inputs):
+        return inputs[0]
+
+
+LAYERS = {'Conv2D': Conv2D,
+          'Convolution2D': Conv2D,
+          'MaxPooling2D': MaxPooling2D,
+          'MaxPool2D': MaxPooling2D,
+          'Dense': Dense,
+          'Flatten': Flatten,
+          'Reshape': Reshape,
+          'Concatenate': Concatenate,
+          'Activation': Activation,
+          'LeakyReLU': LeakyReLU,
+          'Dropout': Dropout}
+
+MODELS = ('Model', 'Sequential')
+
+
+def build_layer(class_name, config, weights):
+    """
+    :param class_name: keras class of the layer
+    :param config: configuration of the layer
+    :param weights: dict layer name -> list of weights of the layer
+    :return: callable from the list of its inputs to its output, or to the list of outputs for a model
+    """
+    if class_name in MODELS:
+        return Graph(class_name, config, weights)
+    if class_name not in LAYERS:
+        raise ValueError('unsupported layer {}'.format(class_name))
+    return LAYERS[class_name](config, weights.get(config['name'], []))
+
+
+class Graph(object):
+    """
+    graph of the layers of a keras model, Sequential or functional
+    """
+
+    def __init__(self, class_name, config, weights):
+        """
+
+        :param class_name: 'Sequential' or 'Model'
+        :param config: configuration of the model in its json
+        :param weights: dict layer name -> list of weights of the layer
+        """
+        self.layers = {}
+        # layer name -> inbound nodes of the layer, each one a list of (layer name, node index, tensor index)
+        self.inbound = {}
+        if class_name == 'Sequential':
+            layers = config['layers'] if isinstance(config, dict) else config
+            first = layers[0]['config']
+            self.input_names = ['input']
+            self.input_shapes = [tuple(first['batch_input_shape'])]
+            previous = 'input'
+            for layer in layers:
+                if layer['class_name'] == 'InputLayer':
+                    continue
+                name = layer['config']['name']
+                self.layers[name] = build_layer(layer['class_name'], layer['config'], weights)
+                self.inbound[name] = [[(previous, 0, 0)]]
+                previous = name
+            self.output_nodes = [(previous, 0, 0)]
+        else:
+            shapes = {}
+            for layer in config['layers']:
+                name = layer['name']
+                if layer['class_name'] == 'InputLayer':
+                    shapes[name] = tuple(layer['config']['batch_input_shape'])
+                    continue
+                self.layers[name] = build_layer(layer['class_name'], layer['config'], weights)
+                self.inbound[name] = [[tuple(tensor[:3]) for tensor in node] for node in layer['inbound_nodes']]
+            self.input_names = [tensor[0] for tensor in config['input_layers']]
+            self.input_shapes = [shapes[name] for name in self.input_names]
+            self.output_nodes = [tuple(tensor) for tensor in config['output_layers']]
+
+    def _evaluate(self, name, node_index, tensors):
+        if (name, node_index) not in tensors:
+            inputs = [self._evaluate(layer, node, tensors)[tensor]
+                      for layer, node, tensor in self.inbound[name][node_index]]
+            output = self.layers[name](inputs)
+            tensors[(name, node_index)] = output if isinstance(output, list) else [output]
+        return tensors[(name, node_index)]
+
+    def __call__(self, inputs):
+        """
+        :param inputs: list of arrays, one for each input of the model
+        :return: list of arrays, one for each output of the model
+        """
+        tensors = dict(((name, 0), [x]) for name, x in zip(self.input_names, inputs))
+        return [self._evaluate(name, node, tensors)[tensor] for name, node, tensor in self.output_nodes]
+
+
+def _nested_models(config):
+    layers = config['layers'] if isinstance(config, dict) else config
+    names = set()
+    for layer in layers:
+        if layer['class_name'] in MODELS:
+            names.add(layer['config']['name'])
+            names.update(_nested_models(layer['config']))
+    return names
+
+
+def load_weights(weights_path, nested_models=()):
+    """
+    reads the weights saved by save_weights
+    :param weights_path: hdf5 file of the weights
+    :param nested_models: names of the models used as layers, their weights are given to their own layers
+    :return: dict layer name -> list of float32 weights of the layer, in the order of keras
+    """
+    weights = {}
+    with h5py.File(weights_path, 'r') as f:
+        group = f['model_weights'] if 'model_weights' in f else f
+        for layer_name in group.attrs['layer_names']:
+            layer_name = _as_str(layer_name)
+            for weight_name in group[layer_name].attrs['weight_names']:
+                weight_name = _as_str(weight_name)
+                owner = layer_name
+                if layer_name in nested_models:
+                    # the names of the weights of a nested model are layer_name/weight_name:0
+                    owner = weight_name.rpartition('/')[0].split('/')[-1]
+                weights.setdefault(owner, []).append(np.asarray(group[layer_name][weight_name], dtype=np.float32))
+    return weights
+
+
+class NumpyModel(object):
+    """
+    trained keras model run with numpy, it exposes the prediction methods of the keras models
+    """
+
+    def __init__(self, architecture, weights):
+        """
+
+        :param architecture: dict of the json of the model
+        :param weights: dict layer name -> list of weights of the layer, as given by load_weights
+        """
+        self.graph = Graph(architecture['class_name'], architecture['config'], weights)
+        shapes = self.graph.input_shapes
+        self.input_shape = shapes[0] if len(shapes) == 1 else shapes
+
+    def predict(self, x, batch_size=32, verbose=0):
+        """
+        :param x: array, or list of arrays for a model with more inputs
+        :param batch_size: samples per forward pass
+        :param verbose: unused, as in keras
+        :return: array, or list of arrays for a model with more outputs
+        """
+        inputs = [np.asarray(inp, dtype=np.float32) for inp in (x if isinstance(x, list) else [x])]
+        starts = range(0, len(inputs[0]), batch_size) or [0]
+        batches = [self.graph([inp[start:start + batch_size] for inp in inputs]) for start in starts]
+        outputs = [np.concatenate(output) for output in zip(*batches)]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def predict_classes(self, x, batch_size=32, verbose=0):
+        """
+        :return: array of the predicted classes of x
+        """
+        proba = self.predict(x, batch_size=batch_size)
+        if proba.shape[-1] > 1:
+            return proba.argmax(axis=-1)
+        return (proba > 0.5).astype('int32')
+
+
+def load_model(model_name):
+    """
+    loads a model saved by save_model
+    :param model_name: filepath to model and weights, not including extension
+    :return: NumpyModel
+    """
+    with open('{}.json'.format(model_name)) as f:
+        architecture = json.loads(f.read())
+    if not isinstance(architecture, dict):
+        # save_model dumps the json string of keras as a json string
+        architecture = json.loads(architecture)
+    weights = load_weights('{}.hdf5'.format(model_name), _nested_models(architecture['config']))
+    return NumpyModel(architecture, weights)
@@ -0,0 +1,142 @@
+# coding=utf-8
+"""
+
+Rendering of the segmentation overlays shared by the models.
+The background slices are turned to rgb and gamma adjusted, then every labelled pixel takes the color
+of its class from a lookup table in a single masked assignment, for one slice or for a whole stack.
+OverlayWriter saves the rendered images from a background thread, so that the next slice can be
+segmented while the previous one is encoded.
+
+"""
+
+from __future__ import print_function
+from skimage.exposure import adjust_gamma
+from skimage.io import imsave
+from threading import Thread
+from Queue import Queue
+from os.path import isdir, dirname
+from os import makedirs
+from errno import EEXIST
+import numpy as np
+
+__author__ = "Cesare Catavitello"
+__license__ = "MIT"
+__version__ = "1.0.1"
+__maintainer__ = "Cesare Catavitello"
+__email__ = "cesarec88@gmail.com"
+__status__ = "Production"
+
+# colors of the classes of the Brats Contest: necrosis, edema, non-enhancing and enhancing tumor
+TUMOR_COLORS = {1: (1, 0.2, 0.2), 2: (0.35, 0.75, 0.25), 3: (0, 0.25, 0.9), 4: (1, 1, 0.25)}
+EDGE_COLORS = {1: (221. / 256, 31. / 256, 100. / 256)}
+
+
+def mkdir_p(path):
+    """
+    mkdir -p function, makes folder recursively if required
+    :param path:
+    :return:
+    """
+    try:
+        makedirs(path)
+    except OSError as exc:  # Python >2.5
+        if exc.errno == EEXIST and isdir(path):
+            pass
+        else:
+            raise
+
+
+def color_table(colors):
+    """
+    :param colors: dict class -> rgb color, the classes missing are left unpainted
+    :return: lookup table (n_classes, 3) of the colors and boolean array (n_classes,) of the painted classes
+    """
+    table = np.zeros((max(colors) + 1, 3))
+    painted = np.zeros(len(table), dtype=bool)
+    for class_num, color in colors.items():
+        table[class_num] = color
+        painted[class_num] = True
+    return table, painted
+
+
+def render_overlays(backgrounds, labels, colors, gamma=0.65, rescale=False):
+    """
+    colors the labels of a stack of slices over their background
+    :param backgrounds: gray images (n, rows, cols)
+    :param labels: classes (n, rows, cols), classes out of colors are not painted
+    :param colors: dict class -> rgb color, as TUMOR_COLORS
+    :param gamma: gamma correction of the background
+    :param rescale: if True the backgrounds brighter than 1 after the gamma are divided by their maximum
+    :return: float rgb images (n, rows, cols, 3)
+    """
+    backgrounds = np.asarray(backgrounds, dtype=float)
+    images = adjust_gamma(np.repeat(backgrounds[..., np.newaxis], 3, axis=-1), gamma)
+    if rescale:
+        maximum = images.max(axis=(1, 2, 3), keepdims=True)
+        images /= np.where(maximum > 1, maximum, 1)
+    table, painted = color_table(colors)
+    labels = np.asarray(labels)
+    mask = (labels >= 0) & (labels < len(table))
+    mask[mask] = painted[labels[mask]]
+    images[mask] = table[labels[mask]]
+    return images
+
+
+def render_overlay(background, labels, colors, gamma=0.65, rescale=False):
+    """
+    colors the labels of one slice over its background, see render_overlays
+    :param background: gray image (rows, cols)
+    :param labels: classes (rows, cols)
+    :return: float rgb image (rows, cols, 3)
+    """
+    return render_overlays(np.asarray(background)[np.newaxis], np.asarray(labels)[np.newaxis], colors, gamma,
+                           rescale)[0]
+
+
+class OverlayWriter(object):
+    """
+    saves images from a background thread, the errors of the writes are raised by close
+    """
+
+    def __init__(self, max_queued=16):
+        """
+
+        :param max_queued: images waiting to be written before save blocks
+        """
+        self._queue = Queue(maxsize=max_queued)
+        self._errors = []
+        self._worker = Thread(target=self._write)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _write(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            path, image = job
+            try:
+                if dirname(path):
+                    mkdir_p(dirname(path))
+                imsave(path, image)
+            except Exception as error:
+                self._errors.append(error)
+
+    def save(self, path, image):
+        """
+        queues an image, it must not be modified afterwards
+        :param path: destination file, its folder is created if missing
+        :param image: image to save
+        :return:
+        """
+        self._queue.put((path, image))
+
+    def close(self):
+        """
+        waits for the queued images to be written
+        :return:
+        """
+        self._queue.put(None)
+        self._worker.join()
+        if self._errors:
+            raise self._errors[0]
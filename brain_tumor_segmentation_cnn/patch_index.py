@@ -0,0 +1,211 @@
+# coding=utf-8
+"""
+
+One-time index of the pixel coordinates usable as patch centers.
+For every class it stores a compact array of (slice id, row, col) entries
+already filtered with the same edge and empty-patch rules used by PatchLibrary,
+so that sampling a patch never has to reject and resample a slice.
+The index is saved on disk and rebuilt when the training or label files change.
+
+"""
+
+from __future__ import print_function
+from os.path import isdir, isfile, join
+from os import makedirs
+from errno import EEXIST
+from volume_store import PngStripLoader
+import numpy as np
+import hashlib
+import json
+
+__author__ = "Cesare Catavitello"
+
+__license__ = "MIT"
+__version__ = "1.0.1"
+__maintainer__ = "Cesare Catavitello"
+__email__ = "cesarec88@gmail.com"
+__status__ = "Production"
+
+COORDINATE_DTYPE = np.dtype([('slice', '<i4'), ('row', '<i2'), ('col', '<i2')])
+
+
+def mkdir_p(path):
+    """
+    mkdir -p function, makes folder recursively if required
+    :type path: basestring
+    :param path:
+    :return:
+    """
+    try:
+        makedirs(path)
+    except OSError as exc:  # Python >2.5
+        if exc.errno == EEXIST and isdir(path):
+            pass
+        else:
+            raise
+
+
+def zeros_per_patch(img, h, w):
+    """
+    counts the zero voxels inside every (4, h, w) window of the image through an integral image
+    :param img: slice of shape (4, rows, cols)
+    :param h: patch height
+    :param w: patch width
+    :return: array of shape (rows - h + 1, cols - w + 1) indexed by the top-left corner of the patch
+    """
+    zeros = (img == 0).sum(axis=0)
+    integral = np.zeros((zeros.shape[0] + 1, zeros.shape[1] + 1), dtype=np.int64)
+    integral[1:, 1:] = zeros.cumsum(axis=0).cumsum(axis=1)
+    return integral[h:, w:] - integral[:-h, w:] - integral[h:, :-w] + integral[:-h, :-w]
+
+
+def not_empty_patches(img, h, w):
+    """
+    resample rule of the patches of the classes other than 0: patches with more than 3/4 of zero voxels are discarded
+    :param img: slice of shape (4, rows, cols)
+    :param h: patch height
+    :param w: patch width
+    :return: boolean array of shape (rows - h + 1, cols - w + 1) indexed by the top-left corner of the patch
+    """
+    return zeros_per_patch(img, h, w) <= 3 * h * w
+
+
+class PatchCoordinateIndex(object):
+    """
+    class indexing, for each class, all the pixels that can be used as the center of a training patch
+    """
+
+    def __init__(self, train_data, patch_size=(33, 33), classes=(0, 1, 2, 3, 4), label_dir='Labels/',
+                 index_dir='patches/index/', min_class_pixels=10, loader=None):
+        """
+
+        :param train_data: list of keys of the training slices (filepaths of the pngs for the default loader).
+         images should have shape (5, 216, 160)
+        :param patch_size: tuple, size (in voxels) of patches to extract
+        :param classes: classes to index
+        :param label_dir: folder containing the labels saved as '{slice name}L.png'
+        :param index_dir: folder where the index is persisted
+        :param min_class_pixels: a slice is indexed for a class only if it has at least this number of pixels of it
+        :param loader: slice loader of volume_store, PngStripLoader over train_data if None
+        """
+        if loader is None:
+            loader = PngStripLoader(train_data, label_dir)
+        self.loader = loader
+        self.train_data = list(train_data)
+        self.patch_size = patch_size
+        self.classes = list(classes)
+        self.label_dir = label_dir
+        self.index_dir = join(index_dir, '{}x{}'.format(patch_size[0], patch_size[1]))
+        self.min_class_pixels = min_class_pixels
+        self.slices = []
+        self.coordinates = {}
+        # fingerprint of the indexed data, also identifying the patches sampled from the index
+        self.signature = self._signature()
+        if not self._load():
+            self._build()
+            self._save()
+
+    def _signature(self):
+        """
+        fingerprint of the indexed files, used to invalidate the index when one of them changes
+        :return: hex digest
+        """
+        digest = hashlib.md5()
+        digest.update(json.dumps([list(self.patch_size), self.classes, self.min_class_pixels]).encode('utf-8'))
+        for key in sorted(self.train_data):
+            digest.update(self.loader.fingerprint(key).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _load(self):
+        """
+        loads the index from index_dir if it is still valid for the current files
+        :return: True if the index has been loaded
+        """
+        meta_path = join(self.index_dir, 'meta.json')
+        if not isfile(meta_path):
+            return False
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['signature'] != self.signature:
+            print('patch index out of date, rebuilding it')
+            return False
+        self.slices = meta['slices']
+        for class_num in self.classes:
+            self.coordinates[class_num] = np.load(join(self.index_dir, 'class_{}.npy'.format(class_num)),
+                                                  mmap_mode='r')
+        print('patch index loaded from {}'.format(self.index_dir))
+        return True
+
+    def _save(self):
+        mkdir_p(self.index_dir)
+        for class_num in self.classes:
+            np.save(join(self.index_dir, 'class_{}.npy'.format(class_num)), self.coordinates[class_num])
+        # meta.json is written last so that an interrupted save is never taken as valid
+        with open(join(self.index_dir, 'meta.json'), 'w') as f:
+            json.dump({'signature': self.signature, 'slices': self.slices}, f)
+
+    def _build(self):
+        """
+        loads every label (and its slice when needed) once and collects the valid centers of each class
+        """
+        h, w = self.patch_size
+        found = dict((class_num, []) for class_num in self.classes)
+        print('Building patch index over {} slices...'.format(len(self.train_data)))
+        for im_path in sorted(self.train_data):
+            try:
+                label = self.loader.load_label(im_path)
+            except:
+                continue
+            rows, cols = label.shape
+            slice_id = len(self.slices)
+            # a patch fits in the slice only if its center is far enough from the edges
+            inner = np.zeros(label.shape, dtype=bool)
+            inner[h // 2:rows - (h - 1) // 2, w // 2:cols - (w - 1) // 2] = True
+            not_empty = None
+            indexed = False
+            for class_num in self.classes:
+                class_mask = label == class_num
+                if class_mask.sum() < self.min_class_pixels:
+                    continue
+                class_mask &= inner
+                if class_num != 0:
+                    # resample rule: patches with more than 3/4 of zero voxels are discarded
+                    if not_empty is None:
+                        img = self.loader.load_slice(im_path)[:-1]
+                        not_empty = np.zeros(label.shape, dtype=bool)
+                        not_empty[h // 2:rows - (h - 1) // 2,
+                                  w // 2:cols - (w - 1) // 2] = not_empty_patches(img, h, w)
+                    class_mask &= not_empty
+                centers = np.argwhere(class_mask)
+                if len(centers) == 0:
+                    continue
+                entries = np.empty(len(centers), dtype=COORDINATE_DTYPE)
+                entries['slice'] = slice_id
+                entries['row'] = centers[:, 0]
+                entries['col'] = centers[:, 1]
+                found[class_num].append(entries)
+                indexed = True
+            if indexed:
+                self.slices.append(im_path)
+        for class_num in self.classes:
+            if found[class_num]:
+                self.coordinates[class_num] = np.concatenate(found[class_num])
+            else:
+                self.coordinates[class_num] = np.empty(0, dtype=COORDINATE_DTYPE)
+            print('class {}: {} candidate centers'.format(class_num, len(self.coordinates[class_num])))
+
+    def count(self, class_num):
+        return len(self.coordinates[class_num])
+
+    def sample(self, class_num, num_patches):
+        """
+        draws uniformly, with replacement, num_patches centers of class class_num
+        :param class_num: class to sample from
+        :param num_patches: number of centers to draw
+        :return: array of COORDINATE_DTYPE sorted by slice, so that each slice is decoded once
+        """
+        entries = self.coordinates[class_num]
+        if len(entries) == 0:
+            raise ValueError('no valid patch center for class {} in the training data'.format(class_num))
+        chosen = np.sort(np.random.randint(0, len(entries), num_patches))
+        return np.array(entries[chosen])
@@ -1,15 +1,9 @@
 # coding=utf-8
 from __future__ import print_function
-from skimage.io import imsave, imread
-from skimage.transform import rotate
-from skimage.color import rgb2gray
-from os.path import isdir
-from os import makedirs
-from os.path import basename
-from glob import glob
-from errno import EEXIST
+from patch_index import PatchCoordinateIndex
+from patch_store import PatchStore
+from volume_store import PngStripLoader
 import numpy as np
-import random
 import progressbar
 
 __author__ = "Cesare Catavitello"
@@ -24,59 +18,22 @@ progress = progressbar.ProgressBar(widgets=[progressbar.Bar('*', '[', ']'), prog
 np.random.seed(5)
 
 
-def mkdir_p(path):
-    """
-    mkdir -p function, makes folder recursively if required
-    :type path: basestring
-    :param path:
-    :return:
-    """
-    try:
-        makedirs(path)
-    except OSError as exc:  # Python >2.5
-        if exc.errno == EEXIST and isdir(path):
-            pass
-        else:
-            raise
-
-
-def rotate_patch(patch, angle):
-    """
-
-    :param patch: patch of size (4, 33, 33)
-    :param angle: says how much rotation must be applied
-    :return: rotate_patch
-    """
-
-    return np.array([rotate(patch[0], angle, resize=False),
-                     rotate(patch[1], angle, resize=False),
-                     rotate(patch[2], angle, resize=False),
-                     rotate(patch[3], angle, resize=False)])
-
-
-def get_right_order(filename):
-    """
-    gives a key_value function for a sorted extraction
-    :param filename:  path to image
-    :return:
-    """
-    last_part = filename.split('/')[len(filename.split('/')) - 1]
-    number_value = last_part[:-4]
-    return int(number_value)
-
-
 class PatchLibrary(object):
     """
     class for creating patches and subpatches from training data to use as input for segmentation models.
     """
 
-    def __init__(self, patch_size=(33, 33), train_data='empty', num_samples=1000, augmentation_angle=0):
+    def __init__(self, patch_size=(33, 33), train_data='empty', num_samples=1000, augmentation_angle=0,
+                 loader=None):
         """
 
         :param patch_size: tuple, size (in voxels) of patches to extract. Use (33,33) for sequential model
-        :param train_data: list of filepaths to all training data saved as pngs. images should have shape (5, 216, 160)
+        :param train_data: list of keys of the training slices (filepaths of the pngs for the default loader).
+         images should have shape (5, 216, 160)
         :param num_samples: the number of patches to collect from training data.
-        :param augmentation_angle: the angle used for flipping patches(producing more datas)
+        :param augmentation_angle: the angle used for rotating patches(producing more datas),
+         rotations are applied while training (see augmentation.py), patches are mined only once
+        :param loader: slice loader of volume_store, PngStripLoader over train_data if None
         """
         if 'empty' in train_data:
             print(" insert a path for path extraction")
@@ -93,6 +50,91 @@ class PatchLibrary(object):
         self.train_data = train_data
         self.h = self.patch_size[0]
         self.w = self.patch_size[1]
+        if loader is None:
+            loader = PngStripLoader(train_data)
+        self.loader = loader
+        self.index = PatchCoordinateIndex(train_data, patch_size=patch_size, loader=loader)
+        # hard_examples.HardExamplePool mixed in the sampling, and the fraction of the patches drawn from it
+        self.hard_pool = None
+        self.hard_fraction = 0.
+
+    def use_hard_examples(self, pool, fraction=0.5):
+        """
+        from now on a fraction of the patches of each class is drawn from the hard examples of the pool
+        :param pool: hard_examples.HardExamplePool mined over the slices of self.index, None to stop using it
+        :param fraction: fraction of the patches of each class drawn from the pool
+        :return:
+        """
+        self.hard_pool = pool
+        self.hard_fraction = fraction
+
+    def hard_count(self, class_num, num_patches):
+        """
+        :return: number of the num_patches patches of class class_num to draw from the hard examples
+        """
+        if self.hard_pool is None or self.hard_pool.count(class_num) == 0:
+            return 0
+        return int(num_patches * self.hard_fraction)
+
+    def sample_centers(self, class_num, num_patches):
+        """
+        draws the centers of num_patches patches of a class, uniformly from the coordinate index
+        and, for the hard fraction, from the hard examples
+        :return: array of COORDINATE_DTYPE sorted by slice
+        """
+        num_hard = self.hard_count(class_num, num_patches)
+        if num_hard == 0:
+            return self.index.sample(class_num, num_patches)
+        centers = np.concatenate([self.index.sample(class_num, num_patches - num_hard),
+                                  self.hard_pool.sample(class_num, num_hard)])
+        return np.sort(centers, order='slice')
+
+    def crop_patches(self, centers):
+        """
+        cuts the patches around the given centers, each modality normalized by its maximum
+        :param centers: array of COORDINATE_DTYPE (see patch_index) sorted by slice
+        :return: float32 array (len(centers), 4, h, w)
+        """
+        h, w = self.patch_size[0], self.patch_size[1]
+        patches = np.empty((len(centers), 4, h, w), dtype=np.float32)
+        img, img_slice = None, None
+        for ct, (slice_id, row, col) in enumerate(zip(centers['slice'], centers['row'], centers['col'])):
+            # centers are sorted by slice, every strip is decoded only once
+            if slice_id != img_slice:
+                img = self.loader.load_slice(self.index.slices[slice_id])[:-1]
+                img_slice = slice_id
+            patch = patches[ct]
+            patch[:] = img[:, row - (h // 2):row + ((h + 1) // 2), col - (w // 2):col + ((w + 1) // 2)]
+            for slice_el in xrange(len(patch)):
+                if np.max(patch[slice_el]) != 0:
+                    patch[slice_el] /= np.max(patch[slice_el])
+        return patches
+
+    def patch_store(self, class_num, num_patches, chunk=10000):
+        """
+        gives the store of the patches of a class, topped up to num_patches
+        :param class_num: class to sample from choice of {0, 1, 2, 3, 4}.
+        :param num_patches: number of patches the store must hold
+        :param chunk: number of patches cut and appended at a time, only a chunk of patches is ever held in memory
+        :return: PatchStore of the class
+        """
+        h, w = self.patch_size[0], self.patch_size[1]
+        # the store is kept only while the coordinate index it is sampled from is the same
+        store = PatchStore('patches/store/{}x{}/class_{}'.format(h, w, class_num), (4, h, w),
+                           source=self.index.signature)
+        # patches already in the store are reused, only the missing ones are extracted
+        start_value_extraction = min(store.count, num_patches)
+        print('*---> {} patches loaded from the store'.format(start_value_extraction))
+        missing = num_patches - start_value_extraction
+        # centers are drawn with replacement, drawing them chunk by chunk gives the same distribution
+        for done in xrange(0, missing, chunk):
+            centers = self.index.sample(class_num, min(chunk, missing - done))
+            patches = self.crop_patches(centers)
+            keys = [self.index.slices[slice_id] for slice_id in centers['slice']]
+            store.append(patches, np.full(len(patches), class_num), keys, centers['row'], centers['col'])
+        if missing > 0:
+            print('*---> {} patches extracted and stored'.format(missing))
+        return store
 
     def find_patches(self, class_num, num_patches):
         """
@@ -101,150 +143,15 @@ class PatchLibrary(object):
         :param num_patches: number of patches to extract
         :return: num_samples patches from class 'class_num' randomly selected.
         """
-        h, w = self.patch_size[0], self.patch_size[1]
-        patches, labels = [], np.full(num_patches * self.augmentation_multiplier, class_num, 'float')
+        labels = np.full(num_patches, class_num, 'float')
         print('Finding patches of class {}...'.format(class_num))
-
-        full = False
-        start_value_extraction = 0
-        if isdir('patches/') and isdir('patches/class_{}/'.format(class_num)):
-
-            # load all patches
-            # check if quantity is enough to work
-            path_to_patches = sorted(glob('./patches/class_{}/**.png'.format(class_num)),
-                                     key=get_right_order)
-
-            for path_index in xrange(len(path_to_patches)):
-                if path_index < num_patches:
-                    patch_to_add = rgb2gray(imread(path_to_patches[path_index],
-                                                   dtype=float)).reshape(4,
-                                                                         self.patch_size[0],
-                                                                         self.patch_size[1])
-
-                    for el in xrange(len(patch_to_add)):
-                        if np.max(patch_to_add[el]) > 1:
-                            patch_to_add[el] = patch_to_add[el] / np.max(patch_to_add[el])
-
-                    patches.append(patch_to_add)
-                    print('*---> patch {} loaded and added '.format(path_index))
-                else:
-                    full = True
-                    break
-
-            if len(path_to_patches) < num_patches:
-                # change start_value_extraction
-                start_value_extraction = len(path_to_patches)
-            else:
-                full = True
-        else:
-            mkdir_p('patches/class_{}'.format(class_num))
-        if not full:
-            ct = start_value_extraction
-            while ct < num_patches:
-                print('searching for patch {}...'.format(ct))
-                im_path = random.choice(self.train_data)
-                fn = basename(im_path)
-                try:
-                    label = np.array(
-                        imread('Labels/' + fn[:-4] + 'L.png'))
-                except:
-                    continue
-                # resample if class_num not in selected slice
-                unique, counts = np.unique(label, return_counts=True)
-                labels_unique = dict(zip(unique, counts))
-                try:
-                    if labels_unique[class_num] < 10:
-                        continue
-                except:
-                    continue
-                # select centerpix (p) and patch (p_ix)
-                img = imread(im_path).reshape(5, 216, 160)[:-1].astype('float')
-                p = random.choice(np.argwhere(label == class_num))
-                p_ix = (p[0] - (h / 2), p[0] + ((h + 1) / 2), p[1] - (w / 2), p[1] + ((w + 1) / 2))
-                patch = np.array([i[p_ix[0]:p_ix[1], p_ix[2]:p_ix[3]] for i in img])
-
-                # resample if patch is empty or too close to edge
-                if patch.shape != (4, h, w) or len(np.argwhere(patch == 0)) > (3 * h * w):
-                    if class_num == 0 and patch.shape == (4, h, w):
-                        pass
-                    else:
-                        continue
-
-                for slice_el in xrange(len(patch)):
-                    if np.max(patch[slice_el]) != 0:
-                        patch[slice_el] /= np.max(patch[slice_el])
-                imsave('./patches/class_{}/{}.png'.format(class_num,
-                                                          ct),
-                       (np.array(patch.reshape((4 * self.patch_size[0], self.patch_size[1])))))
-                patches.append(patch)
-                print('*---> patch {} saved and added'.format(ct))
-                ct += 1
-
-        print()
-
-        for i in xrange(len(patches)):
-            print('*' * 20)
-            print('*' * 20)
-
-            print(patches[i][0].max())
-            print(patches[i][0].min())
-            print('*' * 20)
-            print('*' * 20)
-
-
-        if self.augmentation_angle != 0:
-            print('_*_*_*_ proceed with data augmentation  for class {} _*_*_*_'.format(class_num))
-            print()
-
-            if isdir('./patches/class_{}/rotations'.format(
-                    class_num)):
-                print("rotations folder present ")
-            else:
-                mkdir_p('./patches/class_{}/rotations'.format(
-                    class_num))
-                print("rotations folder created")
-            for el_index in xrange(len(patches)):
-                for j in range(1, self.augmentation_multiplier):
-                    try:
-                        patch_rotated = np.array(rgb2gray(imread('./patches/class_{}/'
-                                                                 'rotations/{}_{}.png'.format(class_num,
-                                                                                              el_index,
-                                                                                              self.augmentation_angle * j)),
-                                                          dtype=float)).reshape(4,
-                                                                                self.patch_size[0],
-                                                                                self.patch_size[1])
-
-                        for slice_el in xrange(len(patch_rotated)):
-                            if np.max(patch_rotated[slice_el]) > 1:
-                                patch_rotated[slice_el] /= np.max(patch_rotated[slice_el])
-
-                        patches.append(patch_rotated)
-                        print('*---> patch {} loaded and added '
-                              'with rotation of {} degrees'.format(el_index,
-                                                                   self.augmentation_angle * j))
-                    except:
-
-                        final_rotated_patch = rotate_patch(np.array(patches[el_index]), self.augmentation_angle * j)
-                        patches.append(final_rotated_patch)
-                        imsave('./patches/class_{}/'
-                               'rotations/{}_{}.png'.format(class_num,
-                                                            el_index,
-                                                            self.augmentation_angle * j),
-                               np.array(final_rotated_patch).reshape(4 * self.patch_size[0], self.patch_size[1]))
-                        print(('*---> patch {} saved and added '
-                               'with rotation of {} degrees '.format(el_index,
-                                                                     self.augmentation_angle * j)))
-            print()
-            print('augmentation done \n')
-
-            # for patch in patches:
-            #     for i in range(1, self.augmentation_multiplier):
-            #         patch_rotate = rotate_patch(patch, self.augmentation_angle * i)
-            #         patches.append(patch_rotate)
-            # print('data augmentation complete')
-            # print()
-
-        return np.array(patches), labels
+        num_hard = self.hard_count(class_num, num_patches)
+        uniform = self.patch_store(class_num, num_patches - num_hard).patches[:num_patches - num_hard]
+        if num_hard == 0:
+            return uniform, labels
+        # the hard examples change with the model, they are cut at every call and never stored
+        print('*---> {} hard examples of class {}'.format(num_hard, class_num))
+        return np.concatenate([uniform, self.crop_patches(self.hard_pool.sample(class_num, num_hard))]), labels
 
     # def slice_to_patches(self, filename):
     #     '''
@@ -282,9 +189,7 @@ class PatchLibrary(object):
                 p, l = self.find_patches(classes[i], per_class)
                 patches.append(p)
                 labels.append(l)
-            return np.array(patches).reshape(self.num_samples * self.augmentation_multiplier, 4, self.h,
-                                             self.w), np.array(labels).reshape(
-                self.num_samples * self.augmentation_multiplier)
+            return np.concatenate(patches), np.concatenate(labels)
 
 
 if __name__ == '__main__':
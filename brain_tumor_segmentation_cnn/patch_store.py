@@ -0,0 +1,157 @@
+# coding=utf-8
+"""
+
+Packed store of the training patches of one class.
+Patches, labels and provenance (slice, row and col of the center) are appended to raw binary files
+and loaded back memory mapped, the number of valid records is kept in meta.json,
+which is rewritten only after the data has been flushed, so that an interrupted append is ignored.
+meta.json also records the source of the patches (e.g. the signature of the coordinate index they were
+sampled from): a store opened for another source is emptied instead of being topped up.
+
+"""
+
+from __future__ import print_function
+from os.path import isdir, isfile, join, getsize
+from os import makedirs, rename
+from errno import EEXIST
+import numpy as np
+import json
+
+__author__ = "Cesare Catavitello"
+
+__license__ = "MIT"
+__version__ = "1.0.1"
+__maintainer__ = "Cesare Catavitello"
+__email__ = "cesarec88@gmail.com"
+__status__ = "Production"
+
+PROVENANCE_DTYPE = np.dtype([('slice', '<i4'), ('row', '<i2'), ('col', '<i2')])
+
+
+def mkdir_p(path):
+    """
+    mkdir -p function, makes folder recursively if required
+    :type path: basestring
+    :param path:
+    :return:
+    """
+    try:
+        makedirs(path)
+    except OSError as exc:  # Python >2.5
+        if exc.errno == EEXIST and isdir(path):
+            pass
+        else:
+            raise
+
+
+class PatchStore(object):
+    """
+    append-only store of patches of shape (n_chan, h, w), with their label and provenance
+    """
+
+    def __init__(self, folder, patch_shape=(4, 33, 33), source=None):
+        """
+
+        :param folder: folder of the store, created if missing
+        :param patch_shape: shape of each patch
+        :param source: string identifying the data the patches come from, None if not known
+        """
+        self.folder = folder
+        self.patch_shape = tuple(patch_shape)
+        self.source = source
+        self.slices = []
+        self.count = 0
+        mkdir_p(folder)
+        self._files = dict((name, join(folder, name + '.raw')) for name in ('patches', 'labels', 'provenance'))
+        self._dtypes = {'patches': np.dtype('<f4'), 'labels': np.dtype('u1'), 'provenance': PROVENANCE_DTYPE}
+        meta_path = join(folder, 'meta.json')
+        if isfile(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if tuple(meta['patch_shape']) != self.patch_shape:
+                raise ValueError('store in {} holds patches of shape {}, not {}'.format(folder, meta['patch_shape'],
+                                                                                    self.patch_shape))
+            if meta.get('source') != source:
+                print('patch store in {} holds patches of another source, emptying it'.format(folder))
+            else:
+                self.count = meta['count']
+                self.slices = meta['slices']
+        # records written on every file, a file shorter than meta.json claims has lost its last records
+        stored = min(getsize(path) // self._record_size(name) if isfile(path) else 0
+                     for name, path in self._files.items())
+        if stored < self.count:
+            print('patch store in {} holds {} whole records, not {}: keeping {}'.format(folder, stored, self.count,
+                                                                                     stored))
+            self.count = stored
+        for name, path in self._files.items():
+            # drops the records of an append interrupted before meta.json was updated, never extends a file
+            with open(path, 'ab') as f:
+                f.truncate(self.count * self._record_size(name))
+        self._save_meta()
+
+    def _record_size(self, name):
+        if name == 'patches':
+            return self._dtypes[name].itemsize * int(np.prod(self.patch_shape))
+        return self._dtypes[name].itemsize
+
+    def append(self, patches, labels, slices, rows, cols):
+        """
+        adds patches at the end of the store
+        :param patches: array (n, n_chan, h, w)
+        :param labels: class of each patch
+        :param slices: key (filepath) of the slice each patch comes from
+        :param rows: row of the center of each patch in its slice
+        :param cols: col of the center of each patch in its slice
+        :return:
+        """
+        patches = np.ascontiguousarray(patches, dtype=self._dtypes['patches'])
+        if patches.shape[1:] != self.patch_shape:
+            raise ValueError('patches of shape {} cannot be stored with {}'.format(patches.shape[1:],
+                                                                                self.patch_shape))
+        provenance = np.empty(len(patches), dtype=PROVENANCE_DTYPE)
+        slice_ids = dict((key, ix) for ix, key in enumerate(self.slices))
+        for ix, key in enumerate(slices):
+            if key not in slice_ids:
+                slice_ids[key] = len(self.slices)
+                self.slices.append(key)
+            provenance['slice'][ix] = slice_ids[key]
+        provenance['row'] = rows
+        provenance['col'] = cols
+        records = {'patches': patches,
+                   'labels': np.asarray(labels, dtype=self._dtypes['labels']),
+                   'provenance': provenance}
+        for name, path in self._files.items():
+            with open(path, 'ab') as f:
+                f.write(records[name].tobytes())
+        self.count += len(patches)
+        self._save_meta()
+
+    def _save_meta(self):
+        meta_path = join(self.folder, 'meta.json')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump({'count': self.count, 'patch_shape': list(self.patch_shape), 'slices': self.slices,
+                       'source': self.source}, f)
+        rename(meta_path + '.tmp', meta_path)
+
+    def _load(self, name, shape):
+        if self.count == 0 or getsize(self._files[name]) == 0:
+            return np.empty((0,) + shape, dtype=self._dtypes[name])
+        return np.memmap(self._files[name], dtype=self._dtypes[name], mode='r', shape=(self.count,) + shape)
+
+    @property
+    def patches(self):
+        """
+        memory mapped array (count, n_chan, h, w)
+        """
+        return self._load('patches', self.patch_shape)
+
+    @property
+    def labels(self):
+        return self._load('labels', ())
+
+    @property
+    def provenance(self):
+        """
+        memory mapped array of PROVENANCE_DTYPE, 'slice' indexes self.slices
+        """
+        return self._load('provenance', ())
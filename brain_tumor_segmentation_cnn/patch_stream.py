@@ -0,0 +1,126 @@
+# coding=utf-8
+"""
+
+Class balanced streaming of training batches, so that the training set is bounded by the disk and not by the memory.
+Patches are drawn either from the packed patch stores (StoreSampler) or cut on the fly around the centers
+of the coordinate index (IndexSampler); shuffling only permutes indices, and batches are prepared
+by a background thread while the model trains on the previous ones.
+
+"""
+
+from __future__ import print_function
+from threading import Thread
+from Queue import Queue
+from augmentation import rotate_batch
+import numpy as np
+
+__author__ = "Cesare Catavitello"
+
+__license__ = "MIT"
+__version__ = "1.0.1"
+__maintainer__ = "Cesare Catavitello"
+__email__ = "cesarec88@gmail.com"
+__status__ = "Production"
+
+
+class StoreSampler(object):
+    """
+    draws the patches of each class from its PatchStore, visiting them in a new random order at every pass
+    """
+
+    def __init__(self, stores, num_patches):
+        """
+
+        :param stores: dict class -> PatchStore
+        :param num_patches: number of patches of each store to use
+        """
+        self.patches = dict((class_num, store.patches[:num_patches]) for class_num, store in stores.items())
+        self._order = {}
+        self._position = {}
+
+    def draw(self, class_num, n):
+        """
+        :param class_num: class of the patches
+        :param n: number of patches
+        :return: array (n, n_chan, h, w)
+        """
+        patches = self.patches[class_num]
+        chosen = []
+        while n > 0:
+            if self._position.get(class_num, len(patches)) >= len(patches):
+                self._order[class_num] = np.random.permutation(len(patches))
+                self._position[class_num] = 0
+            position = self._position[class_num]
+            taken = self._order[class_num][position:position + n]
+            chosen.append(taken)
+            self._position[class_num] = position + len(taken)
+            n -= len(taken)
+        # sorted reads are cheaper on memory mapped patches
+        return patches[np.sort(np.concatenate(chosen))]
+
+
+class IndexSampler(object):
+    """
+    draws new patches of each class at every batch, cutting them around the centers of the coordinate index
+    and of the hard examples of the library, if it uses them
+    """
+
+    def __init__(self, library):
+        """
+
+        :param library: PatchLibrary giving the index and the slices
+        """
+        self.library = library
+
+    def draw(self, class_num, n):
+        return self.library.crop_patches(self.library.sample_centers(class_num, n))
+
+
+def balanced_batches(sampler, classes=(0, 1, 2, 3, 4), batch_size=128, maps=None):
+    """
+    endless stream of batches holding the same number of patches of each class
+    :param sampler: StoreSampler or IndexSampler
+    :param classes: classes to draw
+    :param batch_size: patches per batch, the remainder of the division among the classes is rotated over them
+    :param maps: rotations as given by augmentation.rotation_maps, a random one is applied to each patch
+    :return: generator of (patches (batch_size, n_chan, h, w), categorical labels (batch_size, len(classes)))
+    """
+    classes = list(classes)
+    batch = 0
+    while True:
+        counts = np.full(len(classes), batch_size // len(classes), dtype=int)
+        counts[np.roll(np.arange(len(classes)) < batch_size % len(classes), batch)] += 1
+        x_batch = np.concatenate([sampler.draw(class_num, count) for class_num, count in zip(classes, counts)
+                                  if count > 0])
+        y_batch = np.repeat(np.eye(len(classes), dtype=np.float32), counts, axis=0)
+        if maps is not None and len(maps) > 1:
+            x_batch = rotate_batch(x_batch, np.random.randint(0, len(maps), len(x_batch)), maps)
+        order = np.random.permutation(len(x_batch))
+        yield x_batch[order], y_batch[order]
+        batch += 1
+
+
+def prefetch(batches, size=8):
+    """
+    runs a batch generator in a background thread, keeping up to size batches ready
+    :param batches: generator of batches
+    :param size: number of batches prepared in advance
+    :return: generator of the same batches
+    """
+    queue = Queue(maxsize=size)
+
+    def produce():
+        try:
+            for batch in batches:
+                queue.put((True, batch))
+        except Exception as error:
+            queue.put((False, error))
+
+    worker = Thread(target=produce)
+    worker.daemon = True
+    worker.start()
+    while True:
+        ok, batch = queue.get()
+        if not ok:
+            raise batch
+        yield batch
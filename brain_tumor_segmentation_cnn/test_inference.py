@@ -0,0 +1,299 @@
+# coding=utf-8
+"""
+
+Checks of the inference paths that must give the classes of the patch by patch prediction,
+run on tiny random models and compared with the model called on every patch of the same slices.
+The checks building keras models are skipped when keras is not installed, the one loading the models with
+the numpy runtime, and asserting that keras is never imported, when the other dependencies are missing.
+Run with: python -m unittest test_inference (from this folder)
+
+"""
+
+from __future__ import print_function
+from numpy.lib.stride_tricks import as_strided
+import batch_inference
+import numpy_runtime
+import numpy as np
+import subprocess
+import unittest
+import tempfile
+import shutil
+import h5py
+import json
+import sys
+import os
+
+try:
+    import keras
+except ImportError:
+    keras = None
+
+__author__ = "Cesare Catavitello"
+
+__license__ = "MIT"
+__version__ = "1.0.1"
+__maintainer__ = "Cesare Catavitello"
+__email__ = "cesarec88@gmail.com"
+__status__ = "Production"
+
+
+def all_patches(slices, patch_size):
+    """
+    :param slices: array (n, channels, rows, cols)
+    :param patch_size: (h, w) of the patches
+    :return: array (n * (rows - h + 1) * (cols - w + 1), channels, h, w) of the patches of every slice,
+     ordered by slice and top-left corner, and the shape (n, rows - h + 1, cols - w + 1) of their grid
+    """
+    h, w = patch_size
+    slices = np.ascontiguousarray(slices, dtype=np.float32)
+    n, channels, rows, cols = slices.shape
+    s = slices.strides
+    patches = as_strided(slices, shape=(n, rows - h + 1, cols - w + 1, channels, h, w),
+                         strides=(s[0], s[2], s[3], s[1], s[2], s[3]))
+    return patches.reshape(-1, channels, h, w), (n, rows - h + 1, cols - w + 1)
+
+
+def randomize_weights(model, random):
+    """
+    replaces the weights of a keras model with larger random ones, so that every class is predicted somewhere
+    """
+    for layer in model.layers:
+        layer.set_weights([random.randn(*weight.shape).astype(np.float32) * 0.5 for weight in layer.get_weights()])
+
+
+def tiny_architecture(random, channels=4, patch=9, filters=6, classes=5):
+    """
+    random patch classifier written as the json of a keras Sequential model:
+    3x3 valid convolution, 2x2 max pooling of stride 2, flatten and softmax dense layer
+    :param random: numpy RandomState of the weights
+    :return: dict of the json of the model and dict layer name -> list of weights, as given by load_weights
+    """
+    pooled = (patch - 2) // 2
+    layers = [{'class_name': 'Conv2D',
+               'config': {'name': 'conv', 'batch_input_shape': [None, channels, patch, patch], 'filters': filters,
+                          'kernel_size': [3, 3], 'strides': [1, 1], 'padding': 'valid',
+                          'data_format': 'channels_first', 'activation': 'relu', 'use_bias': True}},
+              {'class_name': 'MaxPooling2D',
+               'config': {'name': 'pool', 'pool_size': [2, 2], 'strides': [2, 2], 'padding': 'valid',
+                          'data_format': 'channels_first'}},
+              {'class_name': 'Flatten', 'config': {'name': 'flatten', 'data_format': 'channels_first'}},
+              {'class_name': 'Dense', 'config': {'name': 'dense', 'units': classes, 'activation': 'softmax',
+                                                 'use_bias': True}}]
+    weights = {'conv': [random.randn(3, 3, channels, filters).astype(np.float32),
+                        random.randn(filters).astype(np.float32) * 0.1],
+               'dense': [random.randn(pooled * pooled * filters, classes).astype(np.float32) * 0.5,
+                         random.randn(classes).astype(np.float32) * 0.1]}
+    architecture = {'class_name': 'Sequential', 'config': {'name': 'tiny', 'layers': layers}}
+    return architecture, weights
+
+
+def tiny_numpy_model(random, **kwargs):
+    """
+    :param random: numpy RandomState of the weights
+    :return: numpy_runtime.NumpyModel of tiny_architecture
+    """
+    return numpy_runtime.NumpyModel(*tiny_architecture(random, **kwargs))
+
+
+def save_tiny_model(model_name, random):
+    """
+    writes tiny_architecture as save_model of the segmentation models does, the weights in the layout of keras
+    :param model_name: filepath to model and weights, not including extension
+    :param random: numpy RandomState of the weights
+    :return:
+    """
+    architecture, weights = tiny_architecture(random)
+    with open('{}.json'.format(model_name), 'w') as f:
+        json.dump(json.dumps(architecture), f)
+    with h5py.File('{}.hdf5'.format(model_name), 'w') as f:
+        f.attrs['layer_names'] = np.array([name.encode('utf8') for name in sorted(weights)])
+        for name in sorted(weights):
+            group = f.create_group(name)
+            weight_names = ['{}/{}:0'.format(name, kind) for kind in ('kernel', 'bias')]
+            group.attrs['weight_names'] = np.array([weight_name.encode('utf8') for weight_name in weight_names])
+            for weight_name, weight in zip(weight_names, weights[name]):
+                group[weight_name] = weight
+
+
+def reference_predict(model, patches):
+    """
+    forward pass of tiny_numpy_model written with explicit loops, independent from the im2col of numpy_runtime
+    :param model: NumpyModel given by tiny_numpy_model
+    :param patches: array (n, channels, h, w)
+    :return: array (n, classes) of probabilities
+    """
+    kernel, bias = model.graph.layers['conv'].weights
+    dense_kernel, dense_bias = model.graph.layers['dense'].weights
+    n, channels, h, w = patches.shape
+    conv = np.empty((n, kernel.shape[3], h - 2, w - 2))
+    for row in xrange(h - 2):
+        for col in xrange(w - 2):
+            window = patches[:, :, row:row + 3, col:col + 3]
+            conv[:, :, row, col] = np.einsum('nkij,ijkf->nf', window, kernel) + bias
+    conv = np.maximum(conv, 0)
+    pooled_rows, pooled_cols = conv.shape[2] // 2, conv.shape[3] // 2
+    pooled = conv[:, :, :pooled_rows * 2, :pooled_cols * 2].reshape(
+        n, -1, pooled_rows, 2, pooled_cols, 2).max(axis=(3, 5))
+    # channels_first flatten: channels last, then in memory order
+    logits = pooled.transpose(0, 2, 3, 1).reshape(n, -1).dot(dense_kernel) + dense_bias
+    exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+class NumpyRuntimeTest(unittest.TestCase):
+    def test_predict_matches_reference(self):
+        random = np.random.RandomState(0)
+        model = tiny_numpy_model(random)
+        patches = random.randn(50, 4, 9, 9).astype(np.float32)
+        expected = reference_predict(model, patches)
+        np.testing.assert_allclose(model.predict(patches, batch_size=16), expected, rtol=1e-4, atol=1e-5)
+        np.testing.assert_array_equal(model.predict_classes(patches), expected.argmax(axis=1))
+
+    @unittest.skipIf(keras is None, 'keras is not installed')
+    def test_saved_models_match_keras(self):
+        from keras.models import Sequential, Model
+        from keras.layers import Input, Conv2D, MaxPooling2D, Flatten, Dense, Dropout, Activation, Reshape, \
+            Concatenate
+        random = np.random.RandomState(1)
+
+        sequential = Sequential()
+        sequential.add(Conv2D(6, (3, 3), padding='same', activation='relu', data_format='channels_first',
+                              input_shape=(4, 9, 9)))
+        sequential.add(MaxPooling2D((2, 2), strides=(2, 2), data_format='channels_first'))
+        sequential.add(Dropout(0.5))
+        sequential.add(Flatten(data_format='channels_first'))
+        sequential.add(Dense(5))
+        sequential.add(Activation('softmax'))
+
+        # two paths as in the two way models, one of them a nested model as in the cascaded ones
+        local_input = Input(shape=(4, 9, 9))
+        local_path = Conv2D(3, (3, 3), activation='relu', data_format='channels_first')(local_input)
+        nested = Model(inputs=local_input, outputs=local_path)
+        large_input = Input(shape=(4, 9, 9))
+        small_input = Input(shape=(4, 7, 7))
+        merged = Concatenate(axis=1)([small_input, nested(large_input)])
+        output = Conv2D(5, (7, 7), data_format='channels_first')(merged)
+        output = Activation('softmax')(Reshape((5,))(output))
+        functional = Model(inputs=[large_input, small_input], outputs=output)
+
+        large = random.randn(40, 4, 9, 9).astype(np.float32)
+        small = random.randn(40, 4, 7, 7).astype(np.float32)
+        folder = tempfile.mkdtemp()
+        try:
+            for name, model, x in (('sequential', sequential, large), ('functional', functional, [large, small])):
+                randomize_weights(model, random)
+                # as save_model of the segmentation models
+                model_name = os.path.join(folder, name)
+                with open('{}.json'.format(model_name), 'w') as f:
+                    json.dump(model.to_json(), f)
+                model.save_weights('{}.hdf5'.format(model_name))
+                expected = model.predict(x)
+                loaded = numpy_runtime.load_model(model_name)
+                np.testing.assert_allclose(loaded.predict(x), expected, rtol=1e-4, atol=1e-5)
+                np.testing.assert_array_equal(loaded.predict_classes(x), expected.argmax(axis=1))
+        finally:
+            shutil.rmtree(folder)
+
+
+class KerasFreeLoadingTest(unittest.TestCase):
+    # run in a new interpreter, keras may already be imported by the other tests
+    script = '\n'.join(['import sys',
+                         "sys.path.append(sys.argv[1])",
+                         'try:',
+                         '    module = __import__(sys.argv[2])',
+                         'except ImportError as error:',
+                         "    sys.exit(1 if 'keras' in str(error) else 2)",
+                         "getattr(module, sys.argv[3])(loaded_model=True, model_name=sys.argv[4], runtime='numpy')",
+                         "sys.exit(1 if 'keras' in sys.modules else 0)"])
+
+    def test_numpy_runtime_does_not_import_keras(self):
+        here = os.path.dirname(os.path.abspath(__file__))
+        edge_folder = os.path.join(here, '..', 'edge_detector_cnn')
+        folder = tempfile.mkdtemp()
+        try:
+            model_name = os.path.join(folder, 'tiny')
+            save_tiny_model(model_name, np.random.RandomState(6))
+            for module, model_class in (('brain_tumor_segmentation_models', 'Brain_tumor_segmentation_model'),
+                                        ('edge_detector_cnn', 'Edge_detector_cnn')):
+                process = subprocess.Popen([sys.executable, '-c', self.script, edge_folder, module, model_class,
+                                            model_name], cwd=here, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                output = process.communicate()[0]
+                if process.returncode == 2:
+                    self.skipTest('the dependencies of {} are not installed'.format(module))
+                self.assertEqual(process.returncode, 0, '{} failed or imported keras:\n{}'.format(module, output))
+        finally:
+            shutil.rmtree(folder)
+
+
+class BatchInferenceTest(unittest.TestCase):
+    def test_classify_slices_matches_patch_prediction(self):
+        random = np.random.RandomState(2)
+        model = tiny_numpy_model(random)
+        sizes = [(20, 24), (15, 15), (9, 30), (18, 12)]
+        features = [random.randn(4, rows, cols).astype(np.float32) for rows, cols in sizes]
+        expected = []
+        for slice_features in features:
+            patches, grid = all_patches(slice_features[np.newaxis], (9, 9))
+            expected.append(model.predict_classes(patches).reshape(grid[1:]))
+        self.assertTrue(len(np.unique(np.concatenate([e.ravel() for e in expected]))) > 1)
+        inside = [None, random.rand(*expected[1].shape) < 0.5, np.zeros(expected[2].shape, dtype=bool),
+                  random.rand(*expected[3].shape) < 0.3]
+        # batches smaller than a slice, spanning slices, and holding the whole stream
+        for batch_size in (7, 100, 10 ** 4):
+            stream = [('slice_{}'.format(i), features[i], inside[i]) for i in xrange(len(features))]
+            results = list(batch_inference.classify_slices(model, stream, batch_size=batch_size))
+            self.assertEqual([key for key, _ in results], [key for key, _, _ in stream])
+            for (_, classes), slice_expected, slice_inside in zip(results, expected, inside):
+                if slice_inside is None:
+                    slice_inside = np.ones(slice_expected.shape, dtype=bool)
+                np.testing.assert_array_equal(classes, np.where(slice_inside, slice_expected, 0))
+
+    def test_read_ahead_keeps_order(self):
+        keys = list(xrange(40))
+        loaded = list(batch_inference.read_ahead(lambda key: key * 2, keys, workers=3, ahead=5))
+        self.assertEqual(loaded, [(key, key * 2) for key in keys])
+
+
+@unittest.skipIf(keras is None, 'keras is not installed')
+class FullyConvolutionalTest(unittest.TestCase):
+    @staticmethod
+    def tiny_model(random, padding='valid', flatten_format='channels_first'):
+        """
+        random patch classifier of 13x13 patches, built as the models of brain_tumor_segmentation_models
+        """
+        from keras.models import Sequential
+        from keras.layers import Conv2D, MaxPool2D, Flatten, Dense, Dropout, Activation
+        model = Sequential()
+        model.add(Conv2D(6, (3, 3), padding=padding, activation='relu', data_format='channels_first',
+                         input_shape=(4, 13, 13)))
+        model.add(MaxPool2D((2, 2), strides=(2, 2), data_format='channels_first'))
+        model.add(Conv2D(5, (3, 3), padding=padding, activation='relu', data_format='channels_first'))
+        model.add(Dropout(0.25))
+        model.add(Flatten(data_format=flatten_format))
+        model.add(Dense(8, activation='relu'))
+        model.add(Dense(5))
+        model.add(Activation('softmax'))
+        randomize_weights(model, random)
+        return model
+
+    def test_dense_prediction_matches_patch_prediction(self):
+        from fully_convolutional import FullyConvolutionalModel
+        random = np.random.RandomState(3)
+        slices = random.randn(2, 4, 30, 27).astype(np.float32)
+        patches, grid = all_patches(slices, (13, 13))
+        for flatten_format in ('channels_first', 'channels_last'):
+            model = self.tiny_model(random, flatten_format=flatten_format)
+            dense_model = FullyConvolutionalModel(model)
+            self.assertTrue(dense_model.exact)
+            expected = model.predict(patches).argmax(axis=1).reshape(grid)
+            self.assertTrue(len(np.unique(expected)) > 1)
+            np.testing.assert_array_equal(dense_model.predict_classes(slices, batch_size=1), expected)
+
+    def test_same_padding_is_not_exact(self):
+        from fully_convolutional import FullyConvolutionalModel
+        model = self.tiny_model(np.random.RandomState(4), padding='same')
+        self.assertFalse(FullyConvolutionalModel(model).exact)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,250 @@
+# coding=utf-8
+"""
+
+Segmentation of whole patient volumes straight from the MHA scans, without the PNG test strips.
+The four modalities are read once through the BrainPipeline of the pre processing (optionally N4 corrected
+and normalized), every slice is scaled as load_test_slice does, slices without brain are skipped
+and the others are classified in batches; the label volume is written with the geometry of the scans.
+Can be run from the command line:
+python volume_inference.py -load model_name -patient patient_folder [-output labels.mha]
+
+"""
+
+from __future__ import print_function
+from os.path import abspath, dirname, join
+from numpy.lib.stride_tricks import as_strided
+import SimpleITK as sitk
+import numpy as np
+import argparse
+import time
+import sys
+
+# the pre processing is a sibling folder, not a package
+sys.path.append(join(dirname(abspath(__file__)), '..', 'pre_processing'))
+from brain_pipeline import BrainPipeline
+from brain_tumor_segmentation_models import Brain_tumor_segmentation_model
+from volume_store import brain_mask
+from overlay import render_overlays, OverlayWriter, TUMOR_COLORS
+
+__author__ = "Cesare Catavitello"
+
+__license__ = "MIT"
+__version__ = "1.0.1"
+__maintainer__ = "Cesare Catavitello"
+__email__ = "cesarec88@gmail.com"
+__status__ = "Production"
+
+
+def scale_modalities(slices):
+    """
+    divides each modality of each slice by its maximum, as load_test_slice does for the test strips
+    :param slices: array (n_slices, 4, rows, cols)
+    :return: float32 array of the same shape
+    """
+    slices = np.array(slices, dtype=np.float32)
+    maximum = slices.max(axis=(-2, -1), keepdims=True)
+    slices /= np.where(maximum == 0, 1, maximum)
+    return slices
+
+
+def classify_positions(model, slices, positions, chunk=4096):
+    """
+    classifies the patches of several slices at once, cut in chunks from a strided view of the batch
+    :param model: keras patch classifier
+    :param slices: array (n_slices, 4, rows, cols)
+    :param positions: array (n, 3) of slice index and top-left corner of the patches to classify
+    :param chunk: number of patches copied and classified at once
+    :return: array (n,) of predicted classes
+    """
+    h, w = model.input_shape[2:]
+    slices = np.ascontiguousarray(slices)
+    n_slices, channels, rows, cols = slices.shape
+    windows = as_strided(slices, shape=(n_slices, rows - h + 1, cols - w + 1, channels, h, w),
+                         strides=slices.strides[:1] + slices.strides[2:] + slices.strides[1:])
+    classes = np.zeros(len(positions), dtype=int)
+    for start in xrange(0, len(positions), chunk):
+        selected = positions[start:start + chunk]
+        classes[start:start + chunk] = model.predict_classes(windows[selected[:, 0], selected[:, 1], selected[:, 2]])
+    return classes
+
+
+def segment_volume(segmentation_model, slices, masks, batch_size=8, dense=False, roi=False):
+    """
+    segments the slices of a volume, the ones without brain are set to class 0 without running the model
+    :param segmentation_model: trained Brain_tumor_segmentation_model
+    :param slices: array (n_slices, 4, rows, cols) scaled by scale_modalities
+    :param masks: boolean brain masks (n_slices, rows, cols)
+    :param batch_size: number of slices classified together
+    :param dense: if True uses the fully convolutional model
+    :param roi: if True only the pixels inside the brain mask are classified
+    :return: array (n_slices, rows, cols) of classes, the border of half a patch where the model
+     can not be applied is class 0
+    """
+    h, w = segmentation_model.model.input_shape[2:]
+    n_slices, _, rows, cols = slices.shape
+    labels = np.zeros((n_slices, rows, cols), dtype=np.uint8)
+    # the patch with top-left corner (i, j) is centered in (i + h // 2, j + w // 2)
+    inside = masks[:, h // 2:h // 2 + rows - h + 1, w // 2:w // 2 + cols - w + 1]
+    brain = np.flatnonzero(inside.any(axis=(1, 2)))
+    print('{} of {} slices hold brain'.format(len(brain), n_slices))
+    for start in xrange(0, len(brain), batch_size):
+        batch = brain[start:start + batch_size]
+        if dense:
+            predicted = segmentation_model.predict_dense(slices[batch])
+            if roi:
+                predicted[~inside[batch]] = 0
+        else:
+            batch_inside = inside[batch] if roi else np.ones((len(batch),) + inside.shape[1:], dtype=bool)
+            positions = np.argwhere(batch_inside)
+            predicted = np.zeros(batch_inside.shape, dtype=int)
+            predicted[batch_inside] = classify_positions(segmentation_model.model, slices[batch], positions)
+        labels[batch, h // 2:h // 2 + rows - h + 1, w // 2:w // 2 + cols - w + 1] = predicted
+    return labels
+
+
+def save_label_volume(labels, reference_scan, output_path):
+    """
+    writes the label volume with origin, spacing and direction of a scan of the patient
+    :param labels: array (n_slices, rows, cols) of classes
+    :param reference_scan: path to a mha scan of the patient, only its header is read
+    :param output_path: path to the mha file to write
+    :return:
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(reference_scan)
+    reader.ReadImageInformation()
+    image = sitk.GetImageFromArray(np.asarray(labels, dtype=np.uint8))
+    image.SetOrigin(reader.GetOrigin())
+    image.SetSpacing(reader.GetSpacing())
+    image.SetDirection(reader.GetDirection())
+    sitk.WriteImage(image, output_path)
+
+
+def save_overlays(slices, labels, folder, batch_size=8):
+    """
+    renders the labels of the slices holding tumor over their t2 image, in batches, and saves them
+    from a background thread as folder/slice-num.png
+    :param slices: array (n_slices, 4, rows, cols) scaled by scale_modalities
+    :param labels: array (n_slices, rows, cols) of classes
+    :param folder: destination folder
+    :param batch_size: number of slices rendered together
+    :return:
+    """
+    tumor = np.flatnonzero(labels.any(axis=(1, 2)))
+    writer = OverlayWriter()
+    for start in xrange(0, len(tumor), batch_size):
+        batch = tumor[start:start + batch_size]
+        # the t2 image is the background of the overlays of save_segmented_image
+        images = render_overlays(np.clip(slices[batch, -1], 0, 1), labels[batch], TUMOR_COLORS, gamma=0.65)
+        for slice_ix, image in zip(batch, images):
+            writer.save(join(folder, '{}.png'.format(slice_ix)), image)
+    writer.close()
+
+
+def segment_patient(segmentation_model, patient_path, output_path, normalized=False, n4itk=False, batch_size=8,
+                    dense=False, roi=False, overlay_folder=None):
+    """
+    segments the volume of a patient and writes its labels
+    :param segmentation_model: trained Brain_tumor_segmentation_model
+    :param patient_path: folder of the patient with the flair, t1, t1c and t2 mha scans, gt is not needed
+    :param output_path: path to the mha file of the labels
+    :param normalized: if True uses the normalized slices of the pipeline, as the Norm_PNG strips
+    :param n4itk: True to use the n4itk corrected t1 scans
+    :param batch_size: number of slices classified together
+    :param dense: if True uses the fully convolutional model
+    :param roi: if True only the pixels inside the brain mask are classified
+    :param overlay_folder: if given, the overlays of the slices holding tumor are saved in it
+    :return: array (n_slices, rows, cols) of classes
+    """
+    start = time.time()
+    pipeline = BrainPipeline(patient_path, n4itk=n4itk)
+    slices = pipeline.normed_slices if normalized else pipeline.slices_by_slice
+    slices = scale_modalities(slices[:, :-1])
+    masks = brain_mask(pipeline.slices_by_mode[:-1])
+    loaded = time.time()
+    labels = segment_volume(segmentation_model, slices, masks, batch_size, dense=dense, roi=roi)
+    save_label_volume(labels, pipeline.reference_scan, output_path)
+    if overlay_folder is not None:
+        save_overlays(slices, labels, overlay_folder, batch_size)
+    print('{} segmented in {:.1f}s ({:.1f}s reading the scans), labels saved in {}'.format(
+        patient_path, time.time() - start, loaded - start, output_path))
+    return labels
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Segment whole patient volumes from their mha scans')
+    parser.add_argument('-load',
+                        '-l',
+                        action='store',
+                        dest='model_to_load',
+                        required=True,
+                        type=str,
+                        help='trained model to use, model name as:\n'
+                             'model_name')
+    parser.add_argument('-patient',
+                        '-p',
+                        action='store',
+                        dest='patients',
+                        nargs='+',
+                        required=True,
+                        type=str,
+                        help='folders of the patients to segment')
+    parser.add_argument('-output',
+                        '-o',
+                        action='store',
+                        dest='output',
+                        default=None,
+                        type=str,
+                        help='label volume to write, with more than one patient the folder name is added,\n'
+                             'default=patient_folder/segmentation.mha')
+    parser.add_argument('-normalized',
+                        action='store_true',
+                        dest='normalized',
+                        default=False,
+                        help='use the normalized slices, for models trained on the Norm_PNG strips')
+    parser.add_argument('-n4',
+                        action='store_true',
+                        dest='n4itk',
+                        default=False,
+                        help='use the n4itk corrected t1 scans')
+    parser.add_argument('-batch',
+                        action='store',
+                        dest='batch_size',
+                        default=8,
+                        type=int,
+                        help='number of slices classified together, default=8')
+    parser.add_argument('-dense',
+                        action='store_true',
+                        dest='dense',
+                        default=False,
+                        help='segment with the fully convolutional model')
+    parser.add_argument('-roi',
+                        action='store_true',
+                        dest='roi',
+                        default=False,
+                        help='classify only the pixels inside the brain mask')
+    parser.add_argument('-overlays',
+                        action='store_true',
+                        dest='overlays',
+                        default=False,
+                        help='save the overlays of the slices holding tumor next to the label volume')
+    parser.add_argument('-runtime',
+                        action='store',
+                        dest='runtime',
+                        default='keras',
+                        choices=['keras', 'numpy'],
+                        help='runtime of the model, numpy predicts without importing keras, default=keras')
+    result = parser.parse_args()
+
+    model = Brain_tumor_segmentation_model(loaded_model=True, model_name='./models/' + result.model_to_load,
+                                           runtime=result.runtime)
+    for patient in result.patients:
+        if result.output is None:
+            output = join(patient, 'segmentation.mha')
+        elif len(result.patients) > 1:
+            output = result.output[:-4] + '_' + patient.rstrip('/').split('/')[-1] + '.mha'
+        else:
+            output = result.output
+        segment_patient(model, patient, output, normalized=result.normalized, n4itk=result.n4itk,
+                        batch_size=result.batch_size, dense=result.dense, roi=result.roi,
+                        overlay_folder=output[:-4] + '_overlays' if result.overlays else None)
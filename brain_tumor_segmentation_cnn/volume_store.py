@@ -0,0 +1,255 @@
+"""
+
+Per-patient volume store, alternative to the 1080x160 PNG strips.
+Each patient is saved as one h5py file holding a (slices, 5, height, width) float32 array
+(flair, t1, t1c, t2, gt), chunked by slice and compressed, or contiguous and memory mapped when
+saved without compression.
+Readers access slices through a loader: PngStripLoader for the PNG strips and VolumeStore
+for the h5 files expose the same keys/load_slice/load_label/load_mask/close interface, get_slice_loader
+chooses the right one for a data folder. The loaders are also context managers closing them.
+
+"""
+
+from __future__ import print_function
+from skimage.io import imread
+from skimage.color import rgb2gray
+from os.path import isdir, join, basename, getmtime, getsize
+from os import makedirs
+from errno import EEXIST
+from glob import glob
+import numpy as np
+import h5py
+
+__author__ = "Cesare Catavitello"
+__license__ = "MIT"
+__version__ = "1.0.1"
+__maintainer__ = "Cesare Catavitello"
+__email__ = "cesarec88@gmail.com"
+__status__ = "Production"
+
+
+def mkdir_p(path):
+    """
+    mkdir -p function, makes folder recursively if required
+    :param path:
+    :return:
+    """
+    try:
+        makedirs(path)
+    except OSError as exc:  # Python >2.5
+        if exc.errno == EEXIST and isdir(path):
+            pass
+        else:
+            raise
+
+
+def brain_mask(images):
+    """
+    mask of the brain in a slice, the pixels where at least one modality is not zero
+    :param images: array (modalities, height, width)
+    :return: boolean array (height, width)
+    """
+    return np.any(np.asarray(images) != 0, axis=0)
+
+
+def save_patient_volume(path, slices, compression='gzip', mask=None):
+    """
+    saves the slices of one patient in a h5 file
+    :param path: destination file, by convention folder/patient-num.h5
+    :param slices: array (slices, 5, height, width), the last image of each slice is the ground truth
+    :param compression: h5py compression filter, chunks of one slice are used.
+     None saves a contiguous dataset that readers memory map
+    :param mask: optional brain mask of each slice, boolean array (slices, height, width)
+    :return:
+    """
+    slices = np.ascontiguousarray(slices, dtype=np.float32)
+    with h5py.File(path, 'w') as f:
+        if compression is None:
+            f.create_dataset('slices', data=slices)
+        else:
+            f.create_dataset('slices', data=slices, chunks=(1,) + slices.shape[1:], compression=compression)
+        if mask is not None:
+            mask = np.asarray(mask, dtype=np.uint8)
+            f.create_dataset('mask', data=mask, chunks=(1,) + mask.shape[1:], compression='gzip')
+
+
+class PngStripLoader(object):
+    """
+    loader of the slices saved as PNG strips, keys are the paths of the strips
+    """
+
+    def __init__(self, paths, label_dir='Labels/'):
+        """
+
+        :param paths: paths to the strips, patient-num_slice-num.png
+        :param label_dir: folder containing the labels saved as patient-num_slice-numL.png
+        """
+        self.paths = list(paths)
+        self.label_dir = label_dir
+
+    def keys(self):
+        return list(self.paths)
+
+    def label_path(self, key):
+        return join(self.label_dir, basename(key)[:-4] + 'L.png')
+
+    def load_slice(self, key):
+        """
+        :param key: path to the strip
+        :return: array (5, height, width) with the values of the 8 bit strip (0-255)
+        """
+        img = imread(key)
+        if img.ndim == 3:
+            img = rgb2gray(img) * 255
+        img = img.astype('float')
+        return img.reshape(5, img.shape[0] // 5, img.shape[1])
+
+    def load_label(self, key):
+        return np.array(imread(self.label_path(key)))
+
+    def load_mask(self, key):
+        """
+        :return: None, the strips carry no brain mask
+        """
+        return None
+
+    def close(self):
+        """
+        nothing to release, the strips are read by path
+        """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def fingerprint(self, key):
+        """
+        :return: string changing when the strip or its label change
+        """
+        parts = []
+        for path in (key, self.label_path(key)):
+            try:
+                parts.append('{}:{}:{}'.format(path, getsize(path), getmtime(path)))
+            except OSError:
+                parts.append('{}:missing'.format(path))
+        return ' '.join(parts)
+
+
+class VolumeStore(object):
+    """
+    loader of the patient volumes saved by save_patient_volume, keys are 'path.h5:slice-num'
+    """
+
+    def __init__(self, folder=None):
+        """
+
+        :param folder: folder containing the h5 files of the patients, keys of any
+         h5 file can be loaded when None
+        """
+        self.paths = sorted(glob(join(folder, '*.h5'))) if folder is not None else []
+        # open h5 files and slices of the patients, by path
+        self._files = {}
+        self._volumes = {}
+
+    def _file(self, path):
+        """
+        :param path: path to the h5 file of a patient
+        :return: the h5py file, opened once and kept open until close
+        """
+        if path not in self._files:
+            self._files[path] = h5py.File(path, 'r')
+        return self._files[path]
+
+    def _volume(self, path):
+        """
+        opens (once) the slices of a patient, memory mapped when the dataset is contiguous
+        :param path: path to the h5 file
+        :return: array-like (slices, 5, height, width)
+        """
+        if path not in self._volumes:
+            dataset = self._file(path)['slices']
+            offset = dataset.id.get_offset()
+            if dataset.chunks is None and dataset.compression is None and offset is not None:
+                self._volumes[path] = np.memmap(path, dtype=dataset.dtype, mode='r', offset=offset,
+                                                shape=dataset.shape)
+            else:
+                self._volumes[path] = dataset
+        return self._volumes[path]
+
+    def close(self):
+        """
+        closes the h5 files opened so far, they are opened again if the store is used afterwards
+        """
+        self._volumes = {}
+        files, self._files = self._files, {}
+        for f in files.values():
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _split(key):
+        path, slice_ix = key.rsplit(':', 1)
+        return path, int(slice_ix)
+
+    def keys(self):
+        keys = []
+        for path in self.paths:
+            keys.extend('{}:{}'.format(path, slice_ix) for slice_ix in range(len(self._volume(path))))
+        return keys
+
+    def load_slice(self, key):
+        """
+        :param key: 'path.h5:slice-num'
+        :return: array (5, height, width) scaled as the 8 bit strip would be (maximum at 255)
+        """
+        path, slice_ix = self._split(key)
+        img = np.array(self._volume(path)[slice_ix], dtype='float')
+        if np.max(img) != 0:
+            img *= 255. / np.max(img)
+        return img
+
+    def load_label(self, key):
+        path, slice_ix = self._split(key)
+        return np.array(self._volume(path)[slice_ix, -1]).astype(np.uint8)
+
+    def load_mask(self, key):
+        """
+        :param key: 'path.h5:slice-num'
+        :return: boolean brain mask (height, width) saved with the volume, None if it has not been saved
+        """
+        path, slice_ix = self._split(key)
+        f = self._file(path)
+        if 'mask' not in f:
+            return None
+        return np.array(f['mask'][slice_ix]).astype(bool)
+
+    def fingerprint(self, key):
+        path, slice_ix = self._split(key)
+        return '{}:{}:{}'.format(key, getsize(path), getmtime(path))
+
+
+def is_volume_key(key):
+    """
+    :param key: key of a slice
+    :return: True if key refers to a slice of a h5 volume ('path.h5:slice-num')
+    """
+    return '.h5:' in key
+
+
+def get_slice_loader(source, label_dir='Labels/'):
+    """
+    gives the loader for a data folder, VolumeStore if it holds h5 volumes, PngStripLoader otherwise
+    :param source: folder of the training or test data
+    :param label_dir: folder of the labels of the PNG strips
+    :return: loader
+    """
+    if glob(join(source, '*.h5')):
+        return VolumeStore(source)
+    return PngStripLoader(sorted(glob(join(source, '*.png'))), label_dir)
@@ -9,28 +9,32 @@ The patch extraction is made using the canny filter for edge detection.
 """
 
 from __future__ import print_function
-from keras.models import Sequential, model_from_json
-from keras.layers import Conv2D, Dense, Flatten, Activation
-from keras.initializers import glorot_normal
-from keras.optimizers import SGD
-from keras.utils.np_utils import to_categorical
 from sklearn.feature_extraction.image import extract_patches_2d
-from sklearn.preprocessing import normalize
-from skimage.exposure import adjust_sigmoid
-from skimage.filters import laplace
-from skimage.color import rgb2gray, gray2rgb
-from skimage.exposure import adjust_gamma
+from skimage.color import rgb2gray
 from skimage.io import imread, imsave
 from skimage.feature import canny as canny_filter
-from skimage import img_as_float, img_as_ubyte
-from glob import glob
+from skimage import img_as_float
+from os.path import abspath, dirname, join
+import sys
+
+# the shared modules are in the brain tumor segmentation folder, a sibling folder, not a package
+sys.path.append(join(dirname(abspath(__file__)), '..', 'brain_tumor_segmentation_cnn'))
+from volume_store import get_slice_loader, PngStripLoader, brain_mask
+from overlay import render_overlay, OverlayWriter, EDGE_COLORS
+from batch_inference import read_ahead, classify_slices
 from errno import EEXIST
 from os import makedirs
 from os.path import isdir
 import patch_extractor_edges
+import numpy_runtime
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import argparse
 import json
+import time
+
+# keras is imported only by the methods building, training or loading a keras model,
+# a model loaded with the numpy runtime predicts without importing it
 
 __author__ = "Cesare Catavitello"
 
@@ -58,8 +62,14 @@ def mkdir_p(path):
 
 # noinspection PyTypeChecker
 class Edge_detector_cnn( object ):
-    def __init__(self, loaded_model=False, model_name=None):
+    def __init__(self, loaded_model=False, model_name=None, runtime='keras'):
         self.loaded_model = loaded_model
+        # slice loader of volume_store for the test data, None reads the test PNGs directly
+        self.loader = None
+        # pixels evaluated and skipped by the last roi prediction
+        self.roi_counts = None
+        # fully convolutional version of the model, built at the first dense prediction
+        self.dense_model = None
         if not self.loaded_model:
             self.model = None
             self._make_model()
@@ -69,9 +79,12 @@ class Edge_detector_cnn( object ):
                 model_to_load = str( raw_input( 'Which model should I load? ' ) )
             else:
                 model_to_load = model_name
-            self.model = self.load_model_weights( model_to_load )
+            self.model = self.load_model_weights( model_to_load, runtime )
 
     def _make_model(self):
+        from keras.models import Sequential
+        from keras.layers import Conv2D, Dense, Flatten, Activation
+        from keras.initializers import glorot_normal
         step = 0
         print( '******************************************', step )
         step += 1
@@ -124,6 +137,7 @@ class Edge_detector_cnn( object ):
         :param y_train: list of labels corresponding to X_train patches in form (n_sample,)
         :return: Fits specified model
         """
+        from keras.utils.np_utils import to_categorical
 
         Y_train = to_categorical( y_train, 2 )
 
@@ -135,8 +149,10 @@ class Edge_detector_cnn( object ):
 
         n_epochs = 20
         self.model.fit( X_train, Y_train, epochs=n_epochs, batch_size=128, verbose=1 )
+        self.dense_model = None
 
     def _compile_model(self):
+        from keras.optimizers import SGD
         # default decay = 1e-6, lr = 0.01 maybe 1e-2 for linear decay?
         sgd = SGD( lr=3e-3,
                    decay=0,
@@ -148,7 +164,8 @@ class Edge_detector_cnn( object ):
                             loss='categorical_crossentropy',
                             metrics=['accuracy'] )
 
-    def show_segmented_image(self, index, test_img, both, canny_use=False, save=False):
+    def show_segmented_image(self, index, test_img, both, canny_use=False, save=False, roi=False, writer=None,
+                             dense=False):
         """
         Creates an image of original brain with segmentation overlay
         :param both: weather or not to use the canny filter plus segmented image,
@@ -156,109 +173,121 @@ class Edge_detector_cnn( object ):
         :param canny_use: weather or not to use the canny filter plus segmented image
         :param test_img: file path to test image for segmentation, including file extension
         :param save: If true, shows output image. (defaults to False)
+        :param roi: if True classifies only the pixels inside the brain mask
+        :param writer: overlay.OverlayWriter saving the images in background, if None they are saved at once
+        :param dense: if True uses the fully convolutional inference
         :return: if save is True, save image of segmentation results
                  if save is False, returns segmented image.
         """
 
-        segmentation = self.predict_image( test_img )
-
-        img_mask = np.pad( segmentation, (11, 11), mode='edge' )
-        print()
-        # print('+' * 40)
-        # print('+', 'mask shape', img_mask.shape, '+')
-        # print('+', 'mask max: {}, mask min: {}'.format(img_mask.max(), img_mask.min()), '+')
-        # print('+' * 40)
-        # print()
-
-        test_back = rgb2gray( imread( test_img ).astype( 'float' ) ).reshape( 5, 216, 160 )[-2]
-
-        edges = np.argwhere( img_mask == 1 )
-        # test_back = rgb2gray(np.ones((216, 160)))
-        gray_img = img_as_float( test_back )
-
-        # adjust gamma of image
-        image = adjust_gamma( gray2rgb( gray_img ), 0.8 )
-        sliced_image = image.copy()
-
-        if sliced_image.max() > 1:
-            sliced_image /= sliced_image.max()
-
-        print( '\n', 'image size : {}'.format( sliced_image.shape ) )
-        color = [221. / 256, 31. / 256, 100. / 256]  # blue as choice
-
-        print( sliced_image.shape )
-
-        # change colors of segmented class
-        for i in xrange( len( edges ) ):
-            try:
-                sliced_image[edges[i][0]][edges[i][1]] = color
-
-            except:
-
-                print( '=' * 50 )
-
-                print( edges.max() )
-
-                print( '=' * 50 )
+        segmentation = self.predict_image( test_img, roi=roi, dense=dense )
 
-                print( edges.shape )
+        test_back = self._load_slice( test_img )
 
-                print( '=' * 50 )
+        return self._show_segmentation( index, segmentation, test_back, both, canny_use, save, writer )
 
-                print( edges[i][0], edges[i][1] )
-                print( sliced_image.shape )
+    def _show_segmentation(self, index, segmentation, test_back, both, canny_use, save, writer):
+        img_mask = np.pad( segmentation, (11, 11), mode='edge' )
 
-                exit( 0 )
+        # adjust gamma of image and change colors of segmented class
+        sliced_image = render_overlay( img_as_float( test_back ), img_mask, EDGE_COLORS, gamma=0.8, rescale=True )
 
         canny_name = ''
 
         if both:
-            path = './results_edge{}/'.format( canny_name )
-            try:
-                mkdir_p( path )
-                imsave( '{}result_edge_{}{}.png'.format( path, canny_name, index ), sliced_image )
-            except:
-                imsave( '{}result_edge_{}{}.png'.format( path, canny_name, index ), sliced_image )
-                # plt.show()
+            self._save_result( sliced_image, canny_name, index, writer )
             canny_use = True
 
         if save:
 
             if canny_use:
-                print( '*' * 40 )
                 print( 'applying canny filter to image ' )
                 canny_name = '_canny_added'
-                # canny filter to the image
-                canny_test_back_mask = canny_filter( test_back )
-                edgess_canny = np.argwhere( canny_test_back_mask == 1 )
-                for i in xrange( len( edgess_canny ) ):
-                    sliced_image[edgess_canny[i][0]][edgess_canny[i][1]] = color
-            path = './results_edge{}/'.format( canny_name )
-            try:
-                mkdir_p( path )
-                imsave( '{}result_edge_{}{}.png'.format( path, canny_name, index ), sliced_image )
-            except:
-                imsave( '{}result_edge_{}{}.png'.format( path, canny_name, index ), sliced_image )
+                # canny filter to the image, painted on a new image: the one above can still be queued
+                sliced_image = np.where( canny_filter( test_back )[..., np.newaxis], EDGE_COLORS[1], sliced_image )
+            self._save_result( sliced_image, canny_name, index, writer )
         else:
             return sliced_image
 
-    def predict_image(self, test_img):
+    def segment_directory(self, tests, both, canny_use=False, roi=False, batch_size=4096, workers=4, writer=None):
+        """
+        finds the edges of the test slices classifying the patches of consecutive slices in the same batches,
+        the next slices are decoded by reader threads while the model runs
+        :param tests: filepaths (or loader keys) of the test slices
+        :param both: save both the segmented image and the one with the canny filter, as show_segmented_image
+        :param canny_use: add the canny filter to the segmented image
+        :param roi: if True classifies only the pixels inside the brain mask
+        :param batch_size: number of patches classified together
+        :param workers: number of threads decoding the slices and computing their features
+        :param writer: overlay.OverlayWriter saving the images in background, if None they are saved at once
+        :return: number of slices segmented per second
+        """
+        h, w = self.model.input_shape[2:]
+
+        def load(test_img):
+            test_back = self._load_slice( test_img )
+            img = np.array( test_back ) / 256
+            inside = None
+            if roi:
+                # the patch with top-left corner (i, j) is centered in (i + h // 2, j + w // 2)
+                mask = self.roi_mask( test_img, img )
+                inside = mask[h // 2:h // 2 + mask.shape[0] - h + 1, w // 2:w // 2 + mask.shape[1] - w + 1]
+            return test_back, self.edge_features( img ), inside
+
+        # the index and the image of each slice travel as its key
+        slices = (((index, test_back), features, inside)
+                  for index, (_, (test_back, features, inside)) in enumerate( read_ahead( load, tests, workers ) ))
+        start = time.time()
+        count = 0
+        for (index, test_back), segmentation in classify_slices( self.model, slices, batch_size ):
+            self._show_segmentation( index, segmentation, test_back, both, canny_use, True, writer )
+            count += 1
+        elapsed = max( time.time() - start, 1e-12 )
+        print( '{} slices segmented in {:.1f}s, {:.2f} slices/s'.format( count, elapsed, count / elapsed ) )
+        return count / elapsed
+
+    @staticmethod
+    def _save_result(image, canny_name, index, writer=None):
+        path = './results_edge{}/result_edge_{}{}.png'.format( canny_name, canny_name, index )
+        if writer is not None:
+            writer.save( path, image )
+        else:
+            mkdir_p( './results_edge{}/'.format( canny_name ) )
+            imsave( path, image )
+
+    def _load_slice(self, test_img):
+        """
+        loads the image of the slice used for the edge detection, through self.loader if set
+        :param test_img: filepath (or loader key) of the test image
+        :return: array (216, 160)
+        """
+        if self.loader is not None:
+            return self.loader.load_slice( test_img )[-2]
+        return rgb2gray( imread( test_img ).astype( 'float' ) ).reshape( 5, 216, 160 )[-2]
+
+    def predict_image(self, test_img, roi=False, mask=None, dense=False):
         """
         predicts classes of input image
         :param test_img: filepath to image to predict on
-        :param show: displays segmentation results
+        :param roi: if True only the pixels inside the brain mask are classified, the background is non edge
+        :param mask: brain mask (216, 160) to use with roi, by default the one saved by the pre processing
+         or the pixels of the image that are not zero
+        :param dense: if True classifies the whole slice in one pass of the fully convolutional model
         :return: segmented result
         """
-        img = np.array( rgb2gray( imread( test_img ).astype( 'float' ) ).reshape( 5, 216, 160 )[-2] ) / 256
+        img = np.array( self._load_slice( test_img ) ) / 256
 
         plist = []
 
         # create patches from an entire slice
-        img_1 = adjust_sigmoid( img ).astype( float )
-        edges_1 = adjust_sigmoid( img, inv=True ).astype( float )
-        edges_2 = img_1
-        edges_5_n = normalize( laplace( img_1 ) )
-        edges_5_n = img_as_float( img_as_ubyte( edges_5_n ) )
+        features = self.edge_features( img )
+        edges_1, edges_2, edges_5_n = features
+
+        if roi:
+            # the features are computed on the whole slice, only the patches inside the mask are classified
+            return self.predict_roi( features, self.roi_mask( test_img, img, mask ), dense=dense )
+        if dense:
+            return self.predict_dense( features[np.newaxis] )[0]
 
         plist.append( extract_patches_2d( edges_1, (23, 23) ) )
         plist.append( extract_patches_2d( edges_2, (23, 23) ) )
@@ -270,6 +299,93 @@ class Edge_detector_cnn( object ):
         fp1 = full_pred.reshape( 194, 138 )
         return fp1
 
+    @staticmethod
+    def edge_features(img):
+        """
+        computes the three images the patches are cut from
+        :param img: image (rows, cols) of the slice, values in [0, 1)
+        :return: array (3, rows, cols): inverted sigmoid, sigmoid and normalized laplace of the sigmoid
+        """
+        # the same features the training patches are cropped from
+        return patch_extractor_edges.edge_features( img )
+
+    def roi_mask(self, test_img, img, mask=None):
+        """
+        gives the brain mask of a test slice: the given one, the one saved with the slice by the
+        pre processing, or the pixels of the image that are not zero
+        :param test_img: filepath (or loader key) of the slice
+        :param img: image (rows, cols) of the slice
+        :param mask: optional boolean mask (rows, cols)
+        :return: boolean mask (rows, cols)
+        """
+        if mask is None and self.loader is not None:
+            mask = self.loader.load_mask( test_img )
+        if mask is None:
+            mask = brain_mask( img[np.newaxis] )
+        return np.asarray( mask, dtype=bool )
+
+    def _predict_positions(self, features, positions, chunk=4096):
+        """
+        classifies only the patches at the given positions, cut in chunks from a strided view of the features
+        :param features: array (3, rows, cols) of the feature images of the slice
+        :param positions: array (n, 2) of top-left corners of the patches to classify
+        :param chunk: number of patches copied and classified at once
+        :return: array (n,) of predicted classes
+        """
+        h, w = self.model.input_shape[2:]
+        channels, rows, cols = features.shape
+        windows = as_strided( features, shape=(rows - h + 1, cols - w + 1, channels, h, w),
+                              strides=features.strides[1:] + features.strides )
+        classes = np.zeros( len( positions ), dtype=int )
+        for start in xrange( 0, len( positions ), chunk ):
+            selected = positions[start:start + chunk]
+            classes[start:start + chunk] = self.model.predict_classes( windows[selected[:, 0], selected[:, 1]] )
+        return classes
+
+    def predict_roi(self, features, mask, dense=False):
+        """
+        classifies only the patches centered inside the mask, the others are set to non edge.
+        The result is the one of the full run inside the mask
+        :param features: array (3, rows, cols) of the feature images of the slice
+        :param mask: boolean mask (rows, cols)
+        :param dense: if True the fully convolutional model is run on the bounding box of the mask
+        :return: array (rows - 22, cols - 22) of predicted classes
+        """
+        h, w = self.model.input_shape[2:]
+        rows, cols = features.shape[1] - h + 1, features.shape[2] - w + 1
+        # the patch with top-left corner (i, j) is centered in (i + h // 2, j + w // 2)
+        inside = mask[h // 2:h // 2 + rows, w // 2:w // 2 + cols]
+        segmentation = np.zeros( (rows, cols), dtype=int )
+        positions = np.argwhere( inside )
+        self.roi_counts = (len( positions ), rows * cols - len( positions ))
+        print( 'ROI: {} pixels evaluated, {} background pixels skipped'.format( *self.roi_counts ) )
+        if len( positions ) == 0:
+            return segmentation
+        if dense:
+            # the crop holds the whole patch of every position of the bounding box
+            (r0, c0), (r1, c1) = positions.min( axis=0 ), positions.max( axis=0 ) + 1
+            crop = features[np.newaxis, :, r0:r1 + h - 1, c0:c1 + w - 1]
+            segmentation[r0:r1, c0:c1] = self.predict_dense( crop )[0]
+            segmentation[~inside] = 0
+        else:
+            segmentation[inside] = self._predict_positions( features, positions )
+        return segmentation
+
+    def predict_dense(self, features):
+        """
+        classifies every patch position of whole slices with the fully convolutional version of the model,
+        the strided convolutions are run with stride 1 and stitched back, instead of extracting every patch
+        :param features: array (n, 3, rows, cols) of the feature images of the slices
+        :return: array (n, rows - 22, cols - 22) of predicted classes
+        """
+        if self.dense_model is None:
+            if isinstance( self.model, numpy_runtime.NumpyModel ):
+                raise ValueError( 'the fully convolutional model is built with keras, '
+                                  'load the model with the keras runtime' )
+            from fully_convolutional import FullyConvolutionalModel
+            self.dense_model = FullyConvolutionalModel( self.model )
+        return self.dense_model.predict_classes( features )
+
     def save_model(self, model_name):
         """
         Saves current model as json and weigts as h5df file
@@ -289,13 +405,22 @@ class Edge_detector_cnn( object ):
             json.dump( json_string, f )
 
     @staticmethod
-    def load_model_weights(model_name):
+    def load_model_weights(model_name, runtime='keras'):
         """
 
         :param model_name: filepath to model and weights, not including extension
-        :return: Model with loaded weights. can fit on model using loaded_model=True in fit_model method
+        :param runtime: 'keras', or 'numpy' to run the model with numpy_runtime, keras is then never imported
+        :return: Model with loaded weights. can fit on model using loaded_model=True in fit_model method,
+         with the numpy runtime a numpy_runtime model that can only predict
         """
         print( 'Loading model {}'.format( model_name ) )
+        if runtime == 'numpy':
+            model_comp = numpy_runtime.load_model( model_name )
+            print( 'Done.' )
+            return model_comp
+        if runtime != 'keras':
+            raise ValueError( 'unknown runtime {}'.format( runtime ) )
+        from keras.models import model_from_json
         model_to_load = '{}.json'.format( model_name )
         weights = '{}.hdf5'.format( model_name )
         with open( model_to_load ) as f:
@@ -367,21 +492,73 @@ if __name__ == '__main__':
                          dest='test',
                          default=False,
                          help='execute test' )
+    parser.add_argument( '-dense',
+                         action='store_true',
+                         dest='dense',
+                         default=False,
+                         help='find the edges of the test images with the fully convolutional model\n'
+                              'instead of classifying each patch' )
+    parser.add_argument( '-roi',
+                         action='store_true',
+                         dest='roi',
+                         default=False,
+                         help='classify only the pixels inside the brain mask of each test slice' )
+    parser.add_argument( '-data',
+                         action='store',
+                         dest='data',
+                         default='./Training_PNG',
+                         type=str,
+                         help='folder of the training data, PNG strips or h5 patient volumes,\n'
+                              'default=./Training_PNG' )
+    parser.add_argument( '-test_data',
+                         action='store',
+                         dest='test_data',
+                         default='test_data',
+                         type=str,
+                         help='folder of the test data, PNG strips or h5 patient volumes,\n'
+                              'default=test_data' )
+    parser.add_argument( '-runtime',
+                         action='store',
+                         dest='runtime',
+                         default='keras',
+                         choices=['keras', 'numpy'],
+                         help='runtime of the loaded model, numpy predicts without importing keras\n'
+                              '(no training, no -dense), default=keras' )
+    parser.add_argument( '-batch',
+                         action='store',
+                         dest='batch',
+                         default=0,
+                         type=int,
+                         help='find the edges of the test slices classifying this many patches together, packed\n'
+                              'from consecutive slices decoded by reader threads, default=0 (one slice at a time)' )
+    parser.add_argument( '-readers',
+                         action='store',
+                         dest='readers',
+                         default=4,
+                         type=int,
+                         help='number of threads decoding the test slices with -batch, default=4' )
     result = parser.parse_args()
+    if result.batch and result.dense:
+        parser.error( '-batch classifies the patches, it can not be used with -dense' )
 
-    train_data = glob( './Training_PNG/**.png' )
+    train_loader = get_slice_loader( result.data )
+    train_data = train_loader.keys()
     print( str( len( train_data ) ) + ' images to load' )
 
     if type( result.model_to_load ) is int:
         patches = patch_extractor_edges.PatchExtractor( num_samples=result.training_datas,
                                                         path_to_images=train_data,
                                                         sigma=result.sigma,
-                                                        augmentation_angle=result.angle )
+                                                        augmentation_angle=result.angle,
+                                                        loader=train_loader )
         X, y = patches.make_training_patches()
         model = Edge_detector_cnn()
         model.fit_model( X, y )
     else:
-        model = Edge_detector_cnn( loaded_model=True, model_name='./models/' + result.model_to_load )
+        model = Edge_detector_cnn( loaded_model=True, model_name='./models/' + result.model_to_load,
+                                   runtime=result.runtime )
+    # the training slices are not read anymore
+    train_loader.close()
 
     if result.save:
         if result.angle is not 0:
@@ -392,8 +569,18 @@ if __name__ == '__main__':
         model.save_model( 'models/{}_{}result_edge_detector_cnn'.format( result.training_datas, angle ) )
 
     if result.test:
-        tests = glob( 'test_data/**' )
-        segmented_images = []
-        for index, slice in enumerate( tests ):
-            segmented_images.append(
-                model.show_segmented_image( index, slice, both=result.both, canny_use=result.canny_filter, save=True ) )
+        test_loader = get_slice_loader( result.test_data )
+        if not isinstance( test_loader, PngStripLoader ):
+            model.loader = test_loader
+        tests = test_loader.keys()
+        # overlays are written in background while the next slice is segmented
+        writer = OverlayWriter()
+        if result.batch:
+            model.segment_directory( tests, both=result.both, canny_use=result.canny_filter, roi=result.roi,
+                                     batch_size=result.batch, workers=result.readers, writer=writer )
+        else:
+            for index, slice in enumerate( tests ):
+                model.show_segmented_image( index, slice, both=result.both, canny_use=result.canny_filter, save=True,
+                                            roi=result.roi, writer=writer, dense=result.dense )
+        writer.close()
+        test_loader.close()
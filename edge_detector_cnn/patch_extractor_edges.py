@@ -3,28 +3,27 @@ This code extract and catalog all patches to give to the cnn
 to achieve the edge of an image through the following criteria:
 0 - non edge
 1 - edge
-one patch is  marked as edge when passing through the canny edge extractor
-all patches found are saved in the folder  patches/sigma_{value inserted}/  and inside of this
-two folder classes contains them together with the rotations folder each that contains all patches with the
-previously specified rotation
+one patch is  marked as edge when its center is an edge of the canny filter applied to the sigmoid of the image.
+The canny edge map and the three feature channels are computed once per image, the classes of all the
+patch centers are read from the edge maps and the patches are cropped directly from the feature images,
+the same ones the model is given at prediction time
 """
 
 from __future__ import print_function
-from random import randint
-from sklearn.feature_extraction.image import extract_patches_2d
 from sklearn.preprocessing import normalize
-from skimage.color import rgb2gray
 from skimage.exposure import adjust_sigmoid
 from skimage.transform import rotate
 from skimage.filters import laplace
 from skimage.feature import canny
-from skimage.io import imread, imsave
 from skimage import img_as_ubyte, img_as_float
-from errno import EEXIST
-from os.path import isdir
-from os import makedirs
-from glob import glob
+from numpy.lib.stride_tricks import as_strided
+from os.path import abspath, dirname, join
 import numpy as np
+import sys
+
+# the shared modules are in the brain tumor segmentation folder, a sibling folder, not a package
+sys.path.append(join(dirname(abspath(__file__)), '..', 'brain_tumor_segmentation_cnn'))
+from volume_store import PngStripLoader
 
 __author__ = "Cesare Catavitello"
 
@@ -35,44 +34,30 @@ __email__ = "cesarec88@gmail.com"
 __status__ = "Production"
 
 
-def mkdir_p(path):
+def edge_features(img):
     """
-    mkdir -p function, makes folder recursively if required
-    :type path: basestring
-    :param path:
-    :return:
+    computes the three images the patches are cut from
+    :param img: image (rows, cols) of the slice, values in [0, 1)
+    :return: array (3, rows, cols): inverted sigmoid, sigmoid and normalized laplace of the sigmoid
     """
-    try:
-        makedirs( path )
-    except OSError as exc:  # Python >2.5
-        if exc.errno == EEXIST and isdir( path ):
-            pass
-        else:
-            raise
+    img_1 = adjust_sigmoid( img ).astype( float )
+    edges_1 = adjust_sigmoid( img, inv=True ).astype( float )
+    edges_5_n = normalize( laplace( img_1 ) )
+    edges_5_n = img_as_float( img_as_ubyte( edges_5_n ) )
+    return np.array( [edges_1, img_1, edges_5_n] )
 
 
-def get_right_order(filename):
-    """
-    gives a key_value function for a sorted extraction
-    :param filename:  path to image
-    :return:
-    """
-    last_part = filename.split( '/' )[len( filename.split( '/' ) ) - 1]
-    number_value = last_part[:-4]
-    return int( number_value )
-
-def is_boarder(patch, sigma):
+def window_sums(image, patch_size):
     """
-    this function evaluates the canny filter ovet the passed patch
-    returning through boolean
-    wheather or not the image can be catalogued as boarder retrieving the
-    boolean value of the center
-    :param patch: the image to filter
-    :param sigma: sigma value for the canny filter
-    :return: boolean value
+    sums of the image over every patch, through the integral image
+    :param image: array (rows, cols)
+    :param patch_size: (height, wide) of the patches
+    :return: array (rows - height + 1, cols - wide + 1), element (i, j) for the patch with top-left corner (i, j)
     """
-    bool_patch = canny( patch, sigma=sigma )
-    return bool_patch[patch.shape[0] / 2][patch.shape[1] / 2]
+    h, w = patch_size
+    integral = np.zeros( (image.shape[0] + 1, image.shape[1] + 1) )
+    integral[1:, 1:] = image.cumsum( axis=0 ).cumsum( axis=1 )
+    return integral[h:, w:] - integral[:-h, w:] - integral[h:, :-w] + integral[:-h, :-w]
 
 
 def rotate_patches(patch, edge_1, edge_2, rotating_angle):
@@ -84,14 +69,15 @@ def rotate_patches(patch, edge_1, edge_2, rotating_angle):
 class PatchExtractor( object ):
     def __init__(self, num_samples=None, path_to_images=None, sigma=None,
                  patch_size=(23, 23),
-                 augmentation_angle=0):
+                 augmentation_angle=0, loader=None):
         """
         load and store all necessary information to achieve the patch extraction
         :param num_samples: number of patches required
-        :param path_to_images: path to the folder containing all '.png.' files
+        :param path_to_images: paths of all '.png.' files, or keys of the slices for the given loader
         :param sigma: sigma value to apply at the canny filter for patch extraction criteria
         :param patch_size: dimensions for each patch
         :param augmentation_angle: angle necessary to operate the increase of the number of patches
+        :param loader: slice loader of volume_store, PngStripLoader over path_to_images if None
         """
         print( '*' * 50 )
         print( 'Starting patch extraction...' )
@@ -107,7 +93,9 @@ class PatchExtractor( object ):
             exit( 1 )
         self.sigma = sigma
         self.augmentation_angle = augmentation_angle % 360
-        self.images = np.array( [rgb2gray( imread( path_to_images[el] ).astype( 'float' ).reshape( 5, 216, 160 )[-2] )
+        if loader is None:
+            loader = PngStripLoader( path_to_images )
+        self.images = np.array( [loader.load_slice( path_to_images[el] )[-2]
                                  for el in range( len( path_to_images ) )] )
         if self.augmentation_angle is not 0:
             self.augmentation_multiplier = int( 360. / self.augmentation_angle )
@@ -117,6 +105,11 @@ class PatchExtractor( object ):
         self.num_samples = num_samples
 
         self.patch_size = patch_size
+        # feature images, edge and background maps of the images, computed at the first extraction
+        self.features = None
+        self.edge_maps = None
+        self.black_maps = None
+        self.valid_centers = None
 
     def make_training_patches(self):
         """
@@ -138,6 +131,71 @@ class PatchExtractor( object ):
                                             self.patch_size[1] ), \
                np.array( labels ).reshape( (self.num_samples * self.augmentation_multiplier) )
 
+    def _build_index(self):
+        """
+        computes once per image its three feature images, the canny edge map of its sigmoid and the patches
+        holding only background: the maps index the centers of the patches of each class,
+        the patches of both classes are cropped from the feature images
+        :return:
+        """
+        print( 'computing the feature images and the edge maps...' )
+        h, w = self.patch_size
+        n_images, rows, cols = self.images.shape
+        self.features = np.empty( (n_images, 3, rows, cols) )
+        self.edge_maps = np.zeros( self.images.shape, dtype=bool )
+        self.black_maps = np.zeros( self.images.shape, dtype=bool )
+        for ix, image in enumerate( self.images ):
+            self.features[ix] = edge_features( image / 256 )
+            # the second feature image is the sigmoid of the image
+            self.edge_maps[ix] = canny( self.features[ix, 1], sigma=self.sigma )
+            # the patch centered in (r, c) has top-left corner (r - h // 2, c - w // 2)
+            self.black_maps[ix, h // 2:h // 2 + rows - h + 1, w // 2:w // 2 + cols - w + 1] = \
+                window_sums( image != 0, self.patch_size ) == 0
+        # centers of the patches inside the image
+        self.valid_centers = np.zeros( (rows, cols), dtype=bool )
+        self.valid_centers[h // 2:h // 2 + rows - h + 1, w // 2:w // 2 + cols - w + 1] = True
+
+    def _sample_centers(self, candidates, num):
+        """
+        draws uniformly, with replacement, centers of patches among the candidates of all images
+        :param candidates: boolean array (n_images, rows, cols) of the allowed centers
+        :param num: number of centers
+        :return: arrays (num,) of image index, row and col of the centers
+        """
+        if num == 0:
+            return np.zeros( (3, 0), dtype=int )
+        counts = candidates.reshape( len( candidates ), -1 ).sum( axis=1 )
+        if counts.sum() == 0:
+            raise ValueError( 'no patch of the required class in the images' )
+        chosen = np.sort( np.random.randint( 0, counts.sum(), num ) )
+        starts = np.cumsum( counts ) - counts
+        image_ix = np.searchsorted( starts, chosen, side='right' ) - 1
+        flat = np.empty( num, dtype=int )
+        for ix in np.unique( image_ix ):
+            selected = image_ix == ix
+            flat[selected] = np.flatnonzero( candidates[ix] )[chosen[selected] - starts[ix]]
+        rows, cols = np.unravel_index( flat, candidates.shape[1:] )
+        return image_ix, rows, cols
+
+    def _crop_patches(self, image_ix, rows, cols):
+        """
+        crops the 3 channel patches from the feature images computed by _build_index
+        :param image_ix: index of the image of each patch
+        :param rows: row of the center of each patch
+        :param cols: col of the center of each patch
+        :return: array (n, 3, height, wide)
+        """
+        h, w = self.patch_size
+        patches = np.empty( (len( image_ix ), 3, h, w) )
+        for ix in np.unique( image_ix ):
+            features = self.features[ix]
+            channels, n_rows, n_cols = features.shape
+            windows = as_strided( features, shape=(n_rows - h + 1, n_cols - w + 1, channels, h, w),
+                                  strides=features.strides[1:] + features.strides )
+            selected = np.flatnonzero( image_ix == ix )
+            patches[selected] = windows[rows[selected] - h // 2, cols[selected] - w // 2]
+        return patches
+
     def _find_patches(self, class_number, per_class):
         """
         this function in dependence of the class number search for patches with the edge pattern
@@ -147,181 +205,34 @@ class PatchExtractor( object ):
         a numpy array of patches and a numpy array of labels
         """
         print()
-        patches = []
         labels = np.ones( per_class * self.augmentation_multiplier ) * class_number
 
-        ten_percent_black = 0
-        ten_percent_black_value = int( float( per_class ) * 0.0001 )
-
-        start_value_extraction = 0
-        full = False
-
-        if isdir( 'patches/' ) and isdir( 'patches/sigma_{}/'.format( self.sigma
-                                                                      ) ) and isdir(
-            'patches/sigma_{}/class_{}/'.format( self.sigma,
-                                                 class_number ) ):
+        if self.edge_maps is None:
+            self._build_index()
 
-            # load all patches
-            # check if quantity is enough to work
-            path_to_patches = sorted( glob( './patches/sigma_{}/class_{}/**.png'.format( self.sigma,
-                                                                                         class_number ) ),
-                                      key=get_right_order )
-
-            for path_index in xrange( len( path_to_patches ) ):
-                if path_index < per_class:
-                    patch_to_load = np.array( rgb2gray( imread( path_to_patches[path_index],
-                                                                dtype=float ) ).reshape( 3,
-                                                                                         self.patch_size[0],
-                                                                                         self.patch_size[1] ) ).astype(
-                        float )
-                    patches.append( patch_to_load )
-                    for el in xrange( len( patch_to_load ) ):
-                        if np.max( patch_to_load[el] ) > 1:
-                            patch_to_load[el] /= np.max( patch_to_load[el] )
-                    print( '*---> patch {}/{} loaded and added '.format( path_index, per_class ) )
-                else:
-                    full = True
-                    break
-
-            if len( path_to_patches ) < per_class:
-                # change start_value_extraction
-                start_value_extraction = len( path_to_patches )
-            else:
-                full = True
+        if class_number == 1:
+            image_ix, rows, cols = self._sample_centers( self.edge_maps & self.valid_centers, per_class )
         else:
-            mkdir_p( 'patches/sigma_{}/class_{}'.format( self.sigma,
-                                                         class_number ) )
-
-        patch_to_extract = 25000
-
-        if not full:
-            for i in range( start_value_extraction, per_class ):
-                extracted = False
-                random_image = self.images[randint( 0, len( self.images ) - 1 )]
-                while np.array_equal( random_image, np.zeros( random_image.shape ) ):
-                    random_image = self.images[randint( 0, len( self.images ) - 1 )]
-                patches_from_random = np.array( extract_patches_2d( random_image, self.patch_size, patch_to_extract ) )
-                counter = 0
-
-                while not extracted:
-                    if counter > per_class / 2:
-                        random_image = self.images[randint( 0, len( self.images ) - 1 )]
-                        patches_from_random = np.array(
-                            extract_patches_2d( random_image, self.patch_size, patch_to_extract ) )
-                        counter = 0
-                    patch = np.array( patches_from_random[randint( 0, patch_to_extract - 1 )].astype( float ) )
-                    if patch.max() > 1:
-                        patch = normalize( patch )
-
-                    patch_1 = adjust_sigmoid( patch )
-                    edges_1 = adjust_sigmoid( patch, inv=True )
-                    edges_2 = patch_1
-                    edges_5_n = normalize( laplace( patch ) )
-                    edges_5_n = img_as_float( img_as_ubyte( edges_5_n ) )
-
-                    choosing_cond = is_boarder( patch=patch_1, sigma=self.sigma )
-
-                    if class_number == 1 and choosing_cond:
-                        final_patch = np.array( [edges_1, edges_2, edges_5_n] )
-                        patches.append( final_patch )
-                        try:
-                            imsave( './patches/sigma_{}/class_{}/{}.png'.format( self.sigma,
-                                                                                 class_number,
-                                                                                 i ),
-                                    final_patch.reshape( (3 * self.patch_size[0], self.patch_size[1]) ),
-                                    dtype=float )
-                        except:
-                            print( 'problem occurred in save for class {}'.format( class_number ) )
-                            exit( 0 )
-
-                        print( '*---> patch {}/{} added and saved '.format( i, per_class ) )
-                        extracted = True
-
-                    elif class_number == 0 and not choosing_cond:
-                        if np.array_equal( patch, np.zeros( patch.shape ) ):
-                            if ten_percent_black < ten_percent_black_value:
-                                final_patch = np.array( [patch, edges_2, edges_5_n] )
-                                patches.append( final_patch )
-                                try:
-
-                                    imsave( './patches/sigma_{}/class_{}/{}.png'.format( self.sigma,
-                                                                                         class_number,
-                                                                                         i ),
-                                            final_patch.reshape( (3 * self.patch_size[0], self.patch_size[1]) ),
-                                            dtype=float )
-                                except:
-                                    print( 'problem occurred in save for class {}'.format( class_number ) )
-                                    exit( 0 )
-
-                                print( '*---> patch {}/{} added and saved '.format( i, per_class ) )
-                                ten_percent_black += 1
-                                extracted = True
-                            else:
-                                pass
-                        else:
-                            final_patch = np.array( [edges_1, edges_2, edges_5_n] )
-                            patches.append( final_patch )
-                            try:
-
-                                imsave( './patches/sigma_{}/class_{}/{}.png'.format( self.sigma,
-                                                                                     class_number,
-                                                                                     i ),
-                                        final_patch.reshape( (3 * self.patch_size[0], self.patch_size[1]) ),
-                                        dtype=float )
-                            except:
-                                print( 'problem occurred in save for class {}'.format( class_number ) )
-                                exit( 0 )
-
-                            print( '*---> patch {}/{} added and saved '.format( i, per_class ) )
-                            extracted = True
-                    counter += 1
+            # only a few patches of the background are allowed in the non edge class
+            ten_percent_black_value = int( float( per_class ) * 0.0001 )
+            non_edges = ~self.edge_maps & self.valid_centers
+            if not (non_edges & self.black_maps).any():
+                ten_percent_black_value = 0
+            black = self._sample_centers( non_edges & self.black_maps, ten_percent_black_value )
+            not_black = self._sample_centers( non_edges & ~self.black_maps, per_class - ten_percent_black_value )
+            image_ix, rows, cols = [np.concatenate( pair ) for pair in zip( black, not_black )]
+        patches = list( self._crop_patches( image_ix, rows, cols ) )
+        print( '*---> {} patches of class {} extracted from {} images'.format( per_class, class_number,
+                                                                             len( np.unique( image_ix ) ) ) )
 
         if self.augmentation_angle != 0:
             print( "\n *_*_*_*_* proceeding  with data augmentation for class {}  *_*_*_*_* \n".format( class_number ) )
-
-            if isdir( './patches/sigma_{}/class_{}/rotations'.format( self.sigma,
-                                                                      class_number ) ):
-                print( "rotations folder present " )
-            else:
-                mkdir_p( './patches/sigma_{}/class_{}/rotations'.format( self.sigma,
-                                                                         class_number ) )
-                print( "rotations folder created" )
-            for el_index in xrange( len( patches ) ):
+            for el_index in xrange( per_class ):
                 for j in range( 1, self.augmentation_multiplier ):
-                    try:
-                        patch_rotated = np.array( rgb2gray( imread(
-                            ('./patches/sigma_{}/class_{}/'
-                             'rotations/{}_{}.png'.format( self.sigma,
-                                                           class_number,
-                                                           el_index,
-                                                           self.augmentation_angle * j )) ) ).reshape( 3,
-                                                                                                       self.patch_size[
-                                                                                                           0],
-                                                                                                       self.patch_size[
-                                                                                                           1]
-                                                                                                       ) ).astype(
-                            float ) / (
-                                            256 * 256)
-                        patches.append( patch_rotated )
-                        print( '*---> patch {}/{} loaded and added '
-                               'with rotation of {} degrees'.format( el_index, per_class,
-                                                                     self.augmentation_angle * j ) )
-                    except:
-                        final_rotated_patch = rotate_patches( patches[el_index][0],
-                                                              patches[el_index][1],
-                                                              patches[el_index][2],
-                                                              self.augmentation_angle * j )
-                        patches.append( final_rotated_patch )
-                        imsave( './patches/sigma_{}/class_{}/'
-                                'rotations/{}_{}.png'.format( self.sigma,
-                                                              class_number,
-                                                              el_index,
-                                                              self.augmentation_angle * j ),
-                                final_rotated_patch.reshape( 3 * self.patch_size[0], self.patch_size[1] ),
-                                dtype=float )
-                        print( ('*---> patch {}/{} saved and added '
-                                'with rotation of {} degrees '.format( el_index, per_class,
-                                                                       self.augmentation_angle * j )) )
+                    patches.append( rotate_patches( patches[el_index][0],
+                                                    patches[el_index][1],
+                                                    patches[el_index][2],
+                                                    self.augmentation_angle * j ) )
             print()
             print( 'augmentation done \n' )
         print( 'extraction for class {} complete\n'.format( class_number ) )
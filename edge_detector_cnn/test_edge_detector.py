@@ -0,0 +1,59 @@
+# coding=utf-8
+"""
+
+Checks of the fully convolutional edge detection: with random weights, the dense pass over the
+feature images of a slice must give the classes of the patch by patch prediction.
+The checks are skipped when keras is not installed.
+Run with: python -m unittest test_edge_detector (from this folder)
+
+"""
+
+from __future__ import print_function
+import numpy as np
+import unittest
+
+try:
+    import keras
+except ImportError:
+    keras = None
+
+__author__ = "Cesare Catavitello"
+
+__license__ = "MIT"
+__version__ = "1.0.2"
+__maintainer__ = "Cesare Catavitello"
+__email__ = "cesarec88@gmail.com"
+__status__ = "Production"
+
+
+@unittest.skipIf( keras is None, 'keras is not installed' )
+class DenseEdgeDetectionTest( unittest.TestCase ):
+    def setUp(self):
+        from edge_detector_cnn import Edge_detector_cnn
+        random = np.random.RandomState( 5 )
+        self.detector = Edge_detector_cnn()
+        # larger weights than the initialization, so that both classes are predicted
+        for layer in self.detector.model.layers:
+            layer.set_weights( [random.randn( *weight.shape ).astype( np.float32 ) * 0.5
+                                for weight in layer.get_weights()] )
+        self.features = random.rand( 3, 60, 50 ).astype( np.float32 )
+
+    def patch_classes(self):
+        rows, cols = self.features.shape[1] - 22, self.features.shape[2] - 22
+        positions = np.indices( (rows, cols) ).reshape( 2, -1 ).T
+        return self.detector._predict_positions( self.features, positions ).reshape( rows, cols )
+
+    def test_dense_prediction_matches_patch_prediction(self):
+        expected = self.patch_classes()
+        self.assertTrue( len( np.unique( expected ) ) > 1 )
+        np.testing.assert_array_equal( self.detector.predict_dense( self.features[np.newaxis] )[0], expected )
+
+    def test_dense_roi_matches_patch_roi(self):
+        mask = np.zeros( self.features.shape[1:], dtype=bool )
+        mask[15:50, 20:45] = np.random.RandomState( 6 ).rand( 35, 25 ) < 0.7
+        np.testing.assert_array_equal( self.detector.predict_roi( self.features, mask, dense=True ),
+                                       self.detector.predict_roi( self.features, mask ) )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,19 @@
 from __future__ import print_function
 from glob import glob
 from skimage import io
+import SimpleITK as sitk
 from errno import EEXIST
-from os.path import isdir
+from os.path import isdir, abspath, dirname, join
 from os import makedirs
+import sys
+
+# the shared modules are in the brain tumor segmentation folder, a sibling folder, not a package
+sys.path.append(join(dirname(abspath(__file__)), '..', 'brain_tumor_segmentation_cnn'))
+from volume_store import save_patient_volume, brain_mask
+from n4_bias_correction import n4_correct, n4_correct_all
+from export_manifest import export_parallel
 import numpy as np
-import subprocess
+import time
 import progressbar
 
 __author__ = "Cesare Catavitello"
@@ -51,23 +59,49 @@ def normalize(slice_el):
         return (slice_el - np.mean(slice_el)) / np.std(slice_el)
 
 
+def normalize_slices(slices, out=None):
+    """
+    vectorized normalize: clips the 1% at the top and bottom of the histogram
+    and z-scores every slice of the block at once
+    :param slices: array of slices (..., height, width)
+    :param out: float array of the same shape where to write the result, can be slices itself
+    :return: array of normalized slices, same shape of slices
+    """
+    bottom, top = np.percentile(slices, (1, 99), axis=(-2, -1), keepdims=True)
+    clipped = np.clip(slices, bottom, top, out=out)
+    mean = clipped.mean(axis=(-2, -1), keepdims=True, dtype=np.float64)
+    std = clipped.std(axis=(-2, -1), keepdims=True, dtype=np.float64)
+    # slices with null std are only clipped
+    flat = std == 0
+    clipped -= np.where(flat, 0, mean)
+    clipped /= np.where(flat, 1, std)
+    return clipped
+
+
 class BrainPipeline(object):
     """
     A class for processing brain scans for one patient
     """
 
-    def __init__(self, path, n4itk=False, n4itk_apply=False):
+    def __init__(self, path, n4itk=False, n4itk_apply=False, dtype=np.float32):
         """
 
         :param path: path to directory of one patient. Contains following mha files:
-        flair, t1, t1c, t2, ground truth (gt)
+        flair, t1, t1c, t2, ground truth (gt). Without gt (volumes to segment) its slices are all zeros
         :param n4itk:  True to use n4itk normed t1 scans (defaults to True)
         :param n4itk_apply: True to apply and save n4itk filter to t1 and t1c scans for given patient.
+        :param dtype: dtype of the loaded scans, float32 or int16 for the raw intensities
         """
         self.path = path
         self.n4itk = n4itk
         self.n4itk_apply = n4itk_apply
+        self.dtype = dtype
+        self.reference_scan = None
+        self.has_gt = True
         self.modes = ['flair', 't1', 't1c', 't2', 'gt']
+        # uncorrected t1 and t1c scans, and their normalized slices after N4 (see n4_slices)
+        self.t1_scans = None
+        self._n4_slices = None
         # slices=[[flair x 155], [t1], [t1c], [t2], [gt]], 155 per modality
         self.slices_by_mode, n = self.read_scans()
         # [ [slice1 x 5], [slice2 x 5], ..., [slice155 x 5]]
@@ -80,34 +114,42 @@ class BrainPipeline(object):
         transforms scans of same slice into strip of 5 images
         """
         print('Loading scans...')
-        slices_by_mode = np.zeros((5, 176, 216, 160))
-        slices_by_slice = np.zeros((176, 5, 216, 160))
         flair = glob(self.path + '/*Flair*/*.mha')
         t2 = glob(self.path + '/*_T2*/*.mha')
         gt = glob(self.path + '/*more*/*.mha')
         t1s = glob(self.path + '/**/*T1*.mha')
         t1_n4 = glob(self.path + '/*T1*/*_n.mha')
         t1 = [scan for scan in t1s if scan not in t1_n4]
-        scans = [flair[0], t1[0], t1[1], t2[0], gt[0]]  # directories to each image (5 total)
+        self.t1_scans = t1[:2]
+        self.has_gt = len(gt) > 0
+        gt = gt[:1] if self.has_gt else []
+        scans = [flair[0], t1[0], t1[1], t2[0]] + gt  # directories to each image (5 total, 4 without gt)
         if self.n4itk_apply:
             print('-> Applyling bias correction...')
-            for t1_path in t1:
-                self.n4itk_norm(t1_path)  # normalize files
-            scans = [flair[0], t1_n4[0], t1_n4[1], t2[0], gt[0]]
+            # t1 and t1c are corrected together, cached results are reused
+            t1_n4 = n4_correct_all(t1, threads=len(t1))
+            scans = [flair[0], t1_n4[0], t1_n4[1], t2[0]] + gt
         elif self.n4itk:
-            scans = [flair[0], t1_n4[0], t1_n4[1], t2[0], gt[0]]
-        for scan_idx in xrange(5):
+            scans = [flair[0], t1_n4[0], t1_n4[1], t2[0]] + gt
+        # the volume shape is given by the header of the first scan, without decoding it
+        self.reference_scan = scans[0]
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(scans[0])
+        reader.ReadImageInformation()
+        shape = tuple(reversed(reader.GetSize()))
+        slices_by_mode = np.empty((len(self.modes),) + shape, dtype=self.dtype)
+        if not self.has_gt:
+            slices_by_mode[-1] = 0
+        for scan_idx in xrange(len(scans)):
             # read each image directory, save to self.slices
-            print(io.imread(scans[scan_idx], plugin='simpleitk').astype(float).shape)
             print(scans[scan_idx])
-            print('*' * 100)
-            try:
-                slices_by_mode[scan_idx] = io.imread(scans[scan_idx], plugin='simpleitk').astype(float)
-            except:
-                continue
-        for mode_ix in xrange(slices_by_mode.shape[0]):  # modes 1 thru 5
-            for slice_ix in xrange(slices_by_mode.shape[1]):  # slices 1 thru 155
-                slices_by_slice[slice_ix][mode_ix] = slices_by_mode[mode_ix][slice_ix]  # reshape by slice
+            volume = sitk.GetArrayFromImage(sitk.ReadImage(scans[scan_idx]))
+            if volume.shape != shape:
+                raise ValueError('{} has shape {}, {} has shape {}'.format(scans[scan_idx], volume.shape,
+                                                                           scans[0], shape))
+            slices_by_mode[scan_idx] = volume
+        # reshape by slice, as a view over the same buffer
+        slices_by_slice = slices_by_mode.transpose(1, 0, 2, 3)
         return slices_by_mode, slices_by_slice
 
     def norm_slices(self):
@@ -118,74 +160,104 @@ class BrainPipeline(object):
         if n4itk == True, will apply n4itk bias correction to T1 and T1c images
         """
         print('Normalizing slices...')
-        normed_slices = np.zeros((176, 5, 216, 160))
-        for slice_ix in xrange(176):
-            normed_slices[slice_ix][-1] = self.slices_by_slice[slice_ix][-1]
-            for mode_ix in xrange(4):
-                normed_slices[slice_ix][mode_ix] = normalize(self.slices_by_slice[slice_ix][mode_ix])
+        normed_by_mode = np.empty(self.slices_by_mode.shape, dtype=np.float32)
+        normed_by_mode[:] = self.slices_by_mode
+        normalize_slices(normed_by_mode[:-1], out=normed_by_mode[:-1])
         print ('Done.')
-        return normed_slices
+        return normed_by_mode.transpose(1, 0, 2, 3)
 
     def save_patient(self, reg_norm_n4, patient_num):
         """
         saves png in Norm_PNG directory for normed, Training_PNG for reg
         :param reg_norm_n4:  'reg' for original images, 'norm' normalized images,
-         'n4' for n4 normalized images
+         'n4' for n4 normalized images (N4 is run on t1 and t1c if the pipeline does not read corrected scans,
+         see n4_slices). With the '_h5' suffix (e.g. 'reg_h5') the slices are saved
+         as one h5 volume (see volume_store) in Training_H5, Norm_H5 or n4_H5 instead of png strips
         :param patient_num: unique identifier for each patient
         :return:
         """
         print('Saving scans for patient {}...'.format(patient_num))
         progress.currval = 0
-        if reg_norm_n4 == 'norm':  # saved normed slices
-            for slice_ix in progress(xrange(176)):  # reshape to strip
-                strip = self.normed_slices[slice_ix].reshape(1080, 160)
-                if np.max(strip) != 0:  # set values < 1
-                    strip /= np.max(strip)
-                if np.min(strip) <= -1:  # set values > -1
-                    strip /= abs(np.min(strip))
-                # save as patient_slice.png
-                try:
-                    io.imsave('Norm_PNG/{}_{}.png'.format(patient_num, slice_ix), strip)
-                except:
-                    mkdir_p('Norm_PNG/')
-                    io.imsave('Norm_PNG/{}_{}.png'.format(patient_num, slice_ix), strip)
+        if reg_norm_n4.endswith('_h5'):
+            folder = {'reg_h5': 'Training_H5/', 'norm_h5': 'Norm_H5/', 'n4_h5': 'n4_H5/'}[reg_norm_n4]
+            slices = {'reg_h5': self.slices_by_slice, 'norm_h5': self.normed_slices}.get(reg_norm_n4)
+            if slices is None:
+                slices = self.n4_slices()
+            mkdir_p(folder)
+            # the brain mask is saved with the volume, inference can skip the background without computing it
+            mask = brain_mask(self.slices_by_mode[:-1])
+            save_patient_volume('{}{}.h5'.format(folder, patient_num), slices, mask=mask)
+        elif reg_norm_n4 == 'norm':  # saved normed slices
+            self._save_strips(self.normed_slices, 'Norm_PNG/', patient_num, normed=True)
         elif reg_norm_n4 == 'reg':
-            # for slice_ix in progress(xrange(155)):
-            for slice_ix in progress(xrange(176)):
-                strip = self.slices_by_slice[slice_ix].reshape(1080, 160)
-                if np.max(strip) != 0:
-                    strip /= np.max(strip)
-                try:
-                    io.imsave('Training_PNG/{}_{}.png'.format(patient_num, slice_ix), strip)
-                except:
-                    mkdir_p('Training_PNG/')
-                    io.imsave('Training_PNG/{}_{}.png'.format(patient_num, slice_ix), strip)
+            self._save_strips(self.slices_by_slice, 'Training_PNG/', patient_num, normed=False)
         else:
-            for slice_ix in progress(xrange(176)):  # reshape to strip
-                strip = self.normed_slices[slice_ix].reshape(1080, 160)
-                if np.max(strip) != 0:  # set values < 1
-                    strip /= np.max(strip)
-                if np.min(strip) <= -1:  # set values > -1
-                    strip /= abs(np.min(strip))
-                # save as patient_slice.png
-                try:
-                    io.imsave('n4_PNG/{}_{}.png'.format(patient_num, slice_ix), strip)
-                except:
-                    mkdir_p('n4_PNG/')
-                    io.imsave('n4_PNG/{}_{}.png'.format(patient_num, slice_ix), strip)
-
-    def n4itk_norm(self, path, n_dims=3, n_iters='[20,20,10,5]'):
+            self._save_strips(self.n4_slices(), 'n4_PNG/', patient_num, normed=True)
+
+    def n4_slices(self):
+        """
+        normalized slices with the t1 and t1c scans bias corrected by N4. They are normed_slices when the
+        pipeline already reads the corrected scans (n4itk or n4itk_apply), otherwise t1 and t1c are corrected
+        (or taken from the cache of n4_bias_correction) and normalized, the other modes are the ones of normed_slices
+        :return: array of slices, each of shape (5, height, width)
+        """
+        if self.n4itk or self.n4itk_apply:
+            return self.normed_slices
+        if self._n4_slices is None:
+            print('-> Applyling bias correction...')
+            normed_by_mode = np.array(self.normed_slices.transpose(1, 0, 2, 3))
+            for mode, scan in zip((1, 2), n4_correct_all(self.t1_scans, threads=len(self.t1_scans))):
+                volume = sitk.GetArrayFromImage(sitk.ReadImage(scan))
+                if volume.shape != normed_by_mode.shape[1:]:
+                    raise ValueError('{} has shape {}, {} has shape {}'.format(scan, volume.shape,
+                                                                               self.reference_scan,
+                                                                               normed_by_mode.shape[1:]))
+                normed_by_mode[mode] = volume
+                normalize_slices(normed_by_mode[mode], out=normed_by_mode[mode])
+            self._n4_slices = normed_by_mode.transpose(1, 0, 2, 3)
+        return self._n4_slices
+
+    @staticmethod
+    def _save_strips(slices, folder, patient_num, normed):
+        """
+        saves each slice as a strip of its 5 images under folder/patient-num_slice-num.png
+        :param slices: array of slices, each of shape (5, height, width)
+        :param folder: destination folder
+        :param patient_num: unique identifier for each patient
+        :param normed: True if the slices are normalized and can have negative values
+        :return:
+        """
+        mkdir_p(folder)
+        for slice_ix in progress(xrange(len(slices))):  # reshape to strip
+            # copy, the same slices can be saved more than once by the same pipeline
+            strip = np.array(slices[slice_ix].reshape(-1, slices.shape[-1]), dtype=float)
+            if np.max(strip) != 0:  # set values < 1
+                strip /= np.max(strip)
+            if normed and np.min(strip) <= -1:  # set values > -1
+                strip /= abs(np.min(strip))
+            # save as patient_slice.png
+            io.imsave('{}{}_{}.png'.format(folder, patient_num, slice_ix), strip)
+
+    def save_labels(self, patient_num):
+        """
+        saves the ground truth of each slice in Labels directory as patient-num_slice-numL.png
+        :param patient_num: unique identifier for each patient
+        :return:
+        """
+        print('Saving labels for patient {}...'.format(patient_num))
+        mkdir_p('Labels/')
+        for slice_ix, label in enumerate(self.slices_by_mode[-1]):
+            io.imsave('Labels/{}_{}L.png'.format(patient_num, slice_ix), label.astype(np.uint8))
+
+    def n4itk_norm(self, path, n_dims=3, n_iters=(20, 20, 10, 5)):
         """
         writes n4itk normalized image to parent_dir under orig_filename_n.mha
         :param path: path to mha T1 or T1c file
         :param n_dims:  param for n4itk filter
         :param n_iters: param for n4itk filter
-        :return:
+        :return: path to the normalized image
         """
-        output_fn = path[:-4] + '_n.mha'
-        # run n4_bias_correction.py path n_dim n_iters output_fn
-        subprocess.call('python n4_bias_correction.py ' + path + ' ' + str(n_dims) + ' ' + n_iters + ' ' + output_fn,
-                        shell=True)
+        return n4_correct(path, n_dims, n_iters)
 
 
 def save_patient_slices(patients_path, type_modality):
@@ -197,11 +269,75 @@ def save_patient_slices(patients_path, type_modality):
      n4 (bias corrected and normalized
     :return:
     """
+    export_patients(patients_path, kinds=(type_modality,), labels=False)
+
+
+def export_patients(patients_path, kinds=('reg', 'norm'), labels=True, n4itk=False, n4itk_apply=False):
+    """
+    reads the scans of each patient once and saves all the requested kinds of strips
+    (and the labels) in a single pass
+    :param patients_path: paths to any directories of patients to save. for example- glob("Training/HGG/**"
+    :param kinds: kinds of strips to save, any of reg, norm and n4 or of reg_h5, norm_h5 and n4_h5
+     for the h5 volumes (see save_patient). n4 runs the N4 correction, it is not saved by default
+    :param labels: True to save also the ground truth of each slice in Labels/
+    :param n4itk: True to use n4itk normed t1 scans
+    :param n4itk_apply: True to apply and save n4itk filter to t1 and t1c scans
+    :return: list of (patient_num, seconds to load and normalize, seconds to save) for each patient
+    """
+    timings = []
     for patient_num, path in enumerate(patients_path):
-        a = BrainPipeline(path)
-        a.save_patient(type_modality, patient_num)
+        timings.append(_export_patient((patient_num, path, kinds, labels, n4itk, n4itk_apply)))
+    if timings:
+        print('{} patients exported in {:.1f}s'.format(len(timings), sum(t[2] + t[3] for t in timings)))
+    return [(t[0], t[2], t[3]) for t in timings]
+
+
+def _export_patient(job):
+    """
+    exports one patient, see export_patients. Defined at module level to be run by a process pool
+    :param job: tuple (patient_num, path, kinds, labels, n4itk, n4itk_apply)
+    :return: (patient_num, path, seconds to load and normalize, seconds to save)
+    """
+    patient_num, path, kinds, labels, n4itk, n4itk_apply = job
+    start = time.time()
+    pipeline = BrainPipeline(path, n4itk=n4itk, n4itk_apply=n4itk_apply)
+    loaded = time.time()
+    for kind in kinds:
+        pipeline.save_patient(kind, patient_num)
+    if labels:
+        pipeline.save_labels(patient_num)
+    saved = time.time()
+    print('patient {} ({}): loaded in {:.1f}s, saved in {:.1f}s'.format(patient_num, path,
+                                                                     loaded - start, saved - loaded))
+    return patient_num, path, loaded - start, saved - loaded
 
 
+def export_patients_parallel(patients_path, kinds=('reg', 'norm'), labels=True, n4itk=False,
+                             n4itk_apply=False, processes=None, manifest_path='export_manifest.json'):
+    """
+    as export_patients, spreading the patients over a pool of processes.
+    Each exported patient is recorded in a manifest with the hash of its scans,
+    so that a new run only exports the patients that are new, changed or missing some kind (see export_manifest).
+    Patient numbers are assigned in the order of patients_path the first time a patient is seen
+    and then kept from the manifest, whatever the order in which the workers finish.
+    :param patients_path: paths to any directories of patients to save. for example- glob("Training/HGG/**"
+    :param kinds: kinds of strips to save, any of reg, norm and n4 or of reg_h5, norm_h5 and n4_h5
+     for the h5 volumes (see save_patient). n4 runs the N4 correction, it is not saved by default
+    :param labels: True to save also the ground truth of each slice in Labels/
+    :param n4itk: True to use n4itk normed t1 scans
+    :param n4itk_apply: True to apply and save n4itk filter to t1 and t1c scans
+    :param processes: number of worker processes, defaults to the number of cpus
+    :param manifest_path: path to the json manifest
+    :return: list of (patient_num, seconds to load and normalize, seconds to save) for the exported patients
+    """
+    results = export_parallel(patients_path, _export_patient, kinds, labels, options=(n4itk, n4itk_apply),
+                              processes=processes, manifest_path=manifest_path)
+    timings = [(patient_num, load_time, save_time) for patient_num, _, load_time, save_time in results]
+    if timings:
+        print('{} patients exported, {:.1f}s of worker time'.format(len(timings),
+                                                                   sum(t[1] + t[2] for t in timings)))
+    return timings
+
 
 def save_labels(labels):
     """
@@ -231,6 +367,4 @@ if __name__ == '__main__':
     # print labels
     # save_labels(labels)
     patients = glob('/Users/Cesare/Desktop/lavoro/brain_segmentation-master/BRATS-2/Image_Data/HG/**')
-    save_patient_slices(patients, 'reg')
-    save_patient_slices(patients, 'norm')
-    save_patient_slices(patients, 'n4')
+    export_patients_parallel(patients, kinds=('reg', 'norm', 'n4'))
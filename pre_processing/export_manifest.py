@@ -0,0 +1,118 @@
+"""
+
+Resumable export of the patients over a pool of processes, shared by the pre processing of
+both projects (brain_pipeline and the two-way ImagePreProcessing).
+Each exported patient is recorded in a json manifest with the md5 of its scans and the kinds already written,
+so that a new run only exports the patients that are new, changed or missing some kind.
+
+"""
+
+from __future__ import print_function
+from glob import glob
+from os.path import isfile, basename
+from os import rename
+from multiprocessing import Pool
+import hashlib
+import json
+
+__author__ = "Cesare Catavitello"
+__license__ = "MIT"
+__version__ = "1.0.1"
+__maintainer__ = "Cesare Catavitello"
+__email__ = "cesarec88@gmail.com"
+__status__ = "Production"
+
+
+def patient_hash(path):
+    """
+    md5 of the content of all the .mha scans of a patient, n4itk outputs (_n.mha) excluded
+    :param path: path to directory of one patient
+    :return: hex digest
+    """
+    digest = hashlib.md5()
+    for scan in sorted(glob(path + '/**/*.mha')):
+        if scan.endswith('_n.mha'):
+            continue
+        digest.update(basename(scan).encode('utf-8'))
+        with open(scan, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(manifest_path):
+    """
+    loads the manifest of the patients already exported
+    :param manifest_path: path to the json manifest
+    :return: dict patient path -> {'num', 'hash', 'kinds', 'labels'}
+    """
+    if not isfile(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_path):
+    """
+    writes the manifest on a temporary file and moves it in place, an interrupted run never leaves it truncated
+    :param manifest: dict patient path -> {'num', 'hash', 'kinds', 'labels'}
+    :param manifest_path: path to the json manifest
+    :return:
+    """
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    rename(manifest_path + '.tmp', manifest_path)
+
+
+def export_parallel(patients_path, export, kinds, labels=False, options=(), processes=None,
+                    manifest_path='export_manifest.json'):
+    """
+    runs export on the patients that are new, changed or missing some of kinds, over a pool of processes.
+    Patient numbers are assigned in the order of patients_path the first time a patient is seen
+    and then kept from the manifest, whatever the order in which the workers finish.
+    :param patients_path: paths to the directories of the patients
+    :param export: function exporting one patient, defined at module level to be run by the pool. It is called
+     on the job (patient_num, path, missing kinds, True if the labels are missing) + options and returns
+     a tuple starting with patient_num and path
+    :param kinds: kinds every patient must be exported to
+    :param labels: True if the labels of every patient must be saved too
+    :param options: values appended to every job
+    :param processes: number of worker processes, defaults to the number of cpus
+    :param manifest_path: path to the json manifest
+    :return: list of the results of export, in the order the patients were finished
+    """
+    manifest = load_manifest(manifest_path)
+    next_num = max([entry['num'] for entry in manifest.values()] + [-1]) + 1
+    jobs, hashes = [], {}
+    for path in patients_path:
+        hashes[path] = patient_hash(path)
+        entry = manifest.get(path)
+        if entry is None:
+            entry = manifest[path] = {'num': next_num, 'hash': None, 'kinds': [], 'labels': False}
+            next_num += 1
+        if entry['hash'] != hashes[path]:
+            entry.update(hash=None, kinds=[], labels=False)
+        missing_kinds = tuple(kind for kind in kinds if kind not in entry['kinds'])
+        missing_labels = labels and not entry['labels']
+        if missing_kinds or missing_labels:
+            jobs.append((entry['num'], path, missing_kinds, missing_labels) + tuple(options))
+    # numbers are saved before any work, an interrupted run gives the same numbers when resumed
+    save_manifest(manifest, manifest_path)
+    print('{} patients to export, {} already done'.format(len(jobs), len(patients_path) - len(jobs)))
+
+    jobs_by_path = dict((job[1], job) for job in jobs)
+    results = []
+    pool = Pool(processes)
+    try:
+        for result in pool.imap_unordered(export, jobs):
+            path = result[1]
+            entry, job = manifest[path], jobs_by_path[path]
+            entry['hash'] = hashes[path]
+            entry['kinds'] = sorted(set(entry['kinds']) | set(job[2]))
+            entry['labels'] = entry['labels'] or job[3]
+            save_manifest(manifest, manifest_path)
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+    return results
@@ -1,25 +1,162 @@
-from nipype.interfaces.ants import N4BiasFieldCorrection
+"""
+
+N4 bias field correction (ANTs through nipype) of T1 and T1c scans.
+Corrected volumes are cached under n4_cache/, keyed by the md5 of the input scan and the N4 parameters,
+so that a scan is corrected only once whatever the number of exports.
+Can still be run from the command line:
+run n4_bias_correction input_image dimension n_iterations(optional, form:[n_1,n_2,n_3,n_4]) output_image(optional)
+
+"""
+
+from __future__ import print_function
+from multiprocessing.pool import ThreadPool
+from os.path import isdir, isfile, join, getmtime, dirname, abspath
+from os import makedirs, rename, remove, close, chmod
+from errno import EEXIST
+from shutil import copyfile
+import SimpleITK as sitk
+import tempfile
+import hashlib
 import sys
 import ast
 
-if len(sys.argv) < 2:
-    print("INPUT from ipython: run n4_bias_correction "
-          "input_image dimension n_iterations(optional,"
-          " form:[n_1,n_2,n_3,n_4]) output_image(optional)")
-    sys.exit(1)
+__author__ = "Cesare Catavitello"
+__license__ = "MIT"
+__version__ = "1.0.1"
+__maintainer__ = "Cesare Catavitello"
+__email__ = "cesarec88@gmail.com"
+__status__ = "Production"
+
+
+def mkdir_p(path):
+    """
+    mkdir -p function, makes folder recursively if required
+    :param path:
+    :return:
+    """
+    try:
+        makedirs(path)
+    except OSError as exc:  # Python >2.5
+        if exc.errno == EEXIST and isdir(path):
+            pass
+        else:
+            raise
+
+
+def n4_key(input_image, dimension, n_iterations):
+    """
+    key of the cached correction of a scan
+    :param input_image: path to the mha scan
+    :param dimension: dimension of the image
+    :param n_iterations: list of iterations per level
+    :return: hex digest of the scan content and of the N4 parameters
+    """
+    digest = hashlib.md5()
+    digest.update('{}:{}'.format(dimension, list(n_iterations)).encode('utf-8'))
+    with open(input_image, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def is_valid_volume(path):
+    """
+    :param path: path to an mha file
+    :return: True if the header of the file can be read
+    """
+    if not isfile(path):
+        return False
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    try:
+        reader.ReadImageInformation()
+    except RuntimeError:
+        return False
+    return True
+
+
+def n4_correct(input_image, dimension=3, n_iterations=(20, 20, 10, 5), output_image=None, cache_dir='n4_cache/'):
+    """
+    applies the N4 bias field correction to a scan, unless a valid corrected volume is already cached
+    :param input_image: path to the mha scan
+    :param dimension: dimension of the image
+    :param n_iterations: list of iterations per level
+    :param output_image: where to copy the corrected scan, defaults to input_image with the _n.mha suffix
+    :param cache_dir: folder of the cached corrections
+    :return: path to output_image
+    """
+    if output_image is None:
+        output_image = input_image[:-4] + '_n.mha'
+    cached = join(cache_dir, n4_key(input_image, dimension, n_iterations) + '.mha')
+    if is_valid_volume(cached):
+        print('-> N4 of {} found in cache'.format(input_image))
+    else:
+        # nipype is only needed when a correction actually runs
+        from nipype.interfaces.ants import N4BiasFieldCorrection
+        mkdir_p(cache_dir)
+        # ANTs writes on a temporary file moved in place when done, the cache never holds partial volumes;
+        # the file is unique, so that workers correcting the same scan do not write on each other's output
+        partial = _temporary_file(cache_dir)
+        try:
+            n4 = N4BiasFieldCorrection(output_image=partial)
+            n4.inputs.dimension = dimension
+            n4.inputs.input_image = input_image
+            n4.inputs.n_iterations = list(n_iterations)
+            n4.run()
+            rename(partial, cached)
+        finally:
+            if isfile(partial):
+                remove(partial)
+    if not isfile(output_image) or getmtime(output_image) < getmtime(cached):
+        copied = _temporary_file(dirname(abspath(output_image)))
+        copyfile(cached, copied)
+        rename(copied, output_image)
+    return output_image
+
+
+def _temporary_file(folder):
+    """
+    :param folder: folder of the file, on the same file system of its final path so that it can be renamed there
+    :return: path to a new empty .mha file with a unique name
+    """
+    handle, path = tempfile.mkstemp(dir=folder, suffix='.mha')
+    close(handle)
+    # mkstemp makes the file readable by its owner only, the volumes are readable as the ones written by ANTs
+    chmod(path, 0o644)
+    return path
+
+
+def n4_correct_all(input_images, dimension=3, n_iterations=(20, 20, 10, 5), cache_dir='n4_cache/', threads=None):
+    """
+    applies n4_correct to many scans at once. ANTs runs outside the interpreter,
+    so a pool of threads is enough to keep several corrections running
+    :param input_images: paths to the mha scans
+    :param dimension: dimension of the images
+    :param n_iterations: list of iterations per level
+    :param cache_dir: folder of the cached corrections
+    :param threads: number of corrections running together, defaults to the number of cpus
+    :return: list of the paths to the corrected scans, in the order of input_images
+    """
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(lambda path: n4_correct(path, dimension, n_iterations, cache_dir=cache_dir), input_images)
+    finally:
+        pool.close()
+        pool.join()
 
-# if output_image is given
-if len(sys.argv) > 3:
-    n4 = N4BiasFieldCorrection(output_image=sys.argv[4])
-else:
-    n4 = N4BiasFieldCorrection()
 
-# dimension of input image, input image
-n4.inputs.dimension = int(sys.argv[2])
-n4.inputs.input_image = sys.argv[1]
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("INPUT from ipython: run n4_bias_correction "
+              "input_image dimension n_iterations(optional,"
+              " form:[n_1,n_2,n_3,n_4]) output_image(optional)")
+        sys.exit(1)
 
-# if n_dinesions arg given
-if len(sys.argv) > 2:
-    n4.inputs.n_iterations = ast.literal_eval(sys.argv[3])
+    iterations = (20, 20, 10, 5)
+    # if n_iterations arg given
+    if len(sys.argv) > 3:
+        iterations = ast.literal_eval(sys.argv[3])
+    # if output_image is given
+    output = sys.argv[4] if len(sys.argv) > 4 else None
 
-n4.run()
+    n4_correct(sys.argv[1], int(sys.argv[2]), iterations, output)
@@ -1,14 +1,20 @@
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import random
 import json
 from glob import glob
 import os
+import sys
+import tempfile
 import progressbar
 from patch_library import PatchLibrary
+# the shared modules are in the brain tumor segmentation folder, a sibling folder, not a package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'brain_tumor_segmentation_cnn'))
+from volume_store import get_slice_loader, is_volume_key, VolumeStore, brain_mask
+from overlay import render_overlay, OverlayWriter, TUMOR_COLORS
+import numpy_runtime
 import matplotlib.pyplot as plt
-from sklearn.feature_extraction.image import extract_patches_2d
-from skimage import io, color, img_as_float
-from skimage.exposure import adjust_gamma
+from skimage import io, img_as_float
 from skimage.segmentation import mark_boundaries
 from keras.models import Model, model_from_json
 from keras.layers.convolutional import Conv2D, MaxPooling2D
@@ -18,7 +24,7 @@ from keras.optimizers import SGD
 from keras import regularizers
 from keras.initializers import zeros, lecun_uniform
 from keras.constraints import max_norm
-from keras.callbacks import EarlyStopping, ModelCheckpoint
+from keras.callbacks import EarlyStopping, ModelCheckpoint, LambdaCallback
 from keras.utils import np_utils
 from keras.utils.vis_utils import plot_model
 
@@ -32,6 +38,35 @@ __status__ = "Production"
 progress = progressbar.ProgressBar(widgets=[progressbar.Bar('*', '[', ']'), progressbar.Percentage(), ' '])
 
 
+def strided_patches(image, size):
+    '''
+    Gives all the square patches of an image with stride 1, without copying it
+    INPUT   (1) numpy array 'image': image of shape (channels, rows, cols)
+            (2) int 'size': side of the patches
+    OUTPUT  (1) view of shape (rows - size + 1, cols - size + 1, channels, size, size) over the same buffer
+    '''
+    channels, rows, cols = image.shape
+    channel_stride, row_stride, col_stride = image.strides
+    return as_strided(image, shape=(rows - size + 1, cols - size + 1, channels, size, size),
+                      strides=(row_stride, col_stride, channel_stride, row_stride, col_stride))
+
+
+def fill_positions(values, positions, shape):
+    '''
+    places the values predicted at some positions in a map
+    INPUT   (1) numpy array 'values': value of each position
+            (2) numpy array 'positions': (n, 2) row and col of each value, None if values covers the whole map
+                in row-major order
+            (3) tuple 'shape': shape of the map
+    OUTPUT  (1) array of the given shape, 0 where no value is given
+    '''
+    if positions is None:
+        return values.reshape(shape)
+    filled = np.zeros(shape, dtype=values.dtype)
+    filled[positions[:, 0], positions[:, 1]] = values
+    return filled
+
+
 class BrainSegDCNN(object):
     """
 
@@ -73,6 +108,10 @@ class BrainSegDCNN(object):
         self.nb_epoch = nb_epoch
         self.nb_sample = nb_sample
         self.cascade_model = cascade_model
+        # pixels evaluated and skipped by the last roi prediction
+        self.roi_counts = None
+        # slice loader of volume_store for the images to predict, None reads the PNG strips directly
+        self.loader = None
         self.model = self.compile_model()
 
     # model of TwoPathCNN
@@ -131,9 +170,17 @@ class BrainSegDCNN(object):
             print 'First CNN compiled!'
             # concatenation of the output of the first CNN and the input of shape 33x33
             conc_input = Concatenate(axis=1)([input33, output_cnn1])
-            # second cnn modeling
-            output_dcnn = self.one_block_model(conc_input)
-            output_dcnn = Reshape((5,))(output_dcnn)
+            # the input of the second cnn can be precomputed once the first one is trained
+            self.cascade_input = Model(inputs=[input65, input33], outputs=conc_input)
+            # second cnn modeling, as a model of its own to be trained on the precomputed inputs
+            input_block2 = Input(shape=(9, 33, 33))
+            output_block2 = self.one_block_model(input_block2)
+            output_block2 = Reshape((5,))(output_block2)
+            block2 = Model(inputs=input_block2, outputs=output_block2)
+            sgd = SGD(lr=self.learning_rate, momentum=self.momentum_rate, decay=self.decay_rate, nesterov=False)
+            block2.compile(loss='categorical_crossentropy', optimizer=sgd, metrics=['accuracy'])
+            self.block2 = block2
+            output_dcnn = block2(conc_input)
             # whole dcnn compiling
             dcnn = Model(inputs=[input65, input33], outputs=output_dcnn)
             sgd = SGD(lr=self.learning_rate, momentum=self.momentum_rate, decay=self.decay_rate, nesterov=False)
@@ -166,28 +213,33 @@ class BrainSegDCNN(object):
         :return:
         '''
         if self.cascade_model:
-            if x65_train == None and x65_uniftrain == None:
+            if x65_train is None or x65_uniftrain is None:
                 print 'Error: patches 65x65, necessary to fit cascade model, not inserted.'
             X33_train, X65_train, Y_train, X33_uniftrain, X65_uniftrain, Y_uniftrain = self.init_cascade_training(x33_train,
                                     x65_train, y_train, x33_uniftrain, x65_uniftrain, y_uniftrain)
             # Stop the training if the monitor function doesn't change after patience epochs
             earlystopping = EarlyStopping(monitor='val_loss', patience=2, verbose=1, mode='auto')
-            # Save model after each epoch to check/bm_epoch#-val_loss
-            checkpointer = ModelCheckpoint(filepath="./check/bm_{epoch:02d}-{val_loss:.2f}.hdf5", verbose=1)
+            # Save the whole dcnn after each epoch to check/bm_epoch#-val_loss, while its second cnn is fit
+            checkpointer = self.checkpoint(self.model)
             # Fit the first cnn
             self.fit_cnn1(X33_train, Y_train, X33_uniftrain, Y_uniftrain)
             # Fix all the weights of the first cnn
             self.cnn1 = self.freeze_model(self.cnn1)
+            # the frozen first cnn gives always the same output: it is run once over all the 65x65 patches
+            # and stored with the 33x33 patches as the (9, 33, 33) input of the second cnn.
+            # Its output is computed in inference mode, so the Dropout of the first cnn is not sampled while
+            # the second one trains, as it was in the end to end fit: the first cnn is frozen, its dropout
+            # only added noise to the input of the second cnn, which now trains on the inputs it gets
+            # when predicting. The Dropout of the second cnn is still sampled by its fit
+            X_block2_uniftrain = self.cached_features(self.cascade_input, [X65_uniftrain, X33_uniftrain])
+            X_block2_train = self.cached_features(self.cascade_input, [X65_train, X33_train])
 
             # First-phase training of the second cnn
-            self.model.fit(x=[X65_uniftrain, X33_uniftrain], y=Y_uniftrain, batch_size=self.batch_size, epochs=self.nb_epoch,
-                       callbacks=[earlystopping, checkpointer], validation_split=0.3, verbose=1)
-            # fix all the layers of the dcnn except the output layer for the second-phase
-            self.freeze_model(self.model, freeze_output=False)
-            # Second-phase training of the second cnn
-            self.model.fit(x=[X65_train, X33_train], y=Y_uniftrain, batch_size=self.batch_size,
-                       epochs=self.nb_epoch,
-                       callbacks=[earlystopping, checkpointer], validation_split=0.3, verbose=1)
+            self.block2.fit(x=X_block2_uniftrain, y=Y_uniftrain, batch_size=self.batch_size, epochs=self.nb_epoch,
+                            callbacks=[earlystopping, checkpointer], validation_split=0.3, verbose=1)
+            # Second-phase training of the output layer of the second cnn, with the real distribution of classes
+            self.fit_output_layer(self.block2, X_block2_train, Y_train, callbacks=[earlystopping],
+                                  checkpoint_model=self.model)
             print 'Model trained'
         else:
             X33_train, Y_train, X33_uniftrain, Y_uniftrain = self.init_single_training(x33_train, y_train,
@@ -211,29 +263,112 @@ class BrainSegDCNN(object):
         # First-phase training with uniformly distribuited training set
         temp_cnn.fit(x=X33_train, y=Y_train, batch_size=self.batch_size, epochs=self.nb_epoch,
                      callbacks=[earlystopping, checkpointer], validation_split=0.3,  verbose=1)
-        # fix all the layers of the temporary cnn except the output layer for the second-phase
-        temp_cnn = self.freeze_model(temp_cnn, freeze_output=False)
-        # Second-phase training of the output layer with training set with real distribution probabily
-        temp_cnn.fit(x=X33_unif_train, y=Y_unif_train, batch_size=self.batch_size, epochs=self.nb_epoch,
-                     callbacks=[earlystopping, checkpointer], validation_split=0.3, verbose=1)
+        # Second-phase training of the output layer with training set with real distribution probabily.
+        # the frozen layers give always the same activations, they are computed once and only the output layer is fit
+        self.fit_output_layer(temp_cnn, X33_unif_train, Y_unif_train, callbacks=[earlystopping],
+                              checkpoint_model=temp_cnn)
         # set the weights of the first cnn to the trained weights of the temporary cnn
         self.cnn1.set_weights(temp_cnn.get_weights())
 
+    def cached_features(self, feature_model, x, max_memory=2 ** 30, cache_dir='./cache/'):
+        '''
+        computes the output of feature_model for every sample, in batches
+        INPUT   (1) Model 'feature_model': model giving the features
+                (2) array 'x': input of the model, or list of arrays for more inputs
+                (3) int 'max_memory': bytes above which the features are kept in a memory mapped file
+                (4) str 'cache_dir': folder of the memory mapped files
+        OUTPUT  (1) array of the features, np.memmap if larger than max_memory
+        '''
+        inputs = x if isinstance(x, list) else [x]
+        n = len(inputs[0])
+        shape = (n,) + tuple(feature_model.output_shape[1:])
+        if np.prod(shape) * 4 > max_memory:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            handle, path = tempfile.mkstemp(suffix='.dat', dir=cache_dir)
+            os.close(handle)
+            features = np.memmap(path, dtype='float32', mode='w+', shape=shape)
+            # the file is removed at once, it lives as long as the memory map
+            os.remove(path)
+            print 'Caching {} features of shape {} in a memory mapped file'.format(n, shape[1:])
+        else:
+            features = np.empty(shape, dtype='float32')
+        chunk = max(1, min(n, max_memory // (4 * int(np.prod(shape[1:]))), 1024))
+        for start in xrange(0, n, chunk):
+            features[start:start + chunk] = feature_model.predict([inp[start:start + chunk] for inp in inputs],
+                                                                  batch_size=self.batch_size)
+        return features
+
+    def checkpoint(self, model, filepath="./check/bm_{epoch:02d}-{val_loss:.2f}.hdf5", before_save=None):
+        '''
+        callback saving the whole model after each epoch, as ModelCheckpoint does for the model being fit,
+        when only a part of it is fit
+        INPUT   (1) Model 'model': model to save
+                (2) str 'filepath': path of the saved model, formatted as the one of ModelCheckpoint
+                (3) function 'before_save': called before saving, to copy in model the weights being fit
+        OUTPUT  (1) keras callback
+        '''
+        def save(epoch, logs):
+            if before_save is not None:
+                before_save()
+            model.save(filepath.format(epoch=epoch + 1, **logs), overwrite=True)
+        return LambdaCallback(on_epoch_end=save)
+
+    def fit_output_layer(self, model, x, y, callbacks=None, checkpoint_model=None):
+        '''
+        trains only the output convolution of a model built by one_block_model on cached features:
+        the activations of the Concatenate layer are computed once, then a model made of the output
+        layer alone is fit on them and its weights are copied back in the output layer of the model.
+        The features are computed in inference mode: the Dropout layers feeding the Concatenate are
+        applied again on the cached features (dropping each element independently, as they do), while the
+        Dropout after the first pooling of the local path, inside the frozen layers, is not sampled any more.
+        INPUT   (1) Model 'model': model whose last Conv2D is the output layer, fed by the last Concatenate
+                (2) array 'x': input of the model, or list of arrays for more inputs
+                (3) array 'y': categorical labels
+                (4) list 'callbacks': keras callbacks for the fit
+                (5) Model 'checkpoint_model': if given, saved after each epoch with the weights fit so far
+        '''
+        concatenation = [layer for layer in model.layers if isinstance(layer, Concatenate)][-1]
+        output_layer = [layer for layer in model.layers if isinstance(layer, Conv2D)][-1]
+        feature_model = Model(inputs=model.inputs, outputs=concatenation.output)
+        features = self.cached_features(feature_model, x)
+        # model made of the output layer only, initialized with its current weights
+        input_features = Input(shape=features.shape[1:])
+        head_layer = Conv2D(5, output_layer.kernel_size, data_format='channels_first', strides=1, padding='valid',
+                            activation='softmax', use_bias=True)
+        head = head_layer(Dropout(self.dropout_rate)(input_features))
+        head = Reshape((5,))(head)
+        head_model = Model(inputs=input_features, outputs=head)
+        head_layer.set_weights(output_layer.get_weights())
+        sgd = SGD(lr=self.learning_rate, momentum=self.momentum_rate, decay=self.decay_rate, nesterov=False)
+        head_model.compile(loss='categorical_crossentropy', optimizer=sgd, metrics=['accuracy'])
+        callbacks = list(callbacks or [])
+        if checkpoint_model is not None:
+            callbacks.append(self.checkpoint(checkpoint_model,
+                                             before_save=lambda: output_layer.set_weights(head_layer.get_weights())))
+        # memory mapped features are shuffled by batch blocks, to read the disk sequentially
+        shuffle = 'batch' if isinstance(features, np.memmap) else True
+        head_model.fit(x=features, y=y, batch_size=self.batch_size, epochs=self.nb_epoch, callbacks=callbacks,
+                       validation_split=0.3, shuffle=shuffle, verbose=1)
+        output_layer.set_weights(head_layer.get_weights())
+
     def freeze_model(self, compiled_model, freeze_output=True):
         '''
         Freeze the weights of the model, they will not be adjusted during training
         :param compiled_model: model to freeze
-        :param freeze_output: if false the weights of the last layer of the model will not be freezed
+        :param freeze_output: if false the weights of the last layer with weights of the model (the output
+         convolution, not the final Reshape) will not be freezed and that layer is set trainable,
+         every other layer is set not trainable
         :return: model with freezed weights
         '''
         input_layer = compiled_model.inputs
         output_layer = compiled_model.outputs
-        if freeze_output:
-            n = len(compiled_model.layers)
-        else:
-            n = len(compiled_model.layers) - 1
-        for i in range(n):
-            compiled_model.layers[i].trainable = False
+        trainable = None
+        if not freeze_output:
+            # the output layer is the last one with weights, the final Reshape has none
+            trainable = [layer for layer in compiled_model.layers if layer.weights][-1]
+        for layer in compiled_model.layers:
+            layer.trainable = layer is trainable
         freezed_model = Model(inputs=input_layer, outputs=output_layer)
         sgd = SGD(lr=self.learning_rate, momentum=self.momentum_rate, decay=self.decay_rate, nesterov=False)
         freezed_model.compile(loss='categorical_crossentropy', optimizer=sgd, metrics=['accuracy'])
@@ -290,13 +425,21 @@ class BrainSegDCNN(object):
             json.dump(json_string, f)
         print 'Model saved.'
 
-    def load_model(self, model_name):
+    def load_model(self, model_name, runtime='keras'):
         '''
         Load a model
         INPUT  (1) string 'model_name': filepath to model and weights, not including extension
+               (2) string 'runtime': 'keras', or 'numpy' to run the model with numpy_runtime instead of keras
+                   (this module still imports keras to build and train the models). The numpy model can only predict
         OUTPUT: Model with loaded weights. can fit on model using loaded_model=True in fit_model method
         '''
         print 'Loading model {}'.format(model_name)
+        if runtime == 'numpy':
+            self.model = numpy_runtime.load_model(model_name)
+            print 'Model loaded.'
+            return self.model
+        if runtime != 'keras':
+            raise ValueError('unknown runtime {}'.format(runtime))
         model_toload = '{}.json'.format(model_name)
         weights = '{}.hdf5'.format(model_name)
         with open(model_toload) as f:
@@ -307,52 +450,74 @@ class BrainSegDCNN(object):
         self.model = model_comp
         return model_comp
 
-    def predict_image(self, filepath_image, show=False):
+    def load_slice(self, filepath_image):
+        '''
+        loads the five images of a slice, through self.loader if set
+        INPUT   (1) str 'filepath_image': filepath (or loader key) of the slice
+        OUTPUT  (1) array (5, 216, 160) with the values of the 8 bit strip
+        '''
+        if self.loader is not None:
+            return self.loader.load_slice(filepath_image)
+        return io.imread(filepath_image).astype('float').reshape(5, 216, 160)
+
+    def roi_mask(self, filepath_image, images, mask=None):
+        '''
+        gives the brain mask of a slice
+        INPUT   (1) str 'filepath_image': filepath (or loader key) of the slice
+                (2) numpy array 'images': modalities of the slice, shape (4, rows, cols)
+                (3) numpy array 'mask': optional boolean mask (rows, cols)
+        OUTPUT  (1) the given mask, else the one saved by the pre processing, else the pixels where any modality
+                    is not zero
+        '''
+        if mask is None and self.loader is not None:
+            mask = self.loader.load_mask(filepath_image)
+        if mask is None:
+            mask = brain_mask(images)
+        return np.asarray(mask, dtype=bool)
+
+    def predict_image(self, filepath_image, show=False, max_memory=256 * 2 ** 20, roi=False, mask=None):
         '''
         predicts classes of input image
         INPUT   (1) str 'filepath_image': filepath to image to predict on
                 (2) bool 'show': True to show the results of prediction, False to return prediction
-        OUTPUT  (1) if show == False: array of predicted pixel classes for the center 208 x 208 pixels
+                (3) int 'max_memory': bytes available for the patches copied at once
+                (4) bool 'roi': True to classify only the pixels inside the brain mask, the background is class 0
+                (5) numpy array 'mask': brain mask (216, 160) for roi, by default the one saved by the
+                    pre processing or the pixels where any modality is not zero
+        OUTPUT  (1) if show == False: array of predicted pixel classes for the center 184 x 128 pixels
                 (2) if show == True: displays segmentation results
         '''
         print 'Starting prediction...'
+        images = self.load_slice(filepath_image)
+        for image in images[:-1]:
+            if np.max(image) != 0:
+                image /= np.max(image)
+        positions = None
+        if roi:
+            # the patch of the output pixel (i, j) is centered in (i + 16, j + 16)
+            inside = self.roi_mask(filepath_image, images[:-1], mask)[16:-16, 16:-16]
+            positions = np.argwhere(inside)
+            self.roi_counts = (len(positions), inside.size - len(positions))
+            print 'ROI: {} pixels evaluated, {} background pixels skipped'.format(*self.roi_counts)
         if self.cascade_model:
-            images = io.imread(filepath_image).astype('float').reshape(5, 216, 160)
-            p33list = []
-            p65list = []
-            # create patches from an entire slice
-            for image in images[:-1]:
-                if np.max(image) != 0:
-                    image /= np.max(image)
-                patch65 = extract_patches_2d(image, (65, 65))
-                p65list.append(patch65)
-                p33list = self.center_n(33, patch65)
-                patches33 = np.array(zip(p33list[0], p33list[1], p33list[2], p33list[3]))
-            patches65 = np.array(zip(p65list[0], p65list[1], p65list[2], p65list[3]))
-            # predict classes of each pixel based on model
-            prediction = self.model.predict([patches65, patches33])
+            # predict classes of each pixel streaming the patches of the slice
+            prediction = self.predict_cascade(images[:-1], max_memory=max_memory, positions=positions)
             print 'Predicted'
-            prediction = prediction.reshape(208, 208)
             if show:
                 io.imshow(prediction)
                 plt.show
             else:
                 return prediction
         else:
-            images = io.imread(filepath_image).astype('float').reshape(5, 216, 160)
-            p33list = []
-            # create patches from an entire slice
-            for image in images[:-1]:
-                if np.max(image) != 0:
-                    image /= np.max(image)
-                patch33 = extract_patches_2d(image, (33, 33))
-                p33list.append(patch33)
-            patches33 = np.array(zip(p33list[0], p33list[1], p33list[2], p33list[3]))
+            # patches 33x33 of the whole slice, as a view
+            patches33 = strided_patches(images[:-1], 33)
+            rows, cols = patches33.shape[:2]
             # predict classes of each pixel based on model
-            prediction = self.cnn1.predict(patches33)
+            probabilities = self._predict_positions(self.cnn1, [patches33], positions, max_memory)
             print 'Predicted'
-            prediction = prediction.reshape(5, 184, 128)
-            predicted_classes = np.argmax(prediction, axis=0)
+            prediction = np.array([fill_positions(probabilities[:, i], positions, (rows, cols))
+                                   for i in xrange(probabilities.shape[1])])
+            predicted_classes = fill_positions(np.argmax(probabilities, axis=1), positions, (rows, cols))
             if show:
                 print 'Let s show'
                 for i in range(5):
@@ -363,7 +528,41 @@ class BrainSegDCNN(object):
             else:
                 return predicted_classes
 
-
+    def _predict_positions(self, model, views, positions=None, max_memory=256 * 2 ** 20):
+        '''
+        predicts the class probabilities of the patches at the given positions.
+        The patches are copied in chunks from strided views in reusable float32 buffers.
+        INPUT   (1) Model 'model': model to run, one input per view
+                (2) list 'views': strided views (rows, cols, channels, h, w) of the patches, one per input
+                (3) numpy array 'positions': (n, 2) row and col of the patches to predict,
+                    None for all of them in row-major order
+                (4) int 'max_memory': bytes of the input buffers, sets the number of patches per chunk
+        OUTPUT  (1) array (n, n_classes) of probabilities
+        '''
+        rows, cols = views[0].shape[:2]
+        total = rows * cols if positions is None else len(positions)
+        patch_bytes = 4 * sum(int(np.prod(view.shape[2:])) for view in views)
+        chunk = int(max(1, min(total, max_memory // patch_bytes)))
+        batches = [np.empty((chunk,) + view.shape[2:], dtype='float32') for view in views]
+        probabilities = np.empty((total, 5), dtype='float32')
+        for start in xrange(0, total, chunk):
+            stop = min(start + chunk, total)
+            n = stop - start
+            if positions is None:
+                # copy the chunk row segment by row segment, avoiding temporary arrays
+                position = start
+                while position < stop:
+                    row, col = divmod(position, cols)
+                    m = min(cols - col, stop - position)
+                    for batch, view in zip(batches, views):
+                        batch[position - start:position - start + m] = view[row, col:col + m]
+                    position += m
+            else:
+                for batch, view in zip(batches, views):
+                    batch[:n] = view[positions[start:stop, 0], positions[start:stop, 1]]
+            output = model.predict([batch[:n] for batch in batches], batch_size=self.batch_size)
+            probabilities[start:stop] = output.reshape(n, -1)
+        return probabilities
 
     def center_n(self, n, patches):
         """
@@ -386,64 +585,63 @@ class BrainSegDCNN(object):
             sub_patches.append(subs)
         return np.array(sub_patches)
 
-    def show_segmented_image(self, filepath_image, modality='t1c', show=False):
+    def predict_cascade(self, images, max_memory=256 * 2 ** 20, positions=None):
+        '''
+        predicts the classes of a slice with the cascade model, streaming its patches in chunks.
+        The 65x65 and 33x33 patches are strided views over one padded copy of the slice,
+        only the patches of the current chunk are copied in the input buffers of the model.
+        INPUT   (1) numpy array 'images': normalized modalities of the slice, shape (4, rows, cols)
+                (2) int 'max_memory': bytes of the input buffers, sets the number of patches per chunk
+                (3) numpy array 'positions': (n, 2) positions to predict, the others are class 0. None for all
+        OUTPUT  (1) array of predicted classes for the center (rows - 32) x (cols - 32) pixels
+        '''
+        # 16 pixels of padding give a 65x65 context to the 33x33 patch of every center pixel
+        padded = np.pad(images, ((0, 0), (16, 16), (16, 16)), mode='constant').astype('float32')
+        patches65 = strided_patches(padded, 65)
+        patches33 = patches65[:, :, :, 16:49, 16:49]
+        probabilities = self._predict_positions(self.model, [patches65, patches33], positions, max_memory)
+        return fill_positions(np.argmax(probabilities, axis=1), positions, patches65.shape[:2])
+
+    def show_segmented_image(self, filepath_image, modality='t1c', show=False, roi=False, writer=None):
         '''
         Creates an image of original brain with segmentation overlay
         INPUT   (1) str 'filepath_image': filepath to test image for segmentation, including file extension
                 (2) str 'modality': imaging modality to use as background. defaults to t1c. options: (flair, t1, t1c, t2)
                 (3) bool 'show': If true, shows output image. defaults to False.
+                (4) bool 'roi': If true, classifies only the pixels inside the brain mask. defaults to False.
+                (5) OverlayWriter 'writer': saves the image in background, if None it is saved at once.
         OUTPUT  (1) if show is True, shows image of segmentation results
                 (2) if show is false, returns segmented image.
         '''
         modes = {'flair': 0, 't1': 1, 't1c': 2, 't2': 3}
 
-        segmentation = self.predict_image(filepath_image, show=False)
+        segmentation = self.predict_image(filepath_image, show=False, roi=roi)
         print 'segmentation = ' + str(segmentation)
         img_mask = np.pad(segmentation, (16, 16), mode='edge')
-        ones = np.argwhere(img_mask == 1)
-        twos = np.argwhere(img_mask == 2)
-        threes = np.argwhere(img_mask == 3)
-        fours = np.argwhere(img_mask == 4)
+        # pixels of each class
+        print np.bincount(img_mask.ravel(), minlength=5)[1:]
 
-        test_im = io.imread(filepath_image)
-        test_back = test_im.reshape(5, 216, 160)[modes[modality]]
+        test_back = self.load_slice(filepath_image)[modes[modality]] / 255.
         # overlay = mark_boundaries(test_back, img_mask)
-        gray_img = img_as_float(test_back)
-
-        # adjust gamma of image
-        image = adjust_gamma(color.gray2rgb(gray_img), 0.65)
-        sliced_image = image.copy()
-        red_multiplier = [1, 0.2, 0.2]
-        yellow_multiplier = [1, 1, 0.25]
-        green_multiplier = [0.35, 0.75, 0.25]
-        blue_multiplier = [0, 0.25, 0.9]
-
-        print str(len(ones))
-        print str(len(twos))
-        print str(len(threes))
-        print str(len(fours))
-
-        # change colors of segmented classes
-        for i in xrange(len(ones)):
-            sliced_image[ones[i][0]][ones[i][1]] = red_multiplier
-        for i in xrange(len(twos)):
-            sliced_image[twos[i][0]][twos[i][1]] = green_multiplier
-        for i in xrange(len(threes)):
-            sliced_image[threes[i][0]][threes[i][1]] = blue_multiplier
-        for i in xrange(len(fours)):
-            sliced_image[fours[i][0]][fours[i][1]] = yellow_multiplier
+        # adjust gamma of image and change colors of segmented classes
+        sliced_image = render_overlay(img_as_float(test_back), img_mask, TUMOR_COLORS, gamma=0.65)
 
         if show:
             print 'Showing...'
             io.imshow(sliced_image)
             plt.show()
             print 'Saving...'
-            io.imsave('./predictions/' + os.path.basename(filepath_image), sliced_image)
+            path = './predictions/' + os.path.basename(filepath_image)
+            if writer is not None:
+                writer.save(path, sliced_image)
+            else:
+                io.imsave(path, sliced_image)
         else:
             return sliced_image
 
 
-def main_model(training_folder_path=None, label_folder_path=None, save_model_path=None, load_model_path=None, to_predict_paths=None, cascade_model=False):
+def main_model(training_folder_path=None, label_folder_path=None, save_model_path=None, load_model_path=None, to_predict_paths=None, cascade_model=False,
+               runtime='keras'):
     if cascade_model:
         # init model
         brain_seg = BrainSegDCNN(dropout_rate=0.2, learning_rate=0.01, momentum_rate=0.5, decay_rate=0.1, l1_rate=0.001,
@@ -453,11 +651,13 @@ def main_model(training_folder_path=None, label_folder_path=None, save_model_pat
 
         # init PatchLibrary and then make patches from training_set
         if training_folder_path is not None and label_folder_path is not None:
-            training_set = glob(training_folder_path + '/**')
-            patches = PatchLibrary(train_samples=training_set, label_folder_path=label_folder_path,
+            loader = get_slice_loader(training_folder_path, label_folder_path)
+            training_set = loader.keys()
+            patches = PatchLibrary(train_samples=training_set, label_folder_path=label_folder_path, loader=loader,
                                    num_samples=brain_seg.nb_sample)
             x33_train, x65_train, y_train = patches.make_training_patches(balanced_classes=False)
             x33_uniftrain, x65_uniftrain, y_uniftrain = patches.make_training_patches()
+            loader.close()
             # fit model
             brain_seg.fit_model(x33_train, y_train, x33_uniftrain, y_uniftrain, x65_train=x65_train,
                             x65_uniftrain=x65_uniftrain)
@@ -467,12 +667,19 @@ def main_model(training_folder_path=None, label_folder_path=None, save_model_pat
             brain_seg.save_model(save_model_path)
         # load model
         if load_model_path is not None:
-            brain_seg.model = brain_seg.load_model(load_model_path)
+            brain_seg.model = brain_seg.load_model(load_model_path, runtime)
 
         # segment and show segmented image
         if to_predict_paths is not None:
+            if any(is_volume_key(to_predict) for to_predict in to_predict_paths):
+                brain_seg.loader = VolumeStore()
+            # overlays are written in background while the next image is segmented
+            writer = OverlayWriter()
             for to_predict in to_predict_paths:
-                brain_seg.show_segmented_image(to_predict, show=True)
+                brain_seg.show_segmented_image(to_predict, show=True, writer=writer)
+            writer.close()
+            if brain_seg.loader is not None:
+                brain_seg.loader.close()
     else:
         # init model
         brain_seg = BrainSegDCNN(dropout_rate=0.2, learning_rate=0.01, momentum_rate=0.5, decay_rate=0.1, l1_rate=0.001,
@@ -482,11 +689,13 @@ def main_model(training_folder_path=None, label_folder_path=None, save_model_pat
 
         # init PatchLibrary and then make patches from training_set
         if training_folder_path is not None and label_folder_path is not None:
-            training_set = glob(training_folder_path + '/**')
-            patches = PatchLibrary(train_samples=training_set, label_folder_path=label_folder_path,
+            loader = get_slice_loader(training_folder_path, label_folder_path)
+            training_set = loader.keys()
+            patches = PatchLibrary(train_samples=training_set, label_folder_path=label_folder_path, loader=loader,
                                    num_samples=brain_seg.nb_sample, patch_size=(33, 33), subpatches_33=False)
             x33_train, y_train = patches.make_training_patches(balanced_classes=False)
             x33_uniftrain, y_uniftrain = patches.make_training_patches()
+            loader.close()
             # fit model
             brain_seg.fit_model(x33_train, y_train, x33_uniftrain, y_uniftrain)
             # save model
@@ -494,14 +703,21 @@ def main_model(training_folder_path=None, label_folder_path=None, save_model_pat
                 brain_seg.save_model(save_model_path)
         # load model
         elif load_model_path is not None:
-            brain_seg.model = brain_seg.load_model(load_model_path)
+            brain_seg.model = brain_seg.load_model(load_model_path, runtime)
         else:
             print 'Trained model cannot be created without providing the path of a model to load or the folder_path of ' \
                   'training samples and folder paths of relative labels!'
         # segment and show segmented image
         if to_predict_paths is not None:
+            if any(is_volume_key(to_predict) for to_predict in to_predict_paths):
+                brain_seg.loader = VolumeStore()
+            # overlays are written in background while the next image is segmented
+            writer = OverlayWriter()
             for to_predict in to_predict_paths:
-                brain_seg.show_segmented_image(to_predict, show=True)
+                brain_seg.show_segmented_image(to_predict, show=True, writer=writer)
+            writer.close()
+            if brain_seg.loader is not None:
+                brain_seg.loader.close()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,7 @@
 import numpy as np
 import random
 import os
+import sys
 import h5py
 from glob import glob
 import matplotlib
@@ -12,6 +13,10 @@ from skimage.morphology import disk
 import progressbar
 from sklearn.feature_extraction.image import extract_patches_2d
 
+# the shared modules are in the brain tumor segmentation folder, a sibling folder, not a package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'brain_tumor_segmentation_cnn'))
+from volume_store import PngStripLoader
+
 __author__ = "Matteo Causio"
 
 __license__ = "MIT"
@@ -24,16 +29,21 @@ np.random.seed(5)
 
 
 class PatchLibrary(object):
-    def __init__(self, train_samples, num_samples, label_folder_path, patch_size=(65, 65), subpatches_33=True):
+    def __init__(self, train_samples, num_samples, label_folder_path, patch_size=(65, 65), subpatches_33=True,
+                 loader=None):
         '''
         class for creating patches and subpatches from training data to use as input for segmentation models.
-        INPUT   (1) list 'train_samples': list of filepaths to all training data saved as pngs.
-                        images should have shape (5, 216, 160)
+        INPUT   (1) list 'train_samples': list of filepaths to all training data saved as pngs,
+                        or keys of the slices for the given loader. images should have shape (5, 216, 160)
                 (2) int 'num_samples': the number of patches to collect from training data.
                 (3) tuple 'patch_size': size (in voxels) of patches to extract. Default= (65,65)
 
                 (4) bool 'subpatches_33': if true for every patches a subpatches 33x33 is extracted. Default=True
+                (5) 'loader': slice loader of volume_store. Default= PngStripLoader over train_samples
         '''
+        if loader is None:
+            loader = PngStripLoader(train_samples, label_folder_path)
+        self.loader = loader
 
         self.patch_size = patch_size
         self.num_samples = num_samples
@@ -51,8 +61,7 @@ class PatchLibrary(object):
         '''
         train_data = []
         for sample_path in self.train_samples:
-            name = os.path.basename(sample_path)[:-4]
-            label = io.imread(label_folder_path + '/' + name + 'L.png')
+            label = self.loader.load_label(sample_path)
             sample_label = [sample_path, label]
             train_data.append(sample_label)
         return train_data
@@ -79,8 +88,7 @@ class PatchLibrary(object):
                 print 'Not enough pixels with label' + str(class_num)
                 continue
             # select centerpix (p) and patch (p_ix)
-            img = io.imread(sample_label[0])
-            img = img.reshape(5, 216, 160)[:-1].astype('float')
+            img = self.loader.load_slice(sample_label[0])[:-1]
             p = random.choice(np.argwhere(sample_label[1] == class_num))
             p_ix = (p[0]-(h/2), p[0]+((h+1)/2), p[1]-(w/2), p[1]+((w+1)/2))
             patch = np.array([i[p_ix[0]:p_ix[1], p_ix[2]:p_ix[3]] for i in img])
@@ -108,8 +116,7 @@ class PatchLibrary(object):
         while ct < num_patches:
             sample_label = random.choice(self.train_data)
              # select centerpix (p) and patch (p_ix)
-            img = io.imread(sample_label[0])
-            img = img.reshape(5, 216, 160)[:-1].astype('float')
+            img = self.loader.load_slice(sample_label[0])[:-1]
             p = random.choice(np.argwhere(sample_label[1] != -1))
             # patch 65x65 around the selected pixel
             p_ix = (p[0] - (h / 2), p[0] + ((h + 1) / 2), p[1] - (w / 2), p[1] + ((w + 1) / 2))
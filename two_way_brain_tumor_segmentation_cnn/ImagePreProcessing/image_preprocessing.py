@@ -10,6 +10,9 @@ import progressbar
 from glob import glob
 from skimage import io
 from nipype.interfaces.ants.segmentation import N4BiasFieldCorrection
+# the export manifest is shared with the pre processing folder, a sibling folder, not a package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'pre_processing'))
+from export_manifest import export_parallel
 
 __author__ = "Matteo Causio"
 
@@ -29,12 +32,14 @@ class ImagePreProcessing(object):
                   flair, t1, t1c, t2,gound truth (gt)
     :param: n4itk: boolean, to specify to use n4itk normed t1 scans (default to True)
     :param: n4itk_apply: boolean, to apply and save n4itk filter to t1 and t1c scans for given patient.            
+    :param: dtype: dtype of the loaded scans, float32 or int16 for the raw intensities
     """
 
-    def __init__(self, path, n4itk=False, n4itk_apply=False):
+    def __init__(self, path, n4itk=False, n4itk_apply=False, dtype=np.float32):
         self.path = path
         self.n4itk = n4itk
         self.n4itk_apply = n4itk_apply
+        self.dtype = dtype
         self.modes = ['flair', 't1', 't1c', 't2', 'gt']
         self.slices_by_mode, self.slices_by_slice, self.normed_slices = None, None, None
         self.read_scans()
@@ -50,8 +55,6 @@ class ImagePreProcessing(object):
         
         """
         print 'Loading scans...'
-        slices_by_mode = np.zeros((5, 176, 216, 160))
-        slice_by_slice = np.zeros((176, 5, 216, 160))
         flair = glob(self.path+'/*Flair*/*.mha')
         t2 = glob(self.path+'/*_T2*/*.mha')
         gt = glob(self.path+'/*more*/*.mha')
@@ -67,13 +70,20 @@ class ImagePreProcessing(object):
         elif self.n4itk:
             print str(t1_n4) + ' ->t1_n4'
             scans = [flair[0], t1_n4[0], t1_n4[1], t2[0], gt[0]]
+        # the volume shape is given by the header of the first scan, without decoding it
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(scans[0])
+        reader.ReadImageInformation()
+        shape = tuple(reversed(reader.GetSize()))
+        slices_by_mode = np.empty((len(scans),) + shape, dtype=self.dtype)
         for scan_idx, scan_el in enumerate(scans):  # read each image directory, save to self.slices
-            slices_by_mode[scan_idx] = io.imread(scan_el, plugin='simpleitk').astype(float)
+            volume = sitk.GetArrayFromImage(sitk.ReadImage(scan_el))
+            if volume.shape != shape:
+                raise ValueError(scan_el + ' has shape ' + str(volume.shape) + ', expected ' + str(shape))
+            slices_by_mode[scan_idx] = volume
 
-        for mode_ix in xrange(slices_by_mode.shape[0]):  # modes 1 thru 5
-            for slice_ix in xrange(slices_by_mode.shape[1]):  # slices 1 thru 155
-                slice_by_slice[slice_ix][mode_ix] = slices_by_mode[mode_ix][slice_ix]  # reshape by slice
-        self.slices_by_slice = slice_by_slice
+        # reshape by slice, as a view over the same buffer
+        self.slices_by_slice = slices_by_mode.transpose(1, 0, 2, 3)
         self.slices_by_mode = slices_by_mode
 
     def norm_slices(self):
@@ -85,13 +95,11 @@ class ImagePreProcessing(object):
         :return: normed_slices:
         """
         print 'Normalizing slices...'
-        normed_slices = np.zeros((176, 5, 216, 160))
-        for slice_ix in xrange(176):
-            normed_slices[slice_ix][-1] = self.slices_by_slice[slice_ix][-1]
-            for mode_ix in xrange(4):
-                normed_slices[slice_ix][mode_ix] = self._normalize(self.slices_by_slice[slice_ix][mode_ix])
+        normed_by_mode = np.empty(self.slices_by_mode.shape, dtype=np.float32)
+        normed_by_mode[:] = self.slices_by_mode
+        self._normalize_slices(normed_by_mode[:-1], out=normed_by_mode[:-1])
         print 'Done.'
-        self.normed_slices = normed_slices
+        self.normed_slices = normed_by_mode.transpose(1, 0, 2, 3)
 
     def _normalize(self, passed_slice):
         """  
@@ -111,6 +119,25 @@ class ImagePreProcessing(object):
         else:
             return (clipped_slice - np.mean(clipped_slice))/ np.std(clipped_slice)
 
+    def _normalize_slices(self, slices, out=None):
+        """
+
+        vectorized _normalize, computing the percentiles, the clipping and the z-score
+        of all the slices of the block in the same numpy calls
+        :param slices: array of slices (..., height, width), excluding gt
+        :param out: float array of the same shape where to write the result, can be slices itself
+        :return: normalized slices, same shape of slices
+        """
+        b, t = np.percentile(slices, (99, 1), axis=(-2, -1), keepdims=True)
+        clipped_slices = np.clip(slices, t, b, out=out)
+        mean = clipped_slices.mean(axis=(-2, -1), keepdims=True, dtype=np.float64)
+        std = clipped_slices.std(axis=(-2, -1), keepdims=True, dtype=np.float64)
+        # slices with null std are only clipped
+        flat = std == 0
+        clipped_slices -= np.where(flat, 0, mean)
+        clipped_slices /= np.where(flat, 1, std)
+        return clipped_slices
+
     def save_patient(self, reg_norm_n4, patient_num):
         """
         :param reg_norm_n4: string, 
@@ -120,8 +147,8 @@ class ImagePreProcessing(object):
         """
         print 'Saving scans for patient {}...'.format(patient_num)
         if reg_norm_n4 == 'norm':  # saved normed slices
-            for slice_ix in range(176):  # reshape to strip
-                strip = self.normed_slices[slice_ix].reshape(1080, 160)
+            for slice_ix in range(len(self.normed_slices)):  # reshape to strip
+                strip = self.normed_slices[slice_ix].reshape(-1, self.normed_slices.shape[-1]).astype(float)
                 if np.max(strip) != 0:  # set values < 1
                     strip /= np.max(strip)
                 if np.min(strip) <= -1:  # set values > -1
@@ -130,14 +157,14 @@ class ImagePreProcessing(object):
                 io.imsave('/home/ixb3/Scrivania/Norm_PNG/{}_{}.png'.format(patient_num, slice_ix), strip)
 
         elif reg_norm_n4 == 'reg':
-            for slice_ix in range(176):#progress(xrange(176)):
-                strip = self.slices_by_slice[slice_ix].reshape(1080, 160)
+            for slice_ix in range(len(self.slices_by_slice)):#progress(xrange(176)):
+                strip = self.slices_by_slice[slice_ix].reshape(-1, self.slices_by_slice.shape[-1]).astype(float)
                 if np.max(strip) != 0:
                     strip /= np.max(strip)
                 io.imsave('/home/ixb3/Scrivania/Training_PNG/{}_{}.png'.format(patient_num, slice_ix), strip)
         else:
-            for slice_ix in range(176):  # reshape to strip
-                strip = self.normed_slices[slice_ix].reshape(1080, 160)
+            for slice_ix in range(len(self.normed_slices)):  # reshape to strip
+                strip = self.normed_slices[slice_ix].reshape(-1, self.normed_slices.shape[-1]).astype(float)
                 if np.max(strip) != 0:  # set values < 1
                     strip /= np.max(strip)
                 if np.min(strip) <= -1:  # set values > -1
@@ -205,6 +232,40 @@ def save_patient_slices(patients, type):
         a.save_patient(type, patient_num)
         print 'Patient ' + str(patient_num) + 'saved!'
 
+
+def _save_patient(job):
+    """
+    Pre process and save one patient, defined at module level to be run by a process pool
+    :param job: tuple (patient_num, path, types, labels) built by export_manifest.export_parallel,
+                labels is always False: the ground truth is saved in the strips
+    :return: patient_num, path
+    """
+    patient_num, path, types, labels = job
+    a = ImagePreProcessing(path)
+    for type in types:
+        a.save_patient(type, patient_num)
+    print 'Patient ' + str(patient_num) + ' saved!'
+    return patient_num, path
+
+
+def save_patient_slices_parallel(patients, type, processes=None, manifest_path='export_manifest.json'):
+    """
+    Save RMIs and targets of the patients as save_patient_slices, using a pool of processes.
+    Every saved patient is recorded in a manifest with the hash of its scans: a new run only saves
+    the patients that are new, changed or not yet saved with this type.
+    Patient numbers are given in the order of patients the first time a patient is seen and then
+    kept from the manifest, whatever the order in which the workers finish.
+    The manifest and the pool are the ones of the pre processing folder (see export_manifest).
+    :param patients: list, string, paths to any directories of patients to save.
+    :param type: string, reg, norm or n4 (see save_patient_slices)
+    :param processes: int, number of worker processes, defaults to the number of cpus
+    :param manifest_path: string, path to the json manifest
+    :return: list, numbers of the patients saved by this run
+    """
+    saved = export_parallel(patients, _save_patient, (type,), processes=processes, manifest_path=manifest_path)
+    return [patient_num for patient_num, path in saved]
+
+
 def s3_dump(directory, bucket):
     """
     necessary to work with an amzn s3 bucket
@@ -223,8 +284,8 @@ if __name__ == '__main__':
     #save_labelsss(labels).
     # patients = glob('Training/HGG/**')
     patients = glob('/home/ixb3/Scrivania/toSend/**')
-    save_patient_slices(patients, 'reg')
-    save_patient_slices(patients, 'norm')
+    save_patient_slices_parallel(patients, 'reg')
+    save_patient_slices_parallel(patients, 'norm')
   #  save_patient_slices(patients, 'n4')
     # s3_dump('Graveyard/Training_PNG/', 'orig-training-png')
 